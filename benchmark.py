@@ -0,0 +1,379 @@
+"""Benchmark the reconstruction on synthetic trajectories.
+
+Times each stage of the reconstruction (neighbor search, system matrix, dcf,
+gridding, FFT and the full reconstruction) on trajectories generated at the sizes
+of our scans, for several kernels and overgrid factors. Each case runs in its own
+process, so that its peak memory is measured alone. No data is read, so the
+benchmark runs offline.
+
+Run the benchmark and save the results:
+    python benchmark.py --output=benchmark.json
+
+Compare results against a saved baseline, flagging regressions:
+    python benchmark.py --command=compare --baseline=baseline.json \
+        --output=benchmark.json
+"""
+import datetime
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import time
+from typing import Any, Callable, Dict, List
+
+import numba
+import numpy as np
+from absl import app, flags
+
+import reconstruction
+from recon import dcf, kernel, proximity, recon_model, system_model
+from utils import constants, fft_utils, recon_utils, traj_utils
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_enum(
+    "command", "run", ["run", "compare"], "run the benchmark or compare results."
+)
+flags.DEFINE_string("output", "benchmark.json", "path of the results JSON file.")
+flags.DEFINE_string("baseline", None, "path of the baseline results JSON file.")
+flags.DEFINE_list("trajectories", None, "trajectories to run, all if not given.")
+flags.DEFINE_list("kernels", None, "kernels to run, all if not given.")
+flags.DEFINE_list("stages", None, "stages to run, all if not given.")
+flags.DEFINE_integer("image_size", 64, "reconstructed image size.")
+flags.DEFINE_integer("repeats", 3, "number of timed runs of each stage.")
+flags.DEFINE_float("time_tolerance", 0.1, "accepted relative increase of wall time.")
+flags.DEFINE_float("rss_tolerance", 0.1, "accepted relative increase of peak RSS.")
+
+# number of projections and of points per projection of the trajectories
+TRAJECTORIES = {
+    "dixon_1000": (1000, 64),
+    "dixon_2000": (2000, 64),
+    "ute_4600": (4600, 64),
+}
+
+# kernel settings passed to reconstruction.reconstruct
+KERNELS = {
+    "gaussian_lr": {
+        "kernel_type": constants.KernelType.GAUSSIAN.value,
+        "kernel_sharpness": 0.14,
+        "kernel_extent": 9 * 0.14,
+        "overgrid_factor": 3.0,
+    },
+    "gaussian_hr": {
+        "kernel_type": constants.KernelType.GAUSSIAN.value,
+        "kernel_sharpness": 0.32,
+        "kernel_extent": 9 * 0.32,
+        "overgrid_factor": 3.0,
+    },
+    "kaiser_bessel_2": {
+        "kernel_type": constants.KernelType.KAISERBESSEL.value,
+        "kernel_extent": 4.0 / 2.0,
+        "overgrid_factor": 2.0,
+    },
+    "kaiser_bessel_1.25": {
+        "kernel_type": constants.KernelType.KAISERBESSEL.value,
+        "kernel_extent": 4.0 / 1.25,
+        "overgrid_factor": 1.25,
+    },
+}
+
+STAGES = ["neighbor_search", "csr_build", "dcf", "gridding", "fft", "reconstruct"]
+
+# number of projections of the untimed run that loads the compiled kernels
+_N_WARMUP_PROJECTIONS = 16
+# number of dcf iterations, as in reconstruction.reconstruct
+_N_DCF_ITERATIONS = 20
+
+
+def get_inputs(trajectory: str, image_size: int) -> Dict[str, np.ndarray]:
+    """Generate the trajectory and random data of a benchmark trajectory.
+
+    The trajectory is scaled like the trajectories of the pipeline.
+
+    Args:
+        trajectory (str): name of the trajectory, see TRAJECTORIES.
+        image_size (int): reconstructed image size.
+
+    Returns:
+        Dictionary of the flattened trajectory of shape (K, 3) and data of shape
+            (K, 1).
+    """
+    n_projections, n_points = TRAJECTORIES[trajectory]
+    x, y, z = traj_utils.generate_trajectory(n_frames=n_projections, n_points=n_points)
+    traj = np.stack([x, y, z], axis=-1) * traj_utils.get_scaling_factor(
+        recon_size=image_size, n_points=n_points
+    )
+    rng = np.random.default_rng(seed=0)
+    data = rng.standard_normal(x.shape) + 1j * rng.standard_normal(x.shape)
+    return {
+        "traj": recon_utils.flatten_traj(traj),
+        "data": recon_utils.flatten_data(data),
+    }
+
+
+def get_proximity(settings: Dict[str, Any]) -> proximity.L2Proximity:
+    """Get the proximity object of the kernel settings."""
+    if settings["kernel_type"] == constants.KernelType.GAUSSIAN.value:
+        kernel_obj = kernel.Gaussian(
+            kernel_extent=settings["kernel_extent"],
+            kernel_sigma=settings["kernel_sharpness"],
+            verbosity=False,
+        )
+    else:
+        kernel_obj = kernel.KaiserBessel(
+            kernel_extent=settings["kernel_extent"],
+            overgrid_factor=settings["overgrid_factor"],
+            verbosity=False,
+        )
+    return proximity.L2Proximity(kernel_obj=kernel_obj, verbosity=False)
+
+
+def get_stage(
+    stage: str,
+    settings: Dict[str, Any],
+    traj: np.ndarray,
+    data: np.ndarray,
+    image_size: int,
+) -> Callable[[], Any]:
+    """Prepare the inputs of a stage and get the function that runs it.
+
+    Args:
+        stage (str): name of the stage, see STAGES.
+        settings (dict): kernel settings, see KERNELS.
+        traj (np.ndarray): trajectory of shape (K, 3)
+        data (np.ndarray): data of shape (K, 1)
+        image_size (int): reconstructed image size.
+
+    Returns:
+        Function without arguments that runs the stage.
+    """
+    overgrid_factor = settings["overgrid_factor"]
+    if stage == "reconstruct":
+        return lambda: reconstruction.reconstruct(
+            data=data, traj=traj, image_size=image_size, verbosity=False, **settings
+        )
+    prox_obj = get_proximity(settings)
+    image_size_3d = np.array([image_size] * 3)
+    full_size = np.ceil(overgrid_factor * image_size_3d).astype(int)
+    if stage == "neighbor_search":
+        return lambda: prox_obj.squared_distances_csr(
+            traj=traj,
+            kernel_width=overgrid_factor * prox_obj.kernel_obj.extent,
+            matrix_size=full_size,
+        )
+
+    def build_system():
+        return system_model.MatrixSystemModel(
+            proximity_obj=prox_obj,
+            overgrid_factor=overgrid_factor,
+            image_size=image_size_3d,
+            traj=traj,
+            verbosity=False,
+        )
+
+    if stage == "csr_build":
+        return build_system
+    system_obj = build_system()
+
+    def build_dcf():
+        return dcf.IterativeDCF(
+            system_obj=system_obj,
+            dcf_iterations=_N_DCF_ITERATIONS,
+            verbosity=False,
+        )
+
+    if stage == "dcf":
+        return build_dcf
+    recon_obj = recon_model.LSQgridded(
+        system_obj=system_obj, dcf_obj=build_dcf(), verbosity=False
+    )
+    if stage == "gridding":
+        return lambda: recon_obj.grid(data)
+    if stage == "fft":
+        grid = recon_obj.grid(data).reshape(tuple(full_size))
+        return lambda: fft_utils.ifftn_centered(grid)
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def peak_rss_mb() -> float:
+    """Get the peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(
+    trajectory: str,
+    kernel_name: str,
+    stage: str,
+    image_size: int,
+    repeats: int,
+    queue: multiprocessing.Queue,
+):
+    """Time a stage of the reconstruction and put its results in the queue.
+
+    The stage is run once untimed on the first projections of the trajectory, which
+    loads the compiled kernels, and then repeats times on the full trajectory.
+
+    Args:
+        trajectory (str): name of the trajectory, see TRAJECTORIES.
+        kernel_name (str): name of the kernel settings, see KERNELS.
+        stage (str): name of the stage, see STAGES.
+        image_size (int): reconstructed image size.
+        repeats (int): number of timed runs.
+        queue (multiprocessing.Queue): queue of the results.
+    """
+    settings = KERNELS[kernel_name]
+    inputs = get_inputs(trajectory, image_size)
+    n_warmup = _N_WARMUP_PROJECTIONS * TRAJECTORIES[trajectory][1]
+    get_stage(
+        stage,
+        settings,
+        inputs["traj"][:n_warmup],
+        inputs["data"][:n_warmup],
+        image_size,
+    )()
+    run_stage = get_stage(stage, settings, inputs["traj"], inputs["data"], image_size)
+    setup_rss_mb = peak_rss_mb()
+    wall_times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        run_stage()
+        wall_times.append(time.perf_counter() - start_time)
+    queue.put(
+        {
+            "name": "/".join([trajectory, kernel_name, stage]),
+            "trajectory": trajectory,
+            "kernel": kernel_name,
+            "stage": stage,
+            "wall_time_s": min(wall_times),
+            "wall_times_s": wall_times,
+            "setup_rss_mb": setup_rss_mb,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    )
+
+
+def run_benchmark() -> Dict[str, Any]:
+    """Run all selected cases, each in a new process.
+
+    Returns:
+        Dictionary of the metadata of the run and of the results of each case.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    results = []
+    for trajectory in FLAGS.trajectories or TRAJECTORIES:
+        for kernel_name in FLAGS.kernels or KERNELS:
+            for stage in FLAGS.stages or STAGES:
+                process = context.Process(
+                    target=run_case,
+                    args=(
+                        trajectory,
+                        kernel_name,
+                        stage,
+                        FLAGS.image_size,
+                        FLAGS.repeats,
+                        queue,
+                    ),
+                )
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError(
+                        "Benchmark case {}/{}/{} failed.".format(
+                            trajectory, kernel_name, stage
+                        )
+                    )
+                result = queue.get()
+                logging.info(
+                    "{}: {:.3f} s, {:.0f} MB".format(
+                        result["name"], result["wall_time_s"], result["peak_rss_mb"]
+                    )
+                )
+                results.append(result)
+    return {
+        "metadata": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "numba": numba.__version__,
+            "n_threads": numba.config.NUMBA_NUM_THREADS,
+            "image_size": FLAGS.image_size,
+            "repeats": FLAGS.repeats,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """Compare benchmark results against a baseline.
+
+    Args:
+        baseline (dict): baseline results, see run_benchmark.
+        current (dict): current results, see run_benchmark.
+
+    Returns:
+        List of the names of the cases whose wall time or peak RSS increased by
+            more than the tolerance.
+    """
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    print(
+        "{:<48} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+            "case", "base s", "new s", "ratio", "base MB", "new MB", "ratio"
+        )
+    )
+    for result in current["results"]:
+        base = baseline_results.get(result["name"])
+        if base is None:
+            print("{:<48} not in baseline".format(result["name"]))
+            continue
+        time_ratio = result["wall_time_s"] / max(base["wall_time_s"], 1e-9)
+        rss_ratio = result["peak_rss_mb"] / max(base["peak_rss_mb"], 1e-9)
+        is_regression = (
+            time_ratio > 1 + FLAGS.time_tolerance or rss_ratio > 1 + FLAGS.rss_tolerance
+        )
+        if is_regression:
+            regressions.append(result["name"])
+        print(
+            "{:<48} {:>10.3f} {:>10.3f} {:>8.2f} {:>10.0f} {:>10.0f} {:>8.2f}{}".format(
+                result["name"],
+                base["wall_time_s"],
+                result["wall_time_s"],
+                time_ratio,
+                base["peak_rss_mb"],
+                result["peak_rss_mb"],
+                rss_ratio,
+                "  REGRESSION" if is_regression else "",
+            )
+        )
+    return regressions
+
+
+def main(argv):
+    """Run the benchmark or compare its results against a baseline."""
+    if FLAGS.command == "run":
+        results = run_benchmark()
+        with open(FLAGS.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logging.info("Saved results to {}".format(FLAGS.output))
+    else:
+        with open(FLAGS.output, "r") as f:
+            results = json.load(f)
+    if FLAGS.baseline is None:
+        return 0
+    with open(FLAGS.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(baseline, results)
+    if regressions:
+        logging.warning(
+            "{} regressions against {}".format(len(regressions), FLAGS.baseline)
+        )
+        return 1
+    logging.info("No regressions against {}".format(FLAGS.baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    app.run(main)
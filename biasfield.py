@@ -1,6 +1,7 @@
 """Bias field correction.
 
-Currently supports N4ITK bias field correction.
+Currently supports N4ITK bias field correction, and RF-depolarization bias field
+correction from the images of the first and second halves of the acquisition.
 """
 import os
 import subprocess
@@ -72,19 +73,15 @@ def calculate_biasfield_rf(
     """
     image_alpha = calculate_flip_angle(image1, image2, n_proj, T1, TR)
     c1 = np.cos(image_alpha * np.pi / 180) * np.exp(-TR / T1)
-    # calculate analytic bias field
-    image_biasfield = (
-        image_alpha
-        * np.sin(image_alpha * np.pi / 180)
-        * np.divide((1 - np.power(c1, n_proj)), 1 - c1)
+    # calculate analytic bias field, the signal summed over the projections
+    image_biasfield = np.sin(image_alpha * np.pi / 180) * np.divide(
+        (1 - np.power(c1, n_proj)), 1 - c1
     )
     # normalize to the mean
     image_biasfield = img_utils.normalize(
         image_biasfield, mask, method=constants.NormalizationMethods.MEAN
     )
-    image_biasfield_smoothed = img_utils.approximate_image_with_bspline(
-        image_biasfield, mask
-    )
+    image_biasfield_smoothed = img_utils.smooth_image_in_mask(image_biasfield, mask)
     return image_biasfield, image_biasfield_smoothed
 
 
@@ -128,7 +125,7 @@ def correct_biasfield_n4itk(
 #    os.remove(pathOutput)
 #    os.remove(pathBiasField)
 
-    return image_cor.astype("float64"), image_biasfield.astype("float64")
+    return image_cor.astype(image.real.dtype), image_biasfield.astype(image.real.dtype)
 
 
 def correct_biasfield_rf(
@@ -161,7 +158,7 @@ def correct_biasfield_rf(
     image_cor = img_utils.normalize(
         image_cor, mask, method=constants.NormalizationMethods.MAX
     )
-    return image_cor, image_biasfield_smoothed
+    return image_cor.astype(image.dtype), image_biasfield_smoothed.astype(image.dtype)
 
 
 def main(argv):
@@ -0,0 +1,116 @@
+"""Validate the single precision pipeline against the double precision pipeline.
+
+Reconstructs and analyzes a subject processed before, read from its .mat file, once
+per precision and writes a report of the binned percentages and mean ratios of both
+runs, their differences and the memory held by the subject images.
+"""
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from absl import app, flags
+from ml_collections import config_flags
+
+from subject_classmap import Subject
+from utils import constants
+
+FLAGS = flags.FLAGS
+
+_CONFIG = config_flags.DEFINE_config_file("config", None, "config file.")
+flags.DEFINE_string("data_dir", None, "folder of the subject .mat file.", required=True)
+flags.DEFINE_float(
+    "tolerance", 0.1, "largest accepted difference of the binned percentages."
+)
+
+# statistics compared between the precisions
+_STATS = [
+    constants.StatsIOFields.VENT_DEFECT_PCT,
+    constants.StatsIOFields.VENT_LOW_PCT,
+    constants.StatsIOFields.VENT_HIGH_PCT,
+    constants.StatsIOFields.RBC_DEFECT_PCT,
+    constants.StatsIOFields.RBC_LOW_PCT,
+    constants.StatsIOFields.RBC_HIGH_PCT,
+    constants.StatsIOFields.MEMBRANE_DEFECT_PCT,
+    constants.StatsIOFields.MEMBRANE_LOW_PCT,
+    constants.StatsIOFields.MEMBRANE_HIGH_PCT,
+    constants.StatsIOFields.VENT_MEAN,
+    constants.StatsIOFields.RBC_MEAN,
+    constants.StatsIOFields.MEMBRANE_MEAN,
+]
+
+
+def run_subject(config, precision: str) -> Subject:
+    """Reconstruct and analyze the subject of the .mat file in a precision.
+
+    The mask, registration and RBC:M ratio of the .mat file are kept, so that only
+    the precision differs between runs.
+
+    Args:
+        config (config_dict.ConfigDict): config dict
+        precision (str): precision of the run, see constants.Precision.
+
+    Returns:
+        Subject with its statistics.
+    """
+    config.precision = precision
+    subject = Subject(config=config)
+    subject.read_mat_file()
+    subject.data_gas = subject.data_gas.astype(subject.complex_dtype)
+    subject.data_dissolved = subject.data_dissolved.astype(subject.complex_dtype)
+    subject.traj_gas = subject.traj_gas.astype(subject.real_dtype)
+    subject.traj_dissolved = subject.traj_dissolved.astype(subject.real_dtype)
+    subject.reconstruction_gas()
+    subject.reconstruction_dissolved()
+    subject.biasfield_correction()
+    subject.gas_binning()
+    subject.dixon_decomposition()
+    subject.hb_correction()
+    subject.dissolved_analysis()
+    subject.dissolved_binning()
+    subject.get_statistics()
+    return subject
+
+
+def image_nbytes(subject: Subject) -> int:
+    """Get the memory held by the arrays of the subject in bytes."""
+    return sum(
+        value.nbytes for value in vars(subject).values() if isinstance(value, np.ndarray)
+    )
+
+
+def main(argv):
+    """Compare the single and double precision pipelines."""
+    config = _CONFIG.value
+    config.data_dir = FLAGS.data_dir
+    os.makedirs("tmp", exist_ok=True)
+    report = {}
+    for precision in [p.value for p in constants.Precision]:
+        start_time = time.time()
+        subject = run_subject(config, precision)
+        report[precision] = {key: subject.dict_stats[key] for key in _STATS}
+        report[precision]["image_mb"] = image_nbytes(subject) / 1e6
+        report[precision]["time_s"] = time.time() - start_time
+    report = pd.DataFrame(report)
+    double = constants.Precision.DOUBLE.value
+    single = constants.Precision.SINGLE.value
+    report["difference"] = report[single] - report[double]
+    output_path = os.path.join(config.data_dir, "output")
+    os.makedirs(output_path, exist_ok=True)
+    report.to_csv(os.path.join(output_path, "precision_report.csv"))
+    print(report.to_string(float_format="{:.4f}".format))
+    pct = [key for key in _STATS if key.endswith("_pct")]
+    max_difference = float(np.max(np.abs(report.loc[pct, "difference"])))
+    if max_difference > FLAGS.tolerance:
+        logging.warning(
+            "Binned percentages differ by up to {:.4f} %.".format(max_difference)
+        )
+    else:
+        logging.info(
+            "Binned percentages agree within {:.4f} %.".format(max_difference)
+        )
+
+
+if __name__ == "__main__":
+    app.run(main)
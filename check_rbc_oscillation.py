@@ -0,0 +1,98 @@
+"""Check that the RBC oscillation analysis recovers a known oscillation amplitude.
+
+Builds synthetic gas, total, high and low keyhole images of a lung with a known RBC
+swing between the high and low bins, a B0 phase map and an arbitrary receiver phase.
+The keyhole images are decomposed with the dixon rotation of the total image, as in
+Subject.rbc_oscillation_analysis, and the mean oscillation in the mask is compared
+with the true value.
+"""
+import logging
+import sys
+
+import numpy as np
+from absl import app, flags
+
+from utils import constants, img_utils
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_float("membrane", 1.0, "membrane signal of the synthetic lung.")
+flags.DEFINE_float("rbc_m_ratio", 0.5, "RBC:M ratio of the synthetic lung.")
+flags.DEFINE_float("amplitude", 0.1, "relative RBC swing of the high and low bins.")
+flags.DEFINE_float("tolerance", 0.5, "largest accepted error in percent.")
+
+
+def make_images(
+    membrane: float, rbc_m_ratio: float, amplitude: float, size: int = 32
+) -> dict:
+    """Make synthetic gas and dissolved images of an ellipsoid lung.
+
+    Args:
+        membrane (float): membrane signal.
+        rbc_m_ratio (float): RBC:M ratio of the total image.
+        amplitude (float): relative RBC swing, the high and low bins hold
+            (1 +- amplitude) times the RBC signal of the total image.
+        size (int): image size.
+
+    Returns:
+        Dictionary of the gas, total, high and low images and the mask.
+    """
+    grid = np.stack(
+        np.meshgrid(*[np.linspace(-1, 1, size)] * 3, indexing="ij"), axis=-1
+    )
+    mask = np.sum((grid / [0.8, 0.6, 0.7]) ** 2, axis=-1) < 1
+    # smooth B0 phase map and receiver phase shared by all images
+    phase_b0 = 0.8 * grid[..., 0] + 0.3 * grid[..., 1] * grid[..., 2]
+    phase = np.exp(1j * (phase_b0 + 1.2))
+    rbc = membrane * rbc_m_ratio
+    images = {
+        "mask": mask,
+        "gas": mask * np.exp(1j * phase_b0),
+        "total": mask * (membrane + 1j * rbc) * phase,
+        "high": mask * (membrane + 1j * rbc * (1 + amplitude)) * phase,
+        "low": mask * (membrane + 1j * rbc * (1 - amplitude)) * phase,
+    }
+    return images
+
+
+def main(argv):
+    """Compare the recovered oscillation with the true oscillation."""
+    images = make_images(FLAGS.membrane, FLAGS.rbc_m_ratio, FLAGS.amplitude)
+    mask = images["mask"]
+    rotation = img_utils.get_dixon_rotation(
+        image_gas=images["gas"],
+        image_dissolved=images["total"],
+        mask=mask,
+        rbc_m_ratio=FLAGS.rbc_m_ratio,
+    )
+    image_rbc_high, image_rbc_low, image_rbc_total = [
+        img_utils.dixon_decomposition(
+            image_gas=images["gas"],
+            image_dissolved=images[key],
+            mask=mask,
+            rbc_m_ratio=FLAGS.rbc_m_ratio,
+            rotation=rotation,
+        )[0]
+        for key in ["high", "low", "total"]
+    ]
+    image_rbc_osc = img_utils.calculate_rbc_oscillation(
+        image_high=image_rbc_high,
+        image_low=image_rbc_low,
+        image_total=image_rbc_total,
+        mask=mask,
+        method=constants.Methods.ELEMENTWISE,
+    )
+    expected = 100 * 2 * FLAGS.amplitude
+    recovered = float(np.mean(image_rbc_osc[mask]))
+    logging.info(
+        "RBC oscillation: expected {:.2f}%, recovered {:.2f}%.".format(
+            expected, recovered
+        )
+    )
+    if abs(recovered - expected) > FLAGS.tolerance:
+        logging.error("The RBC oscillation is not recovered.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    app.run(main)
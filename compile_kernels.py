@@ -0,0 +1,63 @@
+"""Compile the numba gridding kernels into the on-disk cache.
+
+The kernels are cached on first use, so running this once after installing the
+pipeline, or after updating recon/, keeps the first subject from paying the compile
+time. Each reconstruction setting of the pipeline is run once on a small trajectory,
+which compiles every kernel for the data types it is called with.
+"""
+import time
+
+import numpy as np
+from absl import app, logging
+
+import reconstruction
+from recon import neighborhood
+from utils import constants, traj_utils
+
+# reconstruction settings that reach distinct kernels or kernel signatures
+_SETTINGS = {
+    "matrix": {},
+    "neighborhood cache": {"neighborhood_cache": neighborhood.NeighborhoodCache()},
+    "on the fly": {"max_matrix_gb": 0.0},
+    "chunked": {"chunk_size": 64 * 16},
+    "kaiser-bessel": {
+        "kernel_type": constants.KernelType.KAISERBESSEL.value,
+        "kernel_extent": 4.0 / 2.0,
+        "overgrid_factor": 2.0,
+    },
+}
+
+
+def main(argv):
+    """Run small reconstructions in all settings and precisions."""
+    x, y, z = traj_utils.generate_trajectory(n_frames=64, n_points=64)
+    traj = np.stack([x, y, z], axis=-1).reshape(-1, 3)
+    start_time = time.time()
+    for precision in constants.Precision:
+        single = precision == constants.Precision.SINGLE
+        real_dtype = np.float32 if single else np.float64
+        data = np.ones((traj.shape[0], 1), dtype=np.result_type(real_dtype, 1j))
+        for name, setting in _SETTINGS.items():
+            setting_time = time.time()
+            reconstruction.reconstruct(
+                data=data,
+                traj=traj.astype(real_dtype),
+                image_size=16,
+                n_dcf_iter=2,
+                matrix_dtype=real_dtype,
+                dcf_dtype=real_dtype,
+                verbosity=False,
+                **setting,
+            )
+            logging.info(
+                "Compiled {} {} in {:.2f} seconds".format(
+                    precision.value, name, time.time() - setting_time
+                )
+            )
+    logging.info(
+        "Compiled all kernels in {:.2f} seconds".format(time.time() - start_time)
+    )
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -16,11 +16,15 @@ class Config(config_dict.ConfigDict):
     """Base config file.
 
     Attributes:
+        cache_twix: bool, whether to keep a parsed copy of each twix file next to it
+            so that reruns skip parsing
         data_dir: str, path to the data directory
         hb_correction_key: str, hemoglobin correction key
         hb: float, subject hb value in g/dL
         manual_reg_filepath: str, path to manual registration nifti file
         manual_seg_filepath: str, path to the manual segmentation nifti file
+        precision: str, the floating point precision of the data and images, see
+            constants.Precision
         processes: Process, the evaluation processes
         rbc_m_ratio: float, the RBC to M ratio
         reference_data_key: str, reference data key
@@ -34,6 +38,7 @@ class Config(config_dict.ConfigDict):
     def __init__(self):
         """Initialize config parameters."""
         super().__init__()
+        self.cache_twix = True
         self.data_dir = ""
         self.manual_seg_filepath = ""
         self.manual_reg_filepath = ""
@@ -44,6 +49,7 @@ class Config(config_dict.ConfigDict):
         self.segmentation_key = constants.SegmentationKey.CNN_VENT.value
         self.registration_key = constants.RegistrationKey.SKIP.value
         self.bias_key = constants.BiasfieldKey.N4ITK.value
+        self.precision = constants.Precision.DOUBLE.value
         self.hb_correction_key = constants.HbCorrectionKey.NONE.value
         self.hb = 0.0
         self.subject_id = "test"
@@ -70,7 +76,8 @@ class Recon(object):
     """Define reconstruction configurations.
 
     Attributes:
-        recon_key: str, the reconstruction key
+        recon_key: str, the reconstruction key. robertson grids the data, plummer runs
+            an iterative compressed sensing reconstruction from the gridded image
         scan_type: str, the scan type
         kernel_sharpness_lr: float, the kernel sharpness for low resolution, higher
             SNR images
@@ -78,7 +85,53 @@ class Recon(object):
             SNR images
         n_skip_start: int, the number of frames to skip at the beginning
         n_skip_end: int, the number of frames to skip at the end
-        key_radius: int, the key radius for the keyhole image
+        key_radius: int, the key radius for the keyhole image in number of points of
+            each projection
+        recon_rbc_oscillation: bool, whether to reconstruct the keyhole high and low
+            RBC images and the RBC oscillation image
+        recon_size: int, the size of the reconstructed image, which sets the kernel
+            and system matrix
+        matrix_size: int, the size of the output images, upsampled from recon_size
+        upsample_method: str, the upsampling from recon_size to matrix_size. The
+            default zero-pads k-space, which keeps voxel recon_size/2 at voxel
+            matrix_size/2. Images of earlier versions were zoomed with aligned corner
+            voxels and are shifted by about half a voxel, use zoom for manual masks
+            drawn on them
+        preview_size: int, the size of the images of the preview reconstruction
+        n_threads: int, the number of threads used to build the system matrix. 0 uses
+            all available threads
+        cache_dir: str, path to the on-disk cache of system matrices and dcfs shared
+            between subjects. Empty string disables the cache
+        cache_size_gb: float, maximum size of the on-disk cache in GB
+        max_matrix_gb: float, memory budget of the system matrix in GB. Larger
+            reconstructions compute the interpolation coefficients on the fly
+        chunk_projections: int, number of projections gridded at a time when
+            streaming the samples through the gridding. 0 grids all projections at once.
+            Streaming recomputes the interpolation coefficients in every dcf
+            iteration, so it is about 3 times slower than the stored matrix
+        presort_samples: bool, whether to sort the samples along a space-filling curve
+            of the grid before gridding, which speeds up the gridding on large
+            trajectories and leaves the images unchanged
+        kernel_type: str, the gridding kernel type. The Kaiser-Bessel kernel does not
+            use the kernel sharpness, so the high SNR and high resolution images only
+            differ with the gaussian kernel
+        overgrid_factor: float, the overgridding factor. 3 for the gaussian kernel,
+            1.25-2 for the Kaiser-Bessel kernel
+        kernel_width_kb: float, the Kaiser-Bessel kernel width in overgridded k-space
+            voxels
+        deapodize: bool, whether to divide the images by the Fourier transform of the
+            gridding kernel. Should be used with the Kaiser-Bessel kernel
+        fft_backend: str, the FFT backend of the reconstruction and spectroscopy.
+            The pyFFTW wisdom is kept in cache_dir if it is set
+        fft_complex64: bool, whether to compute the image FFTs in single precision
+        dcf_warm_start: bool, whether to start the dcf iterations from the analytic
+            density of the radial trajectory
+        dcf_tolerance: float, relative dcf update below which the dcf iterations stop.
+            0 runs all iterations, 5e-3 keeps the images within 1% of 20 iterations
+        dcf_float32: bool, whether to run the dcf iterations in single precision
+        n_cs_iter: int, the number of iterations of the plummer reconstruction
+        cs_lambda: float, the wavelet regularization of the plummer reconstruction,
+            relative to the maximum of the gridded image. 0 solves least squares
     """
 
     def __init__(self):
@@ -89,11 +142,32 @@ class Recon(object):
         self.kernel_sharpness_hr = 0.32
         self.n_skip_start = config_utils.get_n_skip_start(self.scan_type)
         self.n_skip_end = 0
+        self.key_radius = 9
+        self.recon_rbc_oscillation = False
         self.recon_size = 64
         self.matrix_size = 128 # ???
+        self.preview_size = 32
         self.recon_proton = True
         self.remove_contamination = False
         self.remove_noisy_projections = True
+        self.n_threads = 0
+        self.cache_dir = ""
+        self.cache_size_gb = 20.0
+        self.max_matrix_gb = 16.0
+        self.chunk_projections = 0
+        self.presort_samples = False
+        self.kernel_type = constants.KernelType.GAUSSIAN.value
+        self.overgrid_factor = 3.0
+        self.kernel_width_kb = 4.0
+        self.deapodize = False
+        self.fft_backend = constants.FFTBackend.SCIPY.value
+        self.upsample_method = constants.UpsampleMethod.FOURIER.value
+        self.fft_complex64 = False
+        self.dcf_warm_start = False
+        self.dcf_tolerance = 0.0
+        self.dcf_float32 = False
+        self.n_cs_iter = 20
+        self.cs_lambda = 0.01
 
 
 class ReferenceData(object):
@@ -45,6 +45,10 @@ flags.DEFINE_bool(name="force_segmentation",
                   default=False, 
                   help="run segmentation again.")
 
+flags.DEFINE_bool(name="preview",
+                  default=False,
+                  help="only reconstruct a low resolution preview of the subject.")
+
 # flags.DEFINE_string(name="seg_path",
                     # default=None, 
                     # help="The path to the mask/label")
@@ -72,7 +76,11 @@ def gx_mapping_reconstruction(config: base_config.Config):
     logging.info("Reconstructing images")
     subject.preprocess()
     subject.reconstruction_gas()
+    if config.bias_key == constants.BiasfieldKey.RF_DEPOLARIZATION.value:
+        subject.reconstruction_gas_subdivisions()
     subject.reconstruction_dissolved()
+    if config.recon.recon_rbc_oscillation:
+        subject.reconstruction_rbc_oscillation()
     
     if config.recon.recon_proton:
         subject.reconstruction_ute()
@@ -84,6 +92,8 @@ def gx_mapping_reconstruction(config: base_config.Config):
     subject.biasfield_correction()
     subject.gas_binning()
     subject.dixon_decomposition()
+    if config.recon.recon_rbc_oscillation:
+        subject.rbc_oscillation_analysis()
     subject.hb_correction()
     subject.dissolved_analysis()
     subject.dissolved_binning()
@@ -101,6 +111,28 @@ def gx_mapping_reconstruction(config: base_config.Config):
     logging.info("Complete")
 
 
+def gx_mapping_preview(config: base_config.Config):
+    """Reconstruct a low resolution preview to check the raw data.
+
+    Skips segmentation, registration and the gas exchange analysis.
+
+    Args:
+        config (config_dict.ConfigDict): config dict
+    """
+    subject = Subject(config=config)
+    try:
+        subject.read_twix_files()
+    except:
+        logging.warning("Cannot read in twix files.")
+        try:
+            subject.read_mrd_files()
+        except:
+            raise ValueError("Cannot read in raw data files.")
+    subject.preprocess()
+    subject.preview_reconstruction()
+    logging.info("Complete")
+
+
 def gx_mapping_readin(config: base_config.Config):
     """Run the gas exchange imaging pipeline by reading in .mat file.
 
@@ -150,6 +182,10 @@ def main(argv):
     '''
     config.rbc_m_ratio = FLAGS.rbc_m_ratio 
     print(f"Given RBC:M ratio: {config.rbc_m_ratio}")
+
+    if FLAGS.preview:
+        gx_mapping_preview(config)
+        return
     
     # Set manual or automatic segmentation
     if FLAGS.force_segmentation:
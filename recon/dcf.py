@@ -4,6 +4,7 @@ import logging
 import sys
 import time
 from abc import ABC, abstractmethod
+from typing import Optional
 
 import numpy as np
 from scipy.stats import norm
@@ -13,6 +14,48 @@ from recon import system_model
 from utils import constants
 
 
+def _safe_divide(a, b: np.ndarray) -> np.ndarray:
+    """Divide a by b, with 0 where b is 0.
+
+    Samples without any grid neighbor inside the kernel, e.g. beyond the edge of
+    the grid with a narrow kernel, have a zero row in the system matrix.
+    """
+    return np.divide(
+        a, b, out=np.zeros(np.shape(b), dtype=np.result_type(a, b)), where=b != 0
+    )
+
+
+def radial_density_estimate(traj: np.ndarray) -> np.ndarray:
+    """Estimate the dcf of a 3D radial trajectory analytically.
+
+    Each sample is weighted by the volume of the spherical shell of k-space between
+    the midpoints to its neighbors on the projection, up to a constant factor, which
+    is |k|^2 dk on the ramp and plateau.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (n_projections, n_points, 3)
+
+    Returns:
+        np.ndarray: dcf estimate of shape (n_projections * n_points, 1)
+    """
+    radius = np.linalg.norm(traj, axis=-1)
+    mid = 0.5 * (radius[:, 1:] + radius[:, :-1])
+    edges = np.concatenate(
+        [
+            np.zeros((radius.shape[0], 1)),
+            mid,
+            radius[:, -1:] + 0.5 * (radius[:, -1:] - radius[:, -2:-1]),
+        ],
+        axis=1,
+    )
+    edges = np.maximum.accumulate(edges, axis=1)
+    weights = np.diff(edges**3, axis=1)
+    # samples repeated at the center must not start at 0, the iterations keep zeros
+    positive = weights[weights > 0]
+    floor = np.min(positive) if positive.size else 1.0
+    return np.maximum(weights, floor).reshape(-1, 1)
+
+
 class DCF(ABC):
     """Density compensation filter abstract class.
 
@@ -55,8 +98,11 @@ class IterativeDCF(DCF):
     Retrieved from http://www.ncbi.nlm.nih.gov/pubmed/10025627
 
     Attributes:
-        system_obj (MatrixSystemModel): A subclass of the SystemModel
-        dcf_iterations (int): number of iterations for density compensation.
+        system_obj (SystemModel): A subclass of the SystemModel
+        dcf_iterations (int): maximum number of iterations for density compensation.
+        tolerance (float): relative update of the dcf below which the iterations
+            stop.
+        n_iterations (int): number of iterations used.
         verbosity (bool): Log output messages.
         space (str): a string
         unique_string (str): unique string defining class.
@@ -64,35 +110,75 @@ class IterativeDCF(DCF):
 
     def __init__(
         self,
-        system_obj: system_model.MatrixSystemModel,
+        system_obj: system_model.SystemModel,
         dcf_iterations: int,
         verbosity: bool,
+        dcf: Optional[np.ndarray] = None,
+        dcf_init: Optional[np.ndarray] = None,
+        tolerance: float = 0.0,
+        dtype: np.dtype = np.float64,
     ):
         """Initialize the iterative density compensation function class.
 
         Args:
-            system_obj (MatrixSystemModel): A subclass of the SystemModel
-            dcf_iterations (int): number of iterations for density compensation.
+            system_obj (SystemModel): A subclass of the SystemModel
+            dcf_iterations (int): maximum number of iterations for density
+                compensation.
             verbosity (bool): Log output messages.
+            dcf (np.ndarray): optional precomputed dcf of shape (K, 1), e.g. loaded
+                from a disk cache.
+            dcf_init (np.ndarray): optional first guess of shape (K, 1), e.g. from
+                radial_density_estimate. Its scale does not matter. Defaults to the
+                inverse of the system matrix row sums.
+            tolerance (float): stop once the relative update of the dcf is below
+                tolerance. 0 runs all iterations.
+            dtype (np.dtype): precision of the dcf iterations.
         """
         self.system_obj = system_obj
         self.dcf_iterations = dcf_iterations
+        self.tolerance = tolerance
+        self.n_iterations = 0
         self.verbosity = verbosity
         self.unique_string = "iter" + str(dcf_iterations)
         self.space = constants.DCFSpace.DATASPACE
-        # system_obj is a MatrixSystemModel
-        idea_PSFdata = np.ones((system_obj.A._shape[1], 1))
-        # reasonable first guess by summing all up
-        dcf = np.divide(1, system_obj.A.dot(idea_PSFdata))
+        if dcf is not None:
+            self.dcf = dcf
+            return
+        if dcf_init is None:
+            idea_PSFdata = np.ones((int(np.prod(system_obj.full_size)), 1), dtype=dtype)
+            # reasonable first guess by summing all up
+            dcf_init = _safe_divide(
+                np.ones((), dtype=dtype), system_obj.multiply(idea_PSFdata)
+            )
+        dcf = np.asarray(dcf_init, dtype=dtype).reshape(-1, 1)
         # start timing
         time_start = time.time()
         # iteratively calculating dcf
         for kk in range(0, self.dcf_iterations):
             if self.verbosity:
                 logging.info(" DCF iteration " + str(kk + 1))
-            dcf = np.divide(dcf, system_obj.A.dot(system_obj.ATrans.dot(dcf)))
+            dcf_new = _safe_divide(
+                dcf, system_obj.multiply(system_obj.multiply_transpose(dcf))
+            ).astype(dtype, copy=False)
+            update = np.linalg.norm(dcf_new - dcf) / np.linalg.norm(dcf_new)
+            dcf = dcf_new
+            self.n_iterations = kk + 1
+            # the first update mostly sets the scale of the first guess
+            if kk > 0 and update < self.tolerance:
+                break
 
         time_end = time.time()
         if self.verbosity:
             logging.info("The runtime for iterative DCF: " + str(time_end - time_start))
+        if self.verbosity and self.n_iterations < self.dcf_iterations:
+            time_saved = (
+                (self.dcf_iterations - self.n_iterations)
+                * (time_end - time_start)
+                / self.n_iterations
+            )
+            logging.info(
+                "DCF converged after {} of {} iterations, saved {:.2f} s.".format(
+                    self.n_iterations, self.dcf_iterations, time_saved
+                )
+            )
         self.dcf = dcf
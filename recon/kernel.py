@@ -1,10 +1,15 @@
 """Gridding kernels."""
 
 from abc import ABC, abstractmethod
+from typing import Tuple
 
 import numpy as np
+from scipy import special
 from scipy.stats import norm
 
+# first positive zero of the spherical Bessel function j_1, tan(x) = x
+_J1_FIRST_ZERO = 4.493409457909064
+
 
 class Kernel(ABC):
     """Gridding kernel abstract class.
@@ -33,6 +38,37 @@ class Kernel(ABC):
         """Evaluate kernel function."""
         pass
 
+    def radial_profile(self, n_samples: int = 2**16) -> Tuple[np.ndarray, float]:
+        """Sample the kernel uniformly in squared distance for table lookups.
+
+        Gaussian and Kaiser-Bessel kernels are smooth functions of the squared
+        distance, so linear interpolation of the table is accurate and the lookup
+        needs no square root.
+
+        Args:
+            n_samples (int): number of samples between the origin and the kernel
+                halfwidth.
+
+        Returns:
+            Tuple of the kernel values and the squared distance between samples in
+                pre-overgridded k-space voxels.
+        """
+        step = (0.5 * self.extent) ** 2 / (n_samples - 1)
+        return self.evaluate(np.sqrt(np.arange(n_samples) * step)), step
+
+    @abstractmethod
+    def fourier_transform(self, frequencies: np.ndarray) -> np.ndarray:
+        """Evaluate the 3D Fourier transform of the radial kernel.
+
+        Args:
+            frequencies (np.ndarray): radial spatial frequencies in cycles per
+                pre-overgridded k-space voxel.
+
+        Returns:
+            np.ndarray: Fourier transform normalized to 1 at the origin.
+        """
+        pass
+
 
 class Gaussian(Kernel):
     """Gaussian kernel for gridding.
@@ -68,3 +104,113 @@ class Gaussian(Kernel):
             norm.pdf(distances, 0, self.sigma), norm.pdf(0, 0, self.sigma)
         )
         return kernel_vals
+
+    def fourier_transform(self, frequencies: np.ndarray) -> np.ndarray:
+        """Evaluate the 3D Fourier transform of the gaussian function.
+
+        The truncation of the kernel at its extent is neglected.
+
+        Args:
+            frequencies (np.ndarray): radial spatial frequencies in cycles per
+                pre-overgridded k-space voxel.
+
+        Returns:
+            np.ndarray: Fourier transform normalized to 1 at the origin.
+        """
+        return np.exp(-2 * (np.pi * self.sigma * frequencies) ** 2)
+
+
+class KaiserBessel(Kernel):
+    """Radial Kaiser-Bessel kernel for gridding.
+
+    The shape parameter minimizes aliasing for the given overgridding factor:
+    Rapid Gridding Reconstruction With a Minimal Oversampling Ratio.
+    Beatty et al. 2005. In 3D the radial kernel is a Kaiser-Bessel "blob" whose
+    Fourier transform is analytic: Multidimensional digital image representations
+    using generalized Kaiser-Bessel window functions. Lewitt 1990.
+
+    Attributes:
+        overgrid_factor (float): overgridding factor the kernel is designed for.
+        beta (float): shape parameter of the kernel.
+        unique_string (str): Unique string defining object.
+    """
+
+    def __init__(self, kernel_extent: float, overgrid_factor: float, verbosity: bool):
+        """Initialize Kaiser-Bessel Kernel subclass.
+
+        Args:
+            kernel_extent (float): kernel extent. The nonzero range of the
+                kernel in units of pre-overgridded k-space voxels.
+            overgrid_factor (float): overgridding factor.
+            verbosity (bool): Log output messages
+        """
+        super().__init__(kernel_extent=kernel_extent, verbosity=verbosity)
+        self.overgrid_factor = overgrid_factor
+        # Beatty et al. eq. 5 with the width in overgridded grid units
+        kernel_width = overgrid_factor * kernel_extent
+        beta_sqr = np.pi**2 * (
+            (kernel_width / overgrid_factor) ** 2 * (overgrid_factor - 0.5) ** 2 - 0.8
+        )
+        # eq. 5 is derived for separable kernels. The corners of the field of view
+        # of the radial kernel are at sqrt(3)/2 cycles per voxel, so keep them in
+        # the main lobe of the Fourier transform, whose first zero is at the first
+        # zero of the spherical Bessel function j_1, for small overgrid factors.
+        beta_sqr = max(
+            beta_sqr,
+            (np.pi * kernel_extent * np.sqrt(3) / 2) ** 2 - 0.5 * _J1_FIRST_ZERO**2,
+            0.0,
+        )
+        self.beta = np.sqrt(beta_sqr)
+        self.unique_string = (
+            "KaiserBessel_e" + str(self.extent) + "_b" + str(self.beta)
+        )
+
+    def evaluate(self, distances: np.ndarray) -> np.ndarray:
+        """Calculate the normalized Kaiser-Bessel function.
+
+        Args:
+            distances (np.ndarray): kernel distances before overgridding.
+
+        Returns:
+            np.ndarray: Kaiser-Bessel function evaluated at distances, 1 at the
+                origin and 0 outside of the kernel extent.
+        """
+        radius_sqr = np.maximum(1 - (2 * distances / self.extent) ** 2, 0)
+        return np.divide(
+            special.i0(self.beta * np.sqrt(radius_sqr)), special.i0(self.beta)
+        ) * (radius_sqr > 0)
+
+    def fourier_transform(self, frequencies: np.ndarray) -> np.ndarray:
+        """Evaluate the 3D Fourier transform of the Kaiser-Bessel function.
+
+        Args:
+            frequencies (np.ndarray): radial spatial frequencies in cycles per
+                pre-overgridded k-space voxel.
+
+        Returns:
+            np.ndarray: Fourier transform normalized to 1 at the origin.
+        """
+        z_sqr = self.beta**2 - (np.pi * self.extent * frequencies) ** 2
+        return _blob_profile(z_sqr) / _blob_profile(np.array(self.beta**2))
+
+
+def _blob_profile(z_sqr: np.ndarray) -> np.ndarray:
+    """Evaluate I_{3/2}(z) / z^{3/2} up to a constant factor.
+
+    Args:
+        z_sqr (np.ndarray): squared argument. Negative values continue the function
+            to J_{3/2}(w) / w^{3/2} with w^2 = -z_sqr.
+
+    Returns:
+        np.ndarray: the profile of the 3D Fourier transform of a Kaiser-Bessel blob.
+    """
+    z = np.sqrt(np.abs(z_sqr))
+    z_safe = np.maximum(z, 1e-3)
+    profile = np.where(
+        z_sqr > 0,
+        (z_safe * np.cosh(z_safe) - np.sinh(z_safe)) / z_safe**3,
+        (np.sin(z_safe) - z_safe * np.cos(z_safe)) / z_safe**3,
+    )
+    # series expansion around 0 to avoid cancellation
+    series = 1.0 / 3 + np.sign(z_sqr) * z**2 / 30
+    return np.where(z < 1e-3, series, profile)
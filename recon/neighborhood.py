@@ -0,0 +1,294 @@
+"""Reusable sample-voxel neighborhoods.
+
+Building the system matrix is dominated by the neighbor search, which only depends
+on the trajectory, the gridding matrix size and the kernel width. A subject is
+reconstructed several times on the same trajectory (e.g. high SNR and high
+resolution gas images) or on a subset of its rows (dissolved image), so the squared
+distances are cached here and only the kernel is re-evaluated. The evaluated kernel
+matrices are kept as well, so that a reconstruction repeated with the same kernel
+does not evaluate anything.
+"""
+
+import logging
+import sys
+from typing import List, Optional, Tuple
+
+import numpy as np
+import scipy.sparse as sps
+from numba import njit
+
+sys.path.append("..")
+from recon import proximity
+
+
+@njit(cache=True)
+def _find_rows_in_order(traj: np.ndarray, subset: np.ndarray) -> np.ndarray:
+    """Find the row indices of subset in traj if its rows are in the same order.
+
+    Args:
+        traj: Trajectory of shape (K, 3)
+        subset: Trajectory of shape (L, 3)
+
+    Returns:
+        Array of shape (L,) such that traj[rows] == subset, or an array of shape
+        (0,) if subset is not a subsequence of the rows of traj.
+    """
+    rows = np.empty(subset.shape[0], dtype=np.int64)
+    row = 0
+    for n in range(subset.shape[0]):
+        while row < traj.shape[0]:
+            equal = True
+            for dim in range(traj.shape[1]):
+                if traj[row, dim] != subset[n, dim]:
+                    equal = False
+                    break
+            if equal:
+                break
+            row += 1
+        if row == traj.shape[0]:
+            return rows[:0]
+        rows[n] = row
+        row += 1
+    return rows
+
+
+def find_rows(traj: np.ndarray, subset: np.ndarray) -> Optional[np.ndarray]:
+    """Find the row indices of subset in traj.
+
+    Subsets that keep the order of traj, e.g. after dropping projections, are
+    matched in a single pass. Other subsets are matched by sorting.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (K, 3)
+        subset (np.ndarray): trajectory of shape (L, 3)
+
+    Returns:
+        Array of shape (L,) such that traj[rows] == subset, or None if a row of
+        subset is not in traj.
+    """
+    if subset.shape[0] > traj.shape[0] or subset.shape[1:] != traj.shape[1:]:
+        return None
+    if subset.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    rows = _find_rows_in_order(traj, subset)
+    if rows.shape[0] == subset.shape[0]:
+        return rows
+    _, inverse = np.unique(
+        np.concatenate([traj, subset], axis=0), axis=0, return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+    traj_row_of_unique = np.full(np.max(inverse) + 1, -1, dtype=np.int64)
+    traj_row_of_unique[inverse[: traj.shape[0]]] = np.arange(traj.shape[0])
+    rows = traj_row_of_unique[inverse[traj.shape[0] :]]
+    if np.any(rows < 0):
+        return None
+    return rows
+
+
+class Neighborhood(object):
+    """Squared sample-voxel distances of a trajectory.
+
+    Attributes:
+        traj (np.ndarray): trajectory of shape (K, 3)
+        matrix_size (np.ndarray): the gridding matrix size.
+        kernel_width (float): kernel width in overgridded grid units.
+        squared_distances (sps.csr_matrix): squared distances in overgridded
+            grid units of shape (K, prod(matrix_size)).
+    """
+
+    def __init__(
+        self,
+        traj: np.ndarray,
+        matrix_size: np.ndarray,
+        kernel_width: float,
+        squared_distances: sps.csr_matrix,
+    ):
+        """Initialize the neighborhood.
+
+        Args:
+            traj (np.ndarray): trajectory of shape (K, 3)
+            matrix_size (np.ndarray): the gridding matrix size.
+            kernel_width (float): kernel width in overgridded grid units.
+            squared_distances (sps.csr_matrix): squared distances in overgridded
+                grid units.
+        """
+        self.traj = traj
+        self.matrix_size = np.asarray(matrix_size)
+        self.kernel_width = kernel_width
+        self.squared_distances = squared_distances
+
+    def nbytes(self) -> int:
+        """Return the memory used by the squared distances in bytes."""
+        return (
+            self.squared_distances.data.nbytes
+            + self.squared_distances.indices.nbytes
+            + self.squared_distances.indptr.nbytes
+        )
+
+    def covers(self, matrix_size: np.ndarray, kernel_width: float) -> bool:
+        """Check if the neighborhood can be used for a gridding matrix and kernel."""
+        return (
+            np.array_equal(self.matrix_size, matrix_size)
+            and kernel_width <= self.kernel_width
+        )
+
+
+class NeighborhoodCache(object):
+    """In-memory cache of neighborhoods keyed by the trajectory.
+
+    A requested trajectory is served from a cached neighborhood if it is equal to
+    the cached trajectory or a subset of its rows, and if the kernel is not wider
+    than the cached one. The last evaluated kernel matrices are cached too.
+
+    Attributes:
+        kernel_extent (float): minimum kernel extent in pre-overgridded k-space
+            voxels to search neighbors for. Setting it to the widest kernel used on
+            a trajectory lets the narrower kernels reuse the same neighborhood.
+        max_entries (int): maximum number of cached neighborhoods.
+        max_matrices (int): maximum number of cached kernel matrices.
+        neighborhoods (list): cached neighborhoods, most recently used last.
+        matrices (list): cached tuples of trajectory, kernel key and kernel matrix,
+            most recently used last.
+    """
+
+    def __init__(
+        self, kernel_extent: float = 0.0, max_entries: int = 1, max_matrices: int = 2
+    ):
+        """Initialize the cache.
+
+        Args:
+            kernel_extent (float): minimum kernel extent to search neighbors for.
+            max_entries (int): maximum number of cached neighborhoods.
+            max_matrices (int): maximum number of cached kernel matrices.
+        """
+        self.kernel_extent = kernel_extent
+        self.max_entries = max_entries
+        self.max_matrices = max_matrices
+        self.neighborhoods: List[Neighborhood] = []
+        self.matrices: List[Tuple[np.ndarray, str, sps.csr_matrix]] = []
+
+    def clear(self):
+        """Remove all cached neighborhoods and kernel matrices."""
+        self.neighborhoods = []
+        self.matrices = []
+
+    def _lookup(
+        self, traj: np.ndarray, matrix_size: np.ndarray, kernel_width: float
+    ) -> Tuple[Optional[Neighborhood], Optional[np.ndarray]]:
+        """Get the cached neighborhood of traj and the rows of traj in it."""
+        for neighborhood in reversed(self.neighborhoods):
+            if not neighborhood.covers(matrix_size, kernel_width):
+                continue
+            if np.array_equal(neighborhood.traj, traj):
+                rows = None
+            else:
+                rows = find_rows(neighborhood.traj, traj)
+                if rows is None:
+                    continue
+            self.neighborhoods.remove(neighborhood)
+            self.neighborhoods.append(neighborhood)
+            if rows is None:
+                logging.info("Reusing cached neighborhood.")
+            else:
+                logging.info("Reusing rows of cached neighborhood.")
+            return neighborhood, rows
+        return None, None
+
+    def get(
+        self,
+        proximity_obj: proximity.L2Proximity,
+        traj: np.ndarray,
+        overgrid_factor: float,
+        matrix_size: np.ndarray,
+    ) -> Tuple[sps.csr_matrix, Optional[np.ndarray]]:
+        """Get the squared sample-voxel distances of a trajectory.
+
+        Args:
+            proximity_obj (L2Proximity): proximity object used for the search.
+            traj (np.ndarray): trajectory of shape (K, 3)
+            overgrid_factor (float): overgridding factor.
+            matrix_size (np.ndarray): the gridding matrix size.
+
+        Returns:
+            Tuple of the squared distances in overgridded grid units and the rows
+                of traj in them, None if all rows belong to traj. The squared
+                distances may hold neighbors outside of the kernel of proximity_obj.
+        """
+        kernel_width = overgrid_factor * proximity_obj.kernel_obj.extent
+        neighborhood, rows = self._lookup(traj, matrix_size, kernel_width)
+        if neighborhood is not None:
+            return neighborhood.squared_distances, rows
+
+        # evict before the search to bound the peak memory
+        while self.neighborhoods and len(self.neighborhoods) >= self.max_entries:
+            self.neighborhoods.pop(0)
+        kernel_width = max(kernel_width, overgrid_factor * self.kernel_extent)
+        squared_distances = proximity_obj.squared_distances_csr(
+            traj=traj, kernel_width=kernel_width, matrix_size=matrix_size
+        )
+        self.neighborhoods.append(
+            Neighborhood(
+                traj=np.array(traj, copy=True),
+                matrix_size=matrix_size,
+                kernel_width=kernel_width,
+                squared_distances=squared_distances,
+            )
+        )
+        return squared_distances, None
+
+    def evaluate(
+        self,
+        proximity_obj: proximity.L2Proximity,
+        traj: np.ndarray,
+        overgrid_factor: float,
+        matrix_size: np.ndarray,
+        dtype: np.dtype = np.float64,
+    ) -> sps.csr_matrix:
+        """Get the kernel matrix of a trajectory.
+
+        A matrix evaluated before for the same trajectory, kernel and precision is
+        returned as is. Otherwise the kernel is evaluated over the cached squared
+        distances. The returned matrix must not be modified in place.
+
+        Args:
+            proximity_obj (L2Proximity): proximity object of the kernel.
+            traj (np.ndarray): trajectory of shape (K, 3)
+            overgrid_factor (float): overgridding factor.
+            matrix_size (np.ndarray): the gridding matrix size.
+            dtype (np.dtype): precision of the kernel values.
+
+        Returns:
+            sps.csr_matrix: sparse matrix of kernel values of shape
+                (K, prod(matrix_size)).
+        """
+        key = "_".join(
+            [
+                proximity_obj.unique_string,
+                str(overgrid_factor),
+                str(np.asarray(matrix_size).tolist()),
+                np.dtype(dtype).str,
+            ]
+        )
+        for i in reversed(range(len(self.matrices))):
+            if self.matrices[i][1] == key and np.array_equal(self.matrices[i][0], traj):
+                self.matrices.append(self.matrices.pop(i))
+                logging.info("Reusing cached kernel matrix.")
+                return self.matrices[-1][2]
+
+        squared_distances, rows = self.get(
+            proximity_obj=proximity_obj,
+            traj=traj,
+            overgrid_factor=overgrid_factor,
+            matrix_size=matrix_size,
+        )
+        matrix = proximity_obj.evaluate_squared_distances(
+            squared_distances=squared_distances,
+            overgrid_factor=overgrid_factor,
+            dtype=dtype,
+            rows=rows,
+        )
+        while self.matrices and len(self.matrices) >= self.max_matrices:
+            self.matrices.pop(0)
+        if self.max_matrices > 0:
+            self.matrices.append((np.array(traj, copy=True), key, matrix))
+        return matrix
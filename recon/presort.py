@@ -0,0 +1,100 @@
+"""Presort k-space samples along a space-filling curve.
+
+Radial spokes are acquired in the order of the Halton spiral, so consecutive samples
+touch grid voxels far apart. Sorting the samples along a Morton (Z-order) curve over
+the overgridded grid keeps consecutive rows of the system matrix, and consecutive
+columns of its transpose, on nearby voxels, which keeps the neighbor search and the
+sparse matrix products within the cache.
+"""
+
+import numpy as np
+
+# bits per axis of the Morton code, 3 * 21 bits fit in an unsigned 64 bit integer
+_MORTON_BITS = 21
+
+
+def _spread_bits(x: np.ndarray) -> np.ndarray:
+    """Insert two zero bits between each of the lowest 21 bits of an integer.
+
+    Args:
+        x (np.ndarray): non-negative integers.
+
+    Returns:
+        np.ndarray: spread integers of type uint64.
+    """
+    x = x.astype(np.uint64) & 0x1FFFFF
+    x = (x | x << 32) & 0x1F00000000FFFF
+    x = (x | x << 16) & 0x1F0000FF0000FF
+    x = (x | x << 8) & 0x100F00F00F00F00F
+    x = (x | x << 4) & 0x10C30C30C30C30C3
+    x = (x | x << 2) & 0x1249249249249249
+    return x
+
+
+def morton_code(traj: np.ndarray, full_size: np.ndarray) -> np.ndarray:
+    """Get the Morton code of the grid voxel of each sample.
+
+    The first trajectory column, which indexes the grid voxels fastest, takes the
+    lowest bit of each triplet of the code.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (K, 3) within [-0.5, 0.5].
+        full_size (np.ndarray): size of the overgridded grid of shape (3,).
+
+    Returns:
+        np.ndarray: Morton codes of shape (K,) of type uint64.
+    """
+    full_size = np.asarray(full_size, dtype=np.float64)
+    voxels = np.floor(traj * full_size + full_size / 2)
+    voxels = np.clip(voxels, 0, np.minimum(full_size, 2**_MORTON_BITS) - 1)
+    return (
+        _spread_bits(voxels[:, 0])
+        | _spread_bits(voxels[:, 1]) << 1
+        | _spread_bits(voxels[:, 2]) << 2
+    )
+
+
+def inverse_permutation(order: np.ndarray) -> np.ndarray:
+    """Get the permutation that maps sorted samples back to their original order.
+
+    Args:
+        order (np.ndarray): permutation of shape (K,).
+
+    Returns:
+        np.ndarray: inverse permutation of shape (K,).
+    """
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(order.shape[0], dtype=order.dtype)
+    return inverse
+
+
+class SamplePresort(object):
+    """Permutation of the samples along the Morton curve of the grid.
+
+    Gridding sums over the samples, so the gridded image does not depend on their
+    order as long as the data, trajectory and per-sample weights are permuted alike.
+    The system matrix built from the sorted trajectory has sorted rows, and its
+    transpose sorted columns, so both products write to nearby memory.
+
+    Attributes:
+        order (np.ndarray): sample indices in the order of the Morton curve.
+        inverse (np.ndarray): position of each original sample in the sorted order.
+    """
+
+    def __init__(self, traj: np.ndarray, full_size: np.ndarray):
+        """Initialize the permutation of the samples.
+
+        Args:
+            traj (np.ndarray): trajectory of shape (K, 3)
+            full_size (np.ndarray): size of the overgridded grid of shape (3,).
+        """
+        self.order = np.argsort(morton_code(traj, full_size), kind="stable")
+        self.inverse = inverse_permutation(self.order)
+
+    def sort(self, x: np.ndarray) -> np.ndarray:
+        """Permute per-sample values of shape (K, ...) into the sorted order."""
+        return x[self.order]
+
+    def unsort(self, x: np.ndarray) -> np.ndarray:
+        """Map sorted per-sample values of shape (K, ...) back to the original order."""
+        return x[self.inverse]
@@ -3,9 +3,11 @@
 import logging
 import sys
 from abc import ABC, abstractmethod
-from typing import Tuple
+from typing import Optional, Tuple
 
+import numba
 import numpy as np
+import scipy.sparse as sps
 
 sys.path.append("..")
 from recon import kernel, sparse_gridding_distance
@@ -54,13 +56,13 @@ class Proximity(ABC):
 
     @abstractmethod
     def evaluate(
-        self, traj: np.ndarray, overgrid_factor: int, matrix_size: np.ndarray
+        self, traj: np.ndarray, overgrid_factor: float, matrix_size: np.ndarray
     ) -> Tuple[np.ndarray, ...]:
         """Evaluate kernel function.
 
         Args:
             traj (np.ndarray): trajectory of shape (K, 3).
-            overgrid_factor (int): overgridding factor. typically 3.
+            overgrid_factor (float): overgridding factor. typically 3.
             matrix_size (np.ndarray): the gridding matrix size. This will be the
                 reconstruction matrix size times the overgrid factor.
         """
@@ -73,26 +75,37 @@ class L2Proximity(Proximity):
     Also known as  the Euclidean/pythagorean distance.
     Attributes:
         unique_string (str): unique string describing class
+        n_threads (int): number of threads used for the 3D distance calculation.
+            0 uses all available threads.
     """
 
-    def __init__(self, kernel_obj: kernel.Kernel, verbosity: bool):
+    def __init__(self, kernel_obj: kernel.Kernel, verbosity: bool, n_threads: int = 0):
         """Initialize the L2 proximity class.
 
         Args:
             kernel_obj (kernel.Kernel): A kernel object for evaluating the kernel
             verbosity (bool): Log output messages.
+            n_threads (int): number of threads used for the 3D distance calculation.
+                0 uses all available threads.
         """
         super().__init__(kernel_obj=kernel_obj, verbosity=verbosity)
         self.unique_string = "L2_" + self.kernel_obj.unique_string
+        self.n_threads = n_threads
+
+    def get_n_threads(self) -> int:
+        """Get the number of threads to use, bounded by the numba thread pool."""
+        if self.n_threads > 0:
+            return min(self.n_threads, numba.config.NUMBA_NUM_THREADS)
+        return numba.config.NUMBA_NUM_THREADS
 
     def evaluate(
-        self, traj: np.ndarray, overgrid_factor: int, matrix_size: np.ndarray
+        self, traj: np.ndarray, overgrid_factor: float, matrix_size: np.ndarray
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """Perform sparse gridding.
 
         Args:
             traj (np.ndarray): trajectory of shape (K, n_dims)
-            overgrid_factor (int): overgridding factor. typically 3
+            overgrid_factor (float): overgridding factor. typically 3
             matrix_size (np.ndarray): the gridding matrix size. This will be the
                 reconstruction matrix size times the overgrid factor. Of shape (N,N,N)
 
@@ -106,22 +119,44 @@ class L2Proximity(Proximity):
 
         n_points, n_dims = traj.shape[0], traj.shape[1]
         kernel_width = overgrid_factor * self.kernel_obj.extent
-        (
-            sample_idx,
-            voxel_idx,
-            pre_overgrid_distances,
-        ) = sparse_gridding_distance.sparse_gridding_distance(
-            coords=traj.flatten(),
-            kernel_width=kernel_width,
-            n_points=n_points,
-            n_dims=n_dims,
-            output_dims=matrix_size,
-            n_nonsparse_entries=np.array([0]).astype(int),
-            max_size=_get_n_nonsparse_entries(
-                n_points=n_points, kernel_width=kernel_width, n_dims=n_dims
-            ),
-            force_dim=-1,
-        )
+        if n_dims == 3:
+            squared_distances = self.squared_distances_csr(
+                traj=traj, kernel_width=kernel_width, matrix_size=matrix_size
+            ).tocoo()
+            sample_idx = squared_distances.row.astype(np.int64) + 1
+            voxel_idx = squared_distances.col.astype(np.int64) + 1
+            pre_overgrid_distances = np.sqrt(squared_distances.data)
+        elif n_dims == 2:
+            (
+                sample_idx,
+                voxel_idx,
+                pre_overgrid_distances,
+            ) = sparse_gridding_distance.sparse_gridding_distance_2d(
+                coords=traj.flatten(),
+                kernel_width=kernel_width,
+                n_points=n_points,
+                output_dims=matrix_size,
+                max_size=_get_n_nonsparse_entries(
+                    n_points=n_points, kernel_width=kernel_width, n_dims=n_dims
+                ),
+            )
+        else:
+            (
+                sample_idx,
+                voxel_idx,
+                pre_overgrid_distances,
+            ) = sparse_gridding_distance.sparse_gridding_distance(
+                coords=traj.flatten(),
+                kernel_width=kernel_width,
+                n_points=n_points,
+                n_dims=n_dims,
+                output_dims=matrix_size,
+                n_nonsparse_entries=np.array([0]).astype(int),
+                max_size=_get_n_nonsparse_entries(
+                    n_points=n_points, kernel_width=kernel_width, n_dims=n_dims
+                ),
+                force_dim=-1,
+            )
         pre_overgrid_distances = pre_overgrid_distances / overgrid_factor
         if self.verbosity:
             logging.info("Finished Calculating L2 distances.")
@@ -137,3 +172,201 @@ class L2Proximity(Proximity):
         kernel_vals = self.kernel_obj.evaluate(pre_overgrid_distances)
 
         return sample_idx, voxel_idx, kernel_vals
+
+    def _neighbors_csr(
+        self,
+        traj: np.ndarray,
+        kernel_width: float,
+        matrix_size: np.ndarray,
+        dtype: np.dtype,
+        lut: np.ndarray,
+        lut_scale: float,
+    ) -> sps.csr_matrix:
+        """Find the grid neighbors of each sample and store them in a CSR matrix.
+
+        The number of neighbors of every sample is counted first so that the CSR
+        arrays are allocated once at their exact size, and the squared distances or
+        kernel values are then written straight into the CSR value array. The
+        column indices are int32.
+
+        Args:
+            traj (np.ndarray): trajectory of shape (K, 3)
+            kernel_width (float): kernel width in overgridded grid units.
+            matrix_size (np.ndarray): the gridding matrix size.
+            dtype (np.dtype): precision of the values.
+            lut (np.ndarray): kernel lookup table, see kernel_lut. If empty, the
+                squared distances are stored.
+            lut_scale (float): conversion from squared distance in overgridded grid
+                units to lookup table position.
+
+        Returns:
+            sps.csr_matrix: sparse matrix of squared distances in overgridded grid
+                units or of kernel values.
+        """
+        assert traj.ndim == 2 and traj.shape[1] == 3, "Trajectory must be of shape (K, 3)"
+
+        if self.verbosity:
+            logging.info("Calculating L2 distances ...")
+        numba.set_num_threads(self.get_n_threads())
+        n_points = traj.shape[0]
+        coords = np.ascontiguousarray(traj, dtype=np.float64).flatten()
+        counts = sparse_gridding_distance.count_neighbors_3d(
+            coords, kernel_width, n_points, matrix_size
+        )
+        n_nonsparse = int(np.sum(counts))
+        index_dtype = np.int32 if n_nonsparse < np.iinfo(np.int32).max else np.int64
+        indptr = np.zeros(n_points + 1, dtype=index_dtype)
+        np.cumsum(counts, out=indptr[1:])
+        del counts
+        indices = np.empty(n_nonsparse, dtype=np.int32)
+        values = np.empty(n_nonsparse, dtype=dtype)
+        sparse_gridding_distance.sparse_gridding_distance_csr(
+            coords,
+            kernel_width,
+            n_points,
+            matrix_size,
+            indptr,
+            indices,
+            values,
+            lut,
+            lut_scale,
+        )
+        if self.verbosity:
+            logging.info("Finished Calculating L2 distances.")
+        return sps.csr_matrix(
+            (values, indices, indptr),
+            shape=(n_points, int(np.prod(matrix_size))),
+            copy=False,
+        )
+
+    def kernel_lut(self, overgrid_factor: float) -> Tuple[np.ndarray, float]:
+        """Get the kernel lookup table.
+
+        Args:
+            overgrid_factor (float): overgridding factor.
+
+        Returns:
+            Tuple of the lookup table and the conversion from squared distance in
+                overgridded grid units to table position.
+        """
+        lut, step = self.kernel_obj.radial_profile()
+        return lut, 1.0 / (step * overgrid_factor**2)
+
+    def evaluate_csr(
+        self,
+        traj: np.ndarray,
+        overgrid_factor: float,
+        matrix_size: np.ndarray,
+        dtype: np.dtype = np.float64,
+    ) -> sps.csr_matrix:
+        """Perform sparse gridding directly into a CSR matrix.
+
+        The kernel is interpolated from a lookup table in the neighbor search, so
+        the distances are never stored.
+
+        Args:
+            traj (np.ndarray): trajectory of shape (K, 3)
+            overgrid_factor (float): overgridding factor. typically 3
+            matrix_size (np.ndarray): the gridding matrix size. This will be the
+                reconstruction matrix size times the overgrid factor. Of shape (N,N,N)
+            dtype (np.dtype): precision of the kernel values.
+
+        Returns:
+            sps.csr_matrix: sparse matrix of kernel values of shape (K, N*N*N).
+        """
+        lut, lut_scale = self.kernel_lut(overgrid_factor)
+        return self._neighbors_csr(
+            traj=traj,
+            kernel_width=overgrid_factor * self.kernel_obj.extent,
+            matrix_size=matrix_size,
+            dtype=dtype,
+            lut=lut,
+            lut_scale=lut_scale,
+        )
+
+    def squared_distances_csr(
+        self, traj: np.ndarray, kernel_width: float, matrix_size: np.ndarray
+    ) -> sps.csr_matrix:
+        """Calculate the squared sample-voxel distances within a kernel width.
+
+        Args:
+            traj (np.ndarray): trajectory of shape (K, 3)
+            kernel_width (float): kernel width in overgridded grid units.
+            matrix_size (np.ndarray): the gridding matrix size.
+
+        Returns:
+            sps.csr_matrix: squared distances in overgridded grid units.
+        """
+        return self._neighbors_csr(
+            traj=traj,
+            kernel_width=kernel_width,
+            matrix_size=matrix_size,
+            dtype=np.float64,
+            lut=np.zeros(0),
+            lut_scale=0.0,
+        )
+
+    def evaluate_squared_distances(
+        self,
+        squared_distances: sps.csr_matrix,
+        overgrid_factor: float,
+        dtype: np.dtype = np.float64,
+        rows: Optional[np.ndarray] = None,
+    ) -> sps.csr_matrix:
+        """Evaluate the kernel over precomputed squared distances.
+
+        Entries outside of the kernel of this proximity object are removed, so the
+        squared distances may have been computed for a wider kernel. The result
+        shares its index arrays with squared_distances if all rows are evaluated
+        and nothing is removed.
+
+        Args:
+            squared_distances (sps.csr_matrix): squared distances in overgridded
+                grid units, see squared_distances_csr.
+            overgrid_factor (float): overgridding factor.
+            dtype (np.dtype): precision of the kernel values.
+            rows (np.ndarray): optional rows of squared_distances to evaluate, e.g.
+                the samples of a subset of the trajectory. None evaluates all rows.
+
+        Returns:
+            sps.csr_matrix: sparse matrix of kernel values.
+        """
+        kernel_halfwidth_sqr = (overgrid_factor * self.kernel_obj.extent * 0.5) ** 2
+        indptr, indices = squared_distances.indptr, squared_distances.indices
+        dist_sq = squared_distances.data
+        if self.verbosity:
+            logging.info("Applying kernel ...")
+        numba.set_num_threads(self.get_n_threads())
+        lut, lut_scale = self.kernel_lut(overgrid_factor)
+        if rows is None and (
+            dist_sq.shape[0] == 0 or np.max(dist_sq) <= kernel_halfwidth_sqr
+        ):
+            values = np.empty(dist_sq.shape[0], dtype=dtype)
+            sparse_gridding_distance.lookup_kernel(dist_sq, lut, lut_scale, values)
+            return sps.csr_matrix(
+                (values, indices, indptr), shape=squared_distances.shape, copy=False
+            )
+        if rows is None:
+            rows = np.arange(squared_distances.shape[0])
+        new_indptr = sparse_gridding_distance.count_csr_rows(
+            indptr, dist_sq, rows, kernel_halfwidth_sqr
+        )
+        new_indices = np.empty(new_indptr[-1], dtype=indices.dtype)
+        values = np.empty(new_indptr[-1], dtype=dtype)
+        sparse_gridding_distance.lookup_kernel_rows(
+            indptr,
+            indices,
+            dist_sq,
+            rows,
+            kernel_halfwidth_sqr,
+            lut,
+            lut_scale,
+            new_indptr,
+            new_indices,
+            values,
+        )
+        return sps.csr_matrix(
+            (values, new_indices, new_indptr),
+            shape=(rows.shape[0], squared_distances.shape[1]),
+            copy=False,
+        )
@@ -8,28 +8,35 @@ import numpy as np
 
 sys.path.append("..")
 
-from recon import dcf, system_model
-from utils import constants
+from recon import dcf, system_model, toeplitz, wavelet
+from utils import constants, fft_utils
 
 
 class GriddedReconModel(ABC):
     """Reconstruction model after gridding.
 
     Attributes:
-        system_obj (MatrixSystemModel): A subclass of the SystemModel
+        system_obj (SystemModel): A subclass of the SystemModel
         verbosity (int): either 0 or 1 whether to log output messages
         crop (bool): crop image if used overgridding
         deapodize (bool): use deapodization
     """
 
-    def __init__(self, system_obj: system_model.MatrixSystemModel, verbosity: int):
+    def __init__(
+        self,
+        system_obj: system_model.SystemModel,
+        verbosity: int,
+        deapodize: bool = False,
+    ):
         """Initialize Gridded Reconstruction model.
 
         Args:
-            system_obj (MatrixSystemModel): A subclass of the SystemModel
+            system_obj (SystemModel): A subclass of the SystemModel
             verbosity (int): either 0 or 1 whether to log output messages
+            deapodize (bool): divide the image by the Fourier transform of the
+                gridding kernel
         """
-        self.deapodize = False
+        self.deapodize = deapodize
         self.crop = True
         self.verbosity = verbosity
         self.system_obj = system_obj
@@ -46,18 +53,23 @@ class LSQgridded(GriddedReconModel):
 
     def __init__(
         self,
-        system_obj: system_model.MatrixSystemModel,
+        system_obj: system_model.SystemModel,
         dcf_obj: dcf.DCF,
         verbosity: int,
+        deapodize: bool = False,
     ):
         """Initialize the LSQ gridding model.
 
         Args:
-            system_obj (MatrixSystemModel): A subclass of the System Object
+            system_obj (SystemModel): A subclass of the System Object
             dcf_obj (IterativeDCF): A density compensation function object
             verbosity (int): either 0 or 1 whether to log output messages
+            deapodize (bool): divide the image by the Fourier transform of the
+                gridding kernel
         """
-        super().__init__(system_obj=system_obj, verbosity=verbosity)
+        super().__init__(
+            system_obj=system_obj, verbosity=verbosity, deapodize=deapodize
+        )
         self.dcf_obj = dcf_obj
         self.unique_string = (
             "grid_" + system_obj.unique_string + "_" + dcf_obj.unique_string
@@ -66,20 +78,25 @@ class LSQgridded(GriddedReconModel):
     def grid(self, data: np.ndarray) -> np.ndarray:
         """Grid data.
 
-        Currently supports only MatrixSystemModel
+        All columns of data are gridded with a single sparse matrix product.
+
         Args:
-            data (np.ndarray): complex kspace data of shape (K, 1)
+            data (np.ndarray): complex kspace data of shape (K, n_images)
 
         Raises:
             Exception: DCF string not recognized
 
         Returns:
-            np.ndarray: gridded data.
+            np.ndarray: gridded data of shape (prod(full_size), n_images).
         """
         if self.dcf_obj.space == constants.DCFSpace.GRIDSPACE:
-            gridVol = np.multiply(self.system_obj.ATrans.dot(data), self.dcf_obj.dcf)
+            gridVol = np.multiply(
+                self.system_obj.multiply_transpose(data), self.dcf_obj.dcf
+            )
         elif self.dcf_obj.space == constants.DCFSpace.DATASPACE:
-            gridVol = self.system_obj.ATrans.dot(np.multiply(self.dcf_obj.dcf, data))
+            gridVol = self.system_obj.multiply_transpose(
+                np.multiply(self.dcf_obj.dcf, data)
+            )
         else:
             raise Exception("DCF space type not recognized")
         return gridVol
@@ -88,12 +105,15 @@ class LSQgridded(GriddedReconModel):
         """Reconstruct the image given the kspace data and trajectory.
 
         Args:
-            data (np.ndarray): kspace data of shape (K, 1)
+            data (np.ndarray): kspace data of shape (K, 1), or of shape (K, n_images)
+                to reconstruct several images on the same trajectory at once.
             traj (np.ndarray): trajectories of shape (K, 3)
 
         Returns:
-            np.ndarray: reconstructed image volume (complex datatype)
+            np.ndarray: reconstructed image volume (complex datatype) of shape
+                (N, N, N) for a single image, or (N, N, N, n_images).
         """
+        n_images = data.shape[1] if data.ndim == 2 else 1
         if self.verbosity:
             logging.info("Reconstructing ...")
             logging.info("-- Gridding Data ...")
@@ -101,12 +121,15 @@ class LSQgridded(GriddedReconModel):
         reconVol = self.grid(data)
         if self.verbosity:
             logging.info("-- Finished Gridding.")
-        reconVol = np.reshape(reconVol, np.ceil(self.system_obj.full_size).astype(int))
+        reconVol = np.reshape(
+            reconVol,
+            tuple(np.ceil(self.system_obj.full_size).astype(int)) + (n_images,),
+        )
         if self.verbosity:
             logging.info("-- Calculating IFFT ...")
         time_start = time.time()
         # reconVol = np.fft.fftshift(np.fft.ifftn(reconVol))
-        reconVol = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(reconVol)))
+        reconVol = fft_utils.ifftn_centered(reconVol, axes=(0, 1, 2), overwrite_x=True)
         time_end = time.time()
         logging.info("The runtime for iFFT: " + str(time_end - time_start))
         if self.verbosity:
@@ -114,23 +137,142 @@ class LSQgridded(GriddedReconModel):
         if self.crop:
             reconVol = self.system_obj.crop(reconVol)
         if self.deapodize:
-            if self.verbosity:
-                logging.info("-- Calculating k-space deapodization function")
-            deapVol = self.grid(
-                np.expand_dims((~np.any(traj > 0, axis=1)).astype(np.float32), -1)
-            )
-            deapVol = np.reshape(
-                deapVol, np.ceil(self.system_obj.full_size).astype(int)
-            )
             if self.verbosity:
                 logging.info("-- Calculating image-space deapodization function")
-            deapVol = np.fft.ifftn(deapVol)
-            deapVol = np.fft.ifftshift(deapVol)
-            if self.crop:
-                deapVol = self.system_obj.crop(deapVol)
-            reconVol = np.divide(reconVol, deapVol)
+            reconVol = np.divide(
+                reconVol, self.system_obj.deapodization()[..., np.newaxis]
+            )
             if self.verbosity:
                 logging.info("-- Finished deapodization.")
         if self.verbosity:
             logging.info("-- Finished Reconstruction.")
-        return reconVol
+        return reconVol[..., 0] if n_images == 1 else reconVol
+
+
+class ToeplitzCSRecon(GriddedReconModel):
+    """Compressed sensing reconstruction with a Toeplitz normal operator.
+
+    Minimizes 1/2 ||W^(1/2) (A x - y)||^2 + lambda ||Psi x||_1 with FISTA, where W
+    is the dcf and Psi is an orthonormal Haar wavelet transform. The normal
+    operator A^H W A is applied by a convolution with the point spread function on a
+    twice as large grid, so each iteration costs two FFTs and no gridding. The
+    iterations start from the deapodized LSQ gridding image.
+
+    Attributes:
+        dcf_obj (IterativeDCF): A density compensation function object.
+        n_iterations (int): number of FISTA iterations.
+        reg_lambda (float): wavelet threshold relative to the maximum of the
+            gridded image. 0 solves the weighted least squares problem.
+        wavelet_levels (int): number of wavelet levels.
+        unique_string (str): A unique string defining this class
+    """
+
+    def __init__(
+        self,
+        system_obj: system_model.SystemModel,
+        dcf_obj: dcf.DCF,
+        verbosity: int,
+        n_iterations: int = 20,
+        reg_lambda: float = 0.0,
+        wavelet_levels: int = 3,
+    ):
+        """Initialize the compressed sensing reconstruction model.
+
+        Args:
+            system_obj (SystemModel): A subclass of the System Object
+            dcf_obj (IterativeDCF): A density compensation function object
+            verbosity (int): either 0 or 1 whether to log output messages
+            n_iterations (int): number of FISTA iterations.
+            reg_lambda (float): wavelet threshold relative to the maximum of the
+                gridded image.
+            wavelet_levels (int): number of wavelet levels.
+        """
+        super().__init__(system_obj=system_obj, verbosity=verbosity, deapodize=True)
+        self.dcf_obj = dcf_obj
+        self.n_iterations = n_iterations
+        self.reg_lambda = reg_lambda
+        self.wavelet_levels = wavelet_levels
+        self.unique_string = (
+            "cs_" + system_obj.unique_string + "_" + dcf_obj.unique_string
+        )
+
+    def _fista(
+        self, normal_obj: toeplitz.ToeplitzOperator, gridded: np.ndarray
+    ) -> np.ndarray:
+        """Run the FISTA iterations of one image.
+
+        Args:
+            normal_obj (ToeplitzOperator): normal operator A^H W A.
+            gridded (np.ndarray): A^H W y, the deapodized gridded image.
+
+        Returns:
+            np.ndarray: reconstructed image.
+        """
+        # scale the gridded image to the least squares solution along it
+        normal_gridded = normal_obj.multiply(gridded)
+        scale = np.vdot(normal_gridded, gridded).real
+        image = gridded * (np.vdot(gridded, gridded).real / scale if scale else 0.0)
+        step = 1.0 / normal_obj.lipschitz()
+        threshold = self.reg_lambda * np.max(np.abs(image))
+        # fixed seed so that the reconstruction is reproducible
+        rng = np.random.default_rng(0)
+        momentum_image = image
+        t = 1.0
+        for kk in range(self.n_iterations):
+            if self.verbosity:
+                logging.info(" FISTA iteration " + str(kk + 1))
+            gradient = normal_obj.multiply(momentum_image) - gridded
+            image_new = momentum_image - step * gradient
+            if threshold > 0:
+                image_new = wavelet.soft_threshold(
+                    image_new,
+                    threshold=threshold,
+                    levels=self.wavelet_levels,
+                    shift=rng.integers(0, 2**self.wavelet_levels, size=3),
+                )
+            t_new = 0.5 * (1 + np.sqrt(1 + 4 * t**2))
+            momentum_image = image_new + ((t - 1) / t_new) * (image_new - image)
+            image, t = image_new, t_new
+        return image
+
+    def reconstruct(self, data: np.ndarray, traj: np.ndarray) -> np.ndarray:
+        """Reconstruct the image given the kspace data and trajectory.
+
+        Args:
+            data (np.ndarray): kspace data of shape (K, 1), or of shape (K, n_images)
+                to reconstruct several images on the same trajectory at once.
+            traj (np.ndarray): trajectories of shape (K, 3)
+
+        Returns:
+            np.ndarray: reconstructed image volume (complex datatype) of shape
+                (N, N, N) for a single image, or (N, N, N, n_images).
+        """
+        data = data.reshape(data.shape[0], -1)
+        n_images = data.shape[1]
+        image_size = int(self.system_obj.crop_size[0])
+        if self.verbosity:
+            logging.info("Reconstructing ...")
+            logging.info("-- Gridding data and point spread function ...")
+        # grid the data and the point spread function blocks in one pass
+        gridding_obj = LSQgridded(
+            system_obj=self.system_obj,
+            dcf_obj=self.dcf_obj,
+            verbosity=0,
+            deapodize=True,
+        )
+        gridded = gridding_obj.reconstruct(
+            data=np.concatenate(
+                [data, toeplitz.psf_modulation(traj, image_size)], axis=1
+            ),
+            traj=traj,
+        )
+        normal_obj = toeplitz.ToeplitzOperator(psf_blocks=gridded[..., n_images:])
+        time_start = time.time()
+        reconVol = np.stack(
+            [self._fista(normal_obj, gridded[..., i]) for i in range(n_images)],
+            axis=-1,
+        )
+        logging.info("The runtime for FISTA: " + str(time.time() - time_start))
+        if self.verbosity:
+            logging.info("-- Finished Reconstruction.")
+        return reconVol[..., 0] if n_images == 1 else reconVol
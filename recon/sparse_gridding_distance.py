@@ -14,18 +14,24 @@ Background reading:
 This code is based off the code written by Scott Robertson.
     
     Source: https://github.com/ScottHaileRobertson/Non-Cartesian-Reconstruction
+
+The compiled kernels are cached on disk next to this module, or in NUMBA_CACHE_DIR
+if it is set, so that they are compiled once per install rather than once per
+process. See compile_kernels.py.
 """
 import logging
 import math
 from typing import Tuple
 
 import numpy as np
-from numba import njit
+from numba import njit, prange
 
 DEBUG = False
 DEBUG_GRID = False
 
 
+# the recursive kernels are not cached, numba crashes when loading cached recursive
+# functions. The 2D and 3D trajectories use the non-recursive variants instead.
 @njit
 def grid_point(
     sample_loc: np.ndarray,
@@ -271,3 +277,536 @@ def sparse_gridding_distance(
         )
 
     return nonsparse_sample_indices, nonsparse_voxel_indices, nonsparse_distances
+
+
+@njit(cache=True)
+def sparse_gridding_distance_2d(
+    coords: np.ndarray,
+    kernel_width: float,
+    n_points: int,
+    output_dims: np.ndarray,
+    max_size: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Perform 2D sparse gridding distance calculation.
+
+    Non-recursive 2D version of sparse_gridding_distance. The voxels of each sample
+    are visited in the same order (y, x) and the distances are accumulated in the
+    same order as in grid_point, so the output matches sparse_gridding_distance
+    exactly.
+
+    Args:
+        coords: Array of sample coordinates of shape (n_points * 2,).
+        kernel_width: Kernel width.
+        n_points: Number of sample points.
+        output_dims: Dimensions of output grid.
+        max_size: Maximum size of output arrays.
+
+    Returns:
+        nonsparse_sample_indices: Array of sample indices (1-based).
+        nonsparse_voxel_indices: Array of voxel indices (1-based).
+        nonsparse_distances: Array of distances.
+    """
+    kernel_halfwidth = kernel_width * 0.5
+    kernel_halfwidth_sqr = kernel_halfwidth**2
+    output_halfwidth = np.zeros(2)
+    for dim in range(2):
+        output_halfwidth[dim] = int(np.ceil(float(output_dims[dim] * 0.5)))
+    idx_convert_y = int(output_dims[0])
+
+    nonsparse_sample_indices = np.zeros(max_size)
+    nonsparse_voxel_indices = np.zeros(max_size)
+    nonsparse_distances = np.zeros(max_size)
+    sample_loc = np.zeros(2)
+    lower = np.zeros(2, dtype=np.int64)
+    upper = np.zeros(2, dtype=np.int64)
+    count = 0
+    for p in range(n_points):
+        for dim in range(2):
+            sample_loc[dim] = coords[2 * p + dim] * float(output_dims[dim]) + float(
+                output_halfwidth[dim]
+            )
+            lower[dim] = int(max(np.ceil(sample_loc[dim] - kernel_halfwidth), 0))
+            upper[dim] = int(
+                min(np.floor(sample_loc[dim] + kernel_halfwidth), output_dims[dim] - 1)
+            )
+        for j in range(lower[1], upper[1] + 1):
+            dist_y = float(j - sample_loc[1])
+            dist_sq_y = dist_y * dist_y + 0.0
+            for i in range(lower[0], upper[0] + 1):
+                dist_x = float(i - sample_loc[0])
+                dist_sq = dist_x * dist_x + dist_sq_y
+                if dist_sq <= kernel_halfwidth_sqr:
+                    nonsparse_sample_indices[count] = p + 1
+                    nonsparse_voxel_indices[count] = float(i + j * idx_convert_y + 1)
+                    nonsparse_distances[count] = math.sqrt(dist_sq)
+                    count += 1
+
+    return nonsparse_sample_indices, nonsparse_voxel_indices, nonsparse_distances
+
+
+@njit(cache=True)
+def _sample_neighbors_3d(
+    coords: np.ndarray,
+    p: int,
+    kernel_halfwidth: float,
+    output_dims: np.ndarray,
+    output_halfwidth: np.ndarray,
+    voxel_indices: np.ndarray,
+    distances: np.ndarray,
+    offset: int,
+    write: bool,
+    lut: np.ndarray,
+    lut_scale: float,
+) -> int:
+    """Find the grid voxels within the kernel halfwidth of a single sample point.
+
+    Args:
+        coords: Array of sample coordinates of shape (n_points * 3,).
+        p: Sample index.
+        kernel_halfwidth: Kernel halfwidth.
+        output_dims: Dimensions of output grid.
+        output_halfwidth: Halfwidth of the output grid.
+        voxel_indices: Output voxel indices (0-based).
+        distances: Output squared distances, or kernel values if lut is not empty.
+        offset: Position of the first neighbor of this sample in the outputs.
+        write: If False, only count the neighbors.
+        lut: Kernel lookup table sampled uniformly in squared distance. If empty,
+            the squared distances are written.
+        lut_scale: Conversion from squared distance to lookup table position.
+
+    Returns:
+        Number of neighbors of the sample point.
+    """
+    kernel_halfwidth_sqr = kernel_halfwidth**2
+    idx_convert_y = int(output_dims[0])
+    idx_convert_z = int(output_dims[0] * output_dims[1])
+    loc_x = coords[3 * p] * float(output_dims[0]) + float(output_halfwidth[0])
+    loc_y = coords[3 * p + 1] * float(output_dims[1]) + float(output_halfwidth[1])
+    loc_z = coords[3 * p + 2] * float(output_dims[2]) + float(output_halfwidth[2])
+    lower_x = int(max(np.ceil(loc_x - kernel_halfwidth), 0))
+    upper_x = int(min(np.floor(loc_x + kernel_halfwidth), output_dims[0] - 1))
+    lower_y = int(max(np.ceil(loc_y - kernel_halfwidth), 0))
+    upper_y = int(min(np.floor(loc_y + kernel_halfwidth), output_dims[1] - 1))
+    lower_z = int(max(np.ceil(loc_z - kernel_halfwidth), 0))
+    upper_z = int(min(np.floor(loc_z + kernel_halfwidth), output_dims[2] - 1))
+
+    count = 0
+    for k in range(lower_z, upper_z + 1):
+        dist_z = float(k - loc_z)
+        dist_sq_z = dist_z * dist_z + 0.0
+        for j in range(lower_y, upper_y + 1):
+            dist_y = float(j - loc_y)
+            dist_sq_y = dist_y * dist_y + dist_sq_z
+            for i in range(lower_x, upper_x + 1):
+                dist_x = float(i - loc_x)
+                dist_sq = dist_x * dist_x + dist_sq_y
+                if dist_sq <= kernel_halfwidth_sqr:
+                    if write:
+                        voxel_indices[offset + count] = (
+                            i + j * idx_convert_y + k * idx_convert_z
+                        )
+                        if lut.shape[0] == 0:
+                            distances[offset + count] = dist_sq
+                        else:
+                            distances[offset + count] = _interpolate_lut(
+                                lut, dist_sq * lut_scale
+                            )
+                    count += 1
+    return count
+
+
+@njit(parallel=True, cache=True)
+def count_neighbors_3d(
+    coords: np.ndarray,
+    kernel_width: float,
+    n_points: int,
+    output_dims: np.ndarray,
+) -> np.ndarray:
+    """Count the number of grid voxels within the kernel of each sample point.
+
+    Args:
+        coords: Array of sample coordinates of shape (n_points * 3,).
+        kernel_width: Kernel width.
+        n_points: Number of sample points.
+        output_dims: Dimensions of output grid.
+
+    Returns:
+        Array of shape (n_points,) with the number of neighbors of each sample.
+    """
+    output_halfwidth = np.zeros(3)
+    for dim in range(3):
+        output_halfwidth[dim] = int(np.ceil(float(output_dims[dim] * 0.5)))
+    dummy_indices = np.zeros(0, dtype=np.int32)
+    dummy_distances = np.zeros(0)
+    counts = np.zeros(n_points, dtype=np.int64)
+    for p in prange(n_points):
+        counts[p] = _sample_neighbors_3d(
+            coords,
+            p,
+            kernel_width * 0.5,
+            output_dims,
+            output_halfwidth,
+            dummy_indices,
+            dummy_distances,
+            0,
+            False,
+            dummy_distances,
+            0.0,
+        )
+    return counts
+
+
+@njit(parallel=True, cache=True)
+def sparse_gridding_distance_csr(
+    coords: np.ndarray,
+    kernel_width: float,
+    n_points: int,
+    output_dims: np.ndarray,
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    distances: np.ndarray,
+    lut: np.ndarray,
+    lut_scale: float,
+):
+    """Write the 3D sparse gridding distances or kernel values into CSR arrays.
+
+    The CSR row pointers must be computed beforehand from count_neighbors_3d, so
+    that every sample point writes its neighbors into its own row. Row i of the
+    resulting matrix holds the voxels within the kernel of sample i, sorted by
+    voxel index. If a kernel lookup table is given, the kernel is evaluated in the
+    same pass and the distances are never stored.
+
+    Args:
+        coords: Array of sample coordinates of shape (n_points * 3,).
+        kernel_width: Kernel width.
+        n_points: Number of sample points.
+        output_dims: Dimensions of output grid.
+        indptr: CSR row pointers of shape (n_points + 1,).
+        indices: CSR column (voxel) indices, filled in place.
+        distances: CSR values, filled in place with the squared distances or the
+            kernel values.
+        lut: Kernel lookup table sampled uniformly in squared distance. If empty,
+            the squared distances are written.
+        lut_scale: Conversion from squared distance to lookup table position.
+    """
+    output_halfwidth = np.zeros(3)
+    for dim in range(3):
+        output_halfwidth[dim] = int(np.ceil(float(output_dims[dim] * 0.5)))
+    for p in prange(n_points):
+        _sample_neighbors_3d(
+            coords,
+            p,
+            kernel_width * 0.5,
+            output_dims,
+            output_halfwidth,
+            indices,
+            distances,
+            indptr[p],
+            True,
+            lut,
+            lut_scale,
+        )
+
+
+@njit(cache=True)
+def _interpolate_lut(lut: np.ndarray, position: float) -> float:
+    """Linearly interpolate a lookup table at a fractional position.
+
+    Args:
+        lut: Lookup table.
+        position: Position in units of table entries. Clamped to the last entry.
+
+    Returns:
+        Interpolated value.
+    """
+    idx = int(position)
+    if idx >= lut.shape[0] - 1:
+        return lut[lut.shape[0] - 1]
+    frac = position - idx
+    return lut[idx] + frac * (lut[idx + 1] - lut[idx])
+
+
+@njit(parallel=True, cache=True)
+def lookup_kernel(
+    squared_distances: np.ndarray,
+    lut: np.ndarray,
+    lut_scale: float,
+    values: np.ndarray,
+):
+    """Evaluate a kernel lookup table at squared distances.
+
+    Args:
+        squared_distances: Squared distances.
+        lut: Kernel lookup table sampled uniformly in squared distance.
+        lut_scale: Conversion from squared distance to lookup table position.
+        values: Output kernel values, filled in place.
+    """
+    for n in prange(squared_distances.shape[0]):
+        values[n] = _interpolate_lut(lut, squared_distances[n] * lut_scale)
+
+
+@njit(parallel=True, cache=True)
+def count_csr_rows(
+    indptr: np.ndarray,
+    values: np.ndarray,
+    rows: np.ndarray,
+    max_value: float,
+) -> np.ndarray:
+    """Get the row pointers of selected rows of a CSR matrix, keeping small values.
+
+    Used with lookup_kernel_rows to restrict squared distances computed for a wide
+    kernel, or for a larger trajectory, to a narrower kernel or a subset of rows.
+
+    Args:
+        indptr: CSR row pointers.
+        values: CSR values.
+        rows: Rows to keep, in their order in the output.
+        max_value: Largest value to keep.
+
+    Returns:
+        Row pointers of the output matrix.
+    """
+    counts = np.zeros(rows.shape[0], dtype=indptr.dtype)
+    for row in prange(rows.shape[0]):
+        count = 0
+        for n in range(indptr[rows[row]], indptr[rows[row] + 1]):
+            if values[n] <= max_value:
+                count += 1
+        counts[row] = count
+    new_indptr = np.zeros(rows.shape[0] + 1, dtype=indptr.dtype)
+    new_indptr[1:] = np.cumsum(counts)
+    return new_indptr
+
+
+@njit(parallel=True, cache=True)
+def lookup_kernel_rows(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    squared_distances: np.ndarray,
+    rows: np.ndarray,
+    max_value: float,
+    lut: np.ndarray,
+    lut_scale: float,
+    new_indptr: np.ndarray,
+    new_indices: np.ndarray,
+    values: np.ndarray,
+):
+    """Evaluate a kernel lookup table at selected squared distances of a CSR matrix.
+
+    Args:
+        indptr: CSR row pointers of the squared distances.
+        indices: CSR column indices of the squared distances.
+        squared_distances: CSR values of the squared distances.
+        rows: Rows to keep, in their order in the output.
+        max_value: Largest squared distance to keep.
+        lut: Kernel lookup table sampled uniformly in squared distance.
+        lut_scale: Conversion from squared distance to lookup table position.
+        new_indptr: Output row pointers, see count_csr_rows.
+        new_indices: Output column indices, filled in place.
+        values: Output kernel values, filled in place.
+    """
+    for row in prange(rows.shape[0]):
+        dst = new_indptr[row]
+        for n in range(indptr[rows[row]], indptr[rows[row] + 1]):
+            if squared_distances[n] <= max_value:
+                new_indices[dst] = indices[n]
+                values[dst] = _interpolate_lut(lut, squared_distances[n] * lut_scale)
+                dst += 1
+
+
+@njit(cache=True)
+def _neighbor_window(
+    coords: np.ndarray,
+    p: int,
+    kernel_halfwidth: float,
+    output_dims: np.ndarray,
+    output_halfwidth: np.ndarray,
+    sample_loc: np.ndarray,
+    lower: np.ndarray,
+    upper: np.ndarray,
+):
+    """Get the grid location of a sample and the bounds of its kernel window.
+
+    Args:
+        coords: Array of sample coordinates of shape (n_points * 3,).
+        p: Sample index.
+        kernel_halfwidth: Kernel halfwidth.
+        output_dims: Dimensions of output grid.
+        output_halfwidth: Halfwidth of the output grid.
+        sample_loc: Output grid location of shape (3,).
+        lower: Output lowest voxel index of the window of shape (3,).
+        upper: Output highest voxel index of the window of shape (3,).
+    """
+    for dim in range(3):
+        sample_loc[dim] = coords[3 * p + dim] * float(output_dims[dim]) + float(
+            output_halfwidth[dim]
+        )
+        lower[dim] = int(max(np.ceil(sample_loc[dim] - kernel_halfwidth), 0))
+        upper[dim] = int(
+            min(np.floor(sample_loc[dim] + kernel_halfwidth), output_dims[dim] - 1)
+        )
+
+
+@njit(parallel=True, cache=True)
+def ungrid_3d(
+    coords: np.ndarray,
+    kernel_width: float,
+    n_points: int,
+    output_dims: np.ndarray,
+    lut: np.ndarray,
+    lut_scale: float,
+    grid: np.ndarray,
+    samples: np.ndarray,
+):
+    """Interpolate grid values at the sample points, computing the kernel on the fly.
+
+    Equivalent to multiplying the system matrix by the flattened grid.
+
+    Args:
+        coords: Array of sample coordinates of shape (n_points * 3,).
+        kernel_width: Kernel width.
+        n_points: Number of sample points.
+        output_dims: Dimensions of the grid.
+        lut: Kernel lookup table sampled uniformly in squared distance.
+        lut_scale: Conversion from squared distance to lookup table position.
+        grid: Flattened grid values of shape (prod(output_dims),).
+        samples: Output sample values of shape (n_points,), filled in place.
+    """
+    kernel_halfwidth = kernel_width * 0.5
+    kernel_halfwidth_sqr = kernel_halfwidth**2
+    idx_convert_y = int(output_dims[0])
+    idx_convert_z = int(output_dims[0] * output_dims[1])
+    output_halfwidth = np.zeros(3)
+    for dim in range(3):
+        output_halfwidth[dim] = int(np.ceil(float(output_dims[dim] * 0.5)))
+    for p in prange(n_points):
+        sample_loc = np.empty(3)
+        lower = np.empty(3, dtype=np.int64)
+        upper = np.empty(3, dtype=np.int64)
+        _neighbor_window(
+            coords,
+            p,
+            kernel_halfwidth,
+            output_dims,
+            output_halfwidth,
+            sample_loc,
+            lower,
+            upper,
+        )
+        samples[p] = 0
+        value = samples[p]
+        for k in range(lower[2], upper[2] + 1):
+            dist_z = float(k - sample_loc[2])
+            dist_sq_z = dist_z * dist_z + 0.0
+            for j in range(lower[1], upper[1] + 1):
+                dist_y = float(j - sample_loc[1])
+                dist_sq_y = dist_y * dist_y + dist_sq_z
+                for i in range(lower[0], upper[0] + 1):
+                    dist_x = float(i - sample_loc[0])
+                    dist_sq = dist_x * dist_x + dist_sq_y
+                    if dist_sq <= kernel_halfwidth_sqr:
+                        value += _interpolate_lut(lut, dist_sq * lut_scale) * grid[
+                            i + j * idx_convert_y + k * idx_convert_z
+                        ]
+        samples[p] = value
+
+
+def sort_into_slabs(
+    coords: np.ndarray, kernel_width: float, n_points: int, output_dims: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Sort sample points into slabs of the grid along the last dimension.
+
+    The slabs are thicker than the kernel width, so samples in slabs that are two
+    apart never touch the same voxel and can be gridded concurrently.
+
+    Args:
+        coords: Array of sample coordinates of shape (n_points * 3,).
+        kernel_width: Kernel width.
+        n_points: Number of sample points.
+        output_dims: Dimensions of the grid.
+
+    Returns:
+        Tuple of the sample indices sorted by slab and the position of the first
+            sample of each slab in the sorted indices, of shape (n_slabs + 1,).
+    """
+    slab_width = int(np.ceil(kernel_width)) + 1
+    n_slabs = int(np.ceil(output_dims[2] / slab_width))
+    loc_z = coords[2::3][:n_points] * float(output_dims[2]) + float(
+        np.ceil(output_dims[2] * 0.5)
+    )
+    slabs = np.clip(np.floor(loc_z / slab_width), 0, n_slabs - 1).astype(np.int64)
+    order = np.argsort(slabs, kind="stable")
+    slab_starts = np.searchsorted(slabs[order], np.arange(n_slabs + 1))
+    return order, slab_starts
+
+
+@njit(parallel=True, cache=True)
+def grid_3d(
+    coords: np.ndarray,
+    kernel_width: float,
+    output_dims: np.ndarray,
+    lut: np.ndarray,
+    lut_scale: float,
+    order: np.ndarray,
+    slab_starts: np.ndarray,
+    samples: np.ndarray,
+    grid: np.ndarray,
+):
+    """Spread sample values onto the grid, computing the kernel on the fly.
+
+    Equivalent to multiplying the transpose of the system matrix by the samples.
+    Even and odd slabs are processed in turn so that no two threads write to the
+    same voxel.
+
+    Args:
+        coords: Array of sample coordinates of shape (n_points * 3,).
+        kernel_width: Kernel width.
+        output_dims: Dimensions of the grid.
+        lut: Kernel lookup table sampled uniformly in squared distance.
+        lut_scale: Conversion from squared distance to lookup table position.
+        order: Sample indices sorted by slab, see sort_into_slabs.
+        slab_starts: Position of the first sample of each slab in order.
+        samples: Sample values of shape (n_points,).
+        grid: Output flattened grid of shape (prod(output_dims),), accumulated in
+            place.
+    """
+    kernel_halfwidth = kernel_width * 0.5
+    kernel_halfwidth_sqr = kernel_halfwidth**2
+    idx_convert_y = int(output_dims[0])
+    idx_convert_z = int(output_dims[0] * output_dims[1])
+    output_halfwidth = np.zeros(3)
+    for dim in range(3):
+        output_halfwidth[dim] = int(np.ceil(float(output_dims[dim] * 0.5)))
+    n_slabs = slab_starts.shape[0] - 1
+    for parity in range(2):
+        for s in prange((n_slabs - parity + 1) // 2):
+            slab = 2 * s + parity
+            sample_loc = np.empty(3)
+            lower = np.empty(3, dtype=np.int64)
+            upper = np.empty(3, dtype=np.int64)
+            for n in range(slab_starts[slab], slab_starts[slab + 1]):
+                p = order[n]
+                _neighbor_window(
+                    coords,
+                    p,
+                    kernel_halfwidth,
+                    output_dims,
+                    output_halfwidth,
+                    sample_loc,
+                    lower,
+                    upper,
+                )
+                value = samples[p]
+                for k in range(lower[2], upper[2] + 1):
+                    dist_z = float(k - sample_loc[2])
+                    dist_sq_z = dist_z * dist_z + 0.0
+                    for j in range(lower[1], upper[1] + 1):
+                        dist_y = float(j - sample_loc[1])
+                        dist_sq_y = dist_y * dist_y + dist_sq_z
+                        for i in range(lower[0], upper[0] + 1):
+                            dist_x = float(i - sample_loc[0])
+                            dist_sq = dist_x * dist_x + dist_sq_y
+                            if dist_sq <= kernel_halfwidth_sqr:
+                                grid[i + j * idx_convert_y + k * idx_convert_z] += (
+                                    _interpolate_lut(lut, dist_sq * lut_scale) * value
+                                )
@@ -3,12 +3,15 @@
 import logging
 import sys
 from abc import ABC, abstractmethod
+from typing import Optional, Tuple
 
+import numba
 import numpy as np
 import scipy.sparse as sps
 
 sys.path.append("..")
-from recon import proximity
+from recon import neighborhood, proximity, sparse_gridding_distance
+from utils import recon_utils
 
 
 class SystemModel(ABC):
@@ -17,14 +20,14 @@ class SystemModel(ABC):
     Attributes:
         verbosity (int): either 0 or 1 whether to log output messages
         proximity_obj (L2Proximity): a subclass that inherits from Proximity class.
-        overgrid_factor (int): overgridding factor
+        overgrid_factor (float): overgridding factor
         image_size (tuple): reconstructed image size.
     """
 
     def __init__(
         self,
         proximity_obj: proximity.Proximity,
-        overgrid_factor: int,
+        overgrid_factor: float,
         image_size: np.ndarray,
         verbosity: int,
     ):
@@ -32,7 +35,7 @@ class SystemModel(ABC):
 
         Args:
             proximity_obj (L2Proximity): a subclass that inherits from Proximity class.
-            overgrid_factor (int): overgridding factor
+            overgrid_factor (float): overgridding factor
             image_size (tuple): reconstructed image size
             verbosity (int): either 0 or 1 whether to log output messages
         """
@@ -43,6 +46,14 @@ class SystemModel(ABC):
         self.full_size = np.ceil(self.overgrid_factor * self.crop_size).astype(int)
         self.unique_string = "sysmodel_" + proximity_obj.unique_string
 
+    def _crop_limits(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the first and past-the-end indices of the cropped image volume."""
+        s_lim = np.round(0.5 * (np.subtract(self.full_size, self.crop_size))).astype(
+            int
+        )
+        l_lim = np.round(0.5 * np.add(self.full_size, self.crop_size)).astype(int)
+        return s_lim, l_lim
+
     def crop(self, uncrop: np.ndarray) -> np.ndarray:
         """Crop the image if overgridding was used.
 
@@ -51,12 +62,33 @@ class SystemModel(ABC):
         Returns:
             np.ndarray: Cropped image volume
         """
-        s_lim = np.round(0.5 * (np.subtract(self.full_size, self.crop_size))).astype(
-            int
-        )
-        l_lim = np.round(0.5 * np.add(self.full_size, self.crop_size)).astype(int)
+        s_lim, l_lim = self._crop_limits()
         return uncrop[s_lim[0] : l_lim[0], s_lim[1] : l_lim[1], s_lim[2] : l_lim[2]]
 
+    def deapodization(self) -> np.ndarray:
+        """Calculate the image-space deapodization function of the cropped volume.
+
+        The image is multiplied by the Fourier transform of the gridding kernel,
+        which is evaluated analytically at the position of each voxel.
+
+        Returns:
+            np.ndarray: deapodization function of the cropped image volume size.
+        """
+        s_lim, l_lim = self._crop_limits()
+        frequencies = [
+            self.overgrid_factor
+            * np.fft.ifftshift(np.fft.fftfreq(int(self.full_size[i])))[
+                s_lim[i] : l_lim[i]
+            ]
+            for i in range(3)
+        ]
+        radius = np.sqrt(
+            frequencies[0][:, None, None] ** 2
+            + frequencies[1][None, :, None] ** 2
+            + frequencies[2][None, None, :] ** 2
+        )
+        return self.proximity_obj.kernel_obj.fourier_transform(radius)
+
     @abstractmethod
     def multiply(self, b) -> np.ndarray:
         """Multiply the system matrix by a vector."""
@@ -67,6 +99,14 @@ class SystemModel(ABC):
         """Change the transpose of the system matrix."""
         pass
 
+    def multiply_transpose(self, b) -> np.ndarray:
+        """Multiply the transpose of the system matrix by a vector."""
+        self.transpose()
+        try:
+            return self.multiply(b)
+        finally:
+            self.transpose()
+
 
 class MatrixSystemModel(SystemModel):
     """A matrix system model class.
@@ -90,10 +130,13 @@ class MatrixSystemModel(SystemModel):
     def __init__(
         self,
         proximity_obj: proximity.Proximity,
-        overgrid_factor: int,
+        overgrid_factor: float,
         image_size: np.ndarray,
         traj: np.ndarray,
         verbosity: int,
+        dtype: np.dtype = np.float64,
+        neighborhood_cache: Optional[neighborhood.NeighborhoodCache] = None,
+        matrix: Optional[sps.csr_matrix] = None,
     ):
         """Initialize the matrix system model class.
 
@@ -101,10 +144,17 @@ class MatrixSystemModel(SystemModel):
             A: Sparse matrix.
             ATrans: Transpose of the sparse matrix.
             proximity_obj (L2Proximity): A subclass of the proximity class
-            overgrid_factor (int): overgridding factor
+            overgrid_factor (float): overgridding factor
             image_size (tuple): reconstructed image size
             traj (np.ndarray): trajectories of shape (K, 3)
             verbosity (int): either 0 or 1 whether to log output messages
+            dtype (np.dtype): precision of the interpolation coefficients.
+            neighborhood_cache (NeighborhoodCache): optional cache of sample-voxel
+                distances. If given, only the kernel is evaluated when the
+                trajectory has already been seen, and nothing if the kernel has
+                also been seen.
+            matrix (sps.csr_matrix): optional precomputed interpolation coefficients
+                of shape (K, prod(full_size)), e.g. loaded from a disk cache.
         """
         super().__init__(
             proximity_obj=proximity_obj,
@@ -119,18 +169,43 @@ class MatrixSystemModel(SystemModel):
         if verbosity:
             logging.info("Calculating Matrix interpolation coefficients...")
 
-        sample_idx, voxel_idx, kernel_vals = self.proximity_obj.evaluate(
-            traj=traj, overgrid_factor=self.overgrid_factor, matrix_size=self.full_size
+        is_l2_3d = np.shape(traj)[1] == 3 and isinstance(
+            self.proximity_obj, proximity.L2Proximity
         )
+        if matrix is not None:
+            self.A = matrix
+        elif is_l2_3d and neighborhood_cache is not None:
+            self.A = neighborhood_cache.evaluate(
+                proximity_obj=self.proximity_obj,
+                traj=traj,
+                overgrid_factor=self.overgrid_factor,
+                matrix_size=self.full_size,
+                dtype=dtype,
+            )
+        elif is_l2_3d:
+            self.A = self.proximity_obj.evaluate_csr(
+                traj=traj,
+                overgrid_factor=self.overgrid_factor,
+                matrix_size=self.full_size,
+                dtype=dtype,
+            )
+        else:
+            sample_idx, voxel_idx, kernel_vals = self.proximity_obj.evaluate(
+                traj=traj,
+                overgrid_factor=self.overgrid_factor,
+                matrix_size=self.full_size,
+            )
+            self.A = sps.csr_matrix(
+                (kernel_vals, (sample_idx - 1, voxel_idx - 1)),
+                shape=(np.shape(traj)[0], np.prod(self.full_size)),
+                dtype=dtype,
+            )
         if verbosity:
             logging.info("Finished calculating Matrix interpolation coefficients)")
-
-        self.A = sps.csr_matrix(
-            (kernel_vals, (sample_idx - 1, voxel_idx - 1)),
-            shape=(np.shape(traj)[0], np.prod(self.full_size)),
-            dtype=np.float64,
-        )
-        self.A.eliminate_zeros()
+        if np.any(self.A.data == 0):
+            # the matrix or its index arrays may be shared with the cache
+            self.A = self.A.copy()
+            self.A.eliminate_zeros()
         self.ATrans = self.A.transpose()
 
     def makeSuperSparse(self):
@@ -144,9 +219,268 @@ class MatrixSystemModel(SystemModel):
         return None
 
     def multiply(self, b) -> np.ndarray:
-        """Multiply the system matrix by a vector."""
-        return self.A.multiply(b) if not self.is_transpose else self.ATrans.multiply(b)
+        """Multiply the system matrix by a vector or by the columns of a matrix."""
+        return self.A.dot(b) if not self.is_transpose else self.ATrans.dot(b)
+
+    def transpose(self):
+        """Change the transpose of the system matrix."""
+        self.is_transpose = not self.is_transpose
+
+
+class OnTheFlySystemModel(SystemModel):
+    """A system model that computes the interpolation coefficients on the fly.
+
+    Nothing but the trajectory is stored, so the memory does not grow with the
+    number of interpolation coefficients. Each multiplication recomputes the
+    coefficients in a gridding or ungridding pass, which is slower than a sparse
+    matrix product in iterative applications.
+
+    Attributes:
+        unique_string (str): a unique string describing the system model.
+        is_transpose (bool): if transpose of A is used.
+        n_points (int): number of sample points.
+        coords (np.ndarray): flattened trajectory of shape (K * 3,).
+        kernel_width (float): kernel width in overgridded grid units.
+        lut (np.ndarray): kernel lookup table.
+        lut_scale (float): conversion from squared distance to table position.
+        order (np.ndarray): sample indices sorted into slabs of the grid.
+        slab_starts (np.ndarray): first position of each slab in order.
+    """
+
+    def __init__(
+        self,
+        proximity_obj: proximity.L2Proximity,
+        overgrid_factor: float,
+        image_size: np.ndarray,
+        traj: np.ndarray,
+        verbosity: int,
+    ):
+        """Initialize the on the fly system model class.
+
+        Args:
+            proximity_obj (L2Proximity): L2 proximity object defining the kernel.
+            overgrid_factor (float): overgridding factor
+            image_size (tuple): reconstructed image size
+            traj (np.ndarray): trajectories of shape (K, 3)
+            verbosity (int): either 0 or 1 whether to log output messages
+        """
+        super().__init__(
+            proximity_obj=proximity_obj,
+            overgrid_factor=overgrid_factor,
+            image_size=image_size,
+            verbosity=verbosity,
+        )
+        assert traj.ndim == 2 and traj.shape[1] == 3, "Trajectory must be of shape (K, 3)"
+        self.unique_string = "OTFMod_" + proximity_obj.unique_string
+        self.is_transpose = False
+        self.n_points = traj.shape[0]
+        self.coords = np.ascontiguousarray(traj, dtype=np.float64).flatten()
+        self.kernel_width = overgrid_factor * proximity_obj.kernel_obj.extent
+        self.lut, self.lut_scale = proximity_obj.kernel_lut(overgrid_factor)
+        self.order, self.slab_starts = sparse_gridding_distance.sort_into_slabs(
+            self.coords, self.kernel_width, self.n_points, self.full_size
+        )
+
+    def multiply(self, b) -> np.ndarray:
+        """Multiply the system matrix by a vector.
+
+        Args:
+            b (np.ndarray): grid values of shape (prod(full_size), n), or sample
+                values of shape (K, n) if the transpose is used.
+
+        Returns:
+            np.ndarray: sample values of shape (K, n), or grid values of shape
+                (prod(full_size), n) if the transpose is used.
+        """
+        numba.set_num_threads(self.proximity_obj.get_n_threads())
+        b = np.asarray(b)
+        b = b.reshape(b.shape[0], -1)
+        dtype = np.result_type(b.dtype, self.lut.dtype)
+        if not self.is_transpose:
+            out = np.empty((self.n_points, b.shape[1]), dtype=dtype)
+        else:
+            out = np.zeros((int(np.prod(self.full_size)), b.shape[1]), dtype=dtype)
+        for i in range(b.shape[1]):
+            values = np.ascontiguousarray(b[:, i], dtype=dtype)
+            column = np.ascontiguousarray(out[:, i])
+            if not self.is_transpose:
+                sparse_gridding_distance.ungrid_3d(
+                    self.coords,
+                    self.kernel_width,
+                    self.n_points,
+                    self.full_size,
+                    self.lut,
+                    self.lut_scale,
+                    values,
+                    column,
+                )
+            else:
+                sparse_gridding_distance.grid_3d(
+                    self.coords,
+                    self.kernel_width,
+                    self.full_size,
+                    self.lut,
+                    self.lut_scale,
+                    self.order,
+                    self.slab_starts,
+                    values,
+                    column,
+                )
+            out[:, i] = column
+        return out
+
+    def transpose(self):
+        """Change the transpose of the system matrix."""
+        self.is_transpose = not self.is_transpose
+
+
+class ChunkedSystemModel(SystemModel):
+    """A system model that streams the samples in chunks.
+
+    The interpolation coefficients of one chunk of samples are built at a time,
+    multiplied, and released, so the memory is bounded by the chunk size instead of
+    the number of samples. Nothing is kept between multiplications: the product
+    rebuilds the coefficients of every chunk, and the transpose product grids each
+    chunk with the kernel computed on the fly. Each dcf iteration therefore costs
+    about two builds of the full system matrix.
+
+    Attributes:
+        unique_string (str): a unique string describing the system model.
+        is_transpose (bool): if transpose of A is used.
+        traj (np.ndarray): trajectories of shape (K, 3)
+        chunks (list): slices of the samples in each chunk.
+        dtype (np.dtype): precision of the interpolation coefficients.
+        kernel_width (float): kernel width in overgridded grid units.
+        lut (np.ndarray): kernel lookup table.
+        lut_scale (float): conversion from squared distance to table position.
+        chunk_coords (list): flattened trajectory of each chunk.
+        chunk_slabs (list): samples of each chunk sorted into slabs of the grid,
+            see sparse_gridding_distance.sort_into_slabs.
+    """
+
+    def __init__(
+        self,
+        proximity_obj: proximity.L2Proximity,
+        overgrid_factor: float,
+        image_size: np.ndarray,
+        traj: np.ndarray,
+        verbosity: int,
+        chunk_size: int,
+        dtype: np.dtype = np.float64,
+    ):
+        """Initialize the chunked system model class.
+
+        Args:
+            proximity_obj (L2Proximity): L2 proximity object defining the kernel.
+            overgrid_factor (float): overgridding factor
+            image_size (tuple): reconstructed image size
+            traj (np.ndarray): trajectories of shape (K, 3)
+            verbosity (int): either 0 or 1 whether to log output messages
+            chunk_size (int): number of samples per chunk.
+            dtype (np.dtype): precision of the interpolation coefficients.
+        """
+        super().__init__(
+            proximity_obj=proximity_obj,
+            overgrid_factor=overgrid_factor,
+            image_size=image_size,
+            verbosity=verbosity,
+        )
+        assert traj.ndim == 2 and traj.shape[1] == 3, "Trajectory must be of shape (K, 3)"
+        self.unique_string = "ChunkMod_" + proximity_obj.unique_string
+        self.is_transpose = False
+        self.traj = traj
+        self.chunks = recon_utils.get_chunk_slices(traj.shape[0], chunk_size)
+        self.dtype = dtype
+        self.kernel_width = overgrid_factor * proximity_obj.kernel_obj.extent
+        self.lut, self.lut_scale = proximity_obj.kernel_lut(overgrid_factor)
+        self.chunk_coords = [
+            np.ascontiguousarray(traj[chunk], dtype=np.float64).flatten()
+            for chunk in self.chunks
+        ]
+        self.chunk_slabs = [
+            sparse_gridding_distance.sort_into_slabs(
+                coords, self.kernel_width, coords.shape[0] // 3, self.full_size
+            )
+            for coords in self.chunk_coords
+        ]
+
+    def _chunk_matrix(self, chunk: slice) -> sps.csr_matrix:
+        """Build the interpolation coefficients of a chunk of samples."""
+        return self.proximity_obj.evaluate_csr(
+            traj=self.traj[chunk],
+            overgrid_factor=self.overgrid_factor,
+            matrix_size=self.full_size,
+            dtype=self.dtype,
+        )
+
+    def multiply(self, b) -> np.ndarray:
+        """Multiply the system matrix by a vector.
+
+        Args:
+            b (np.ndarray): grid values of shape (prod(full_size), n), or sample
+                values of shape (K, n) if the transpose is used.
+
+        Returns:
+            np.ndarray: sample values of shape (K, n), or grid values of shape
+                (prod(full_size), n) if the transpose is used.
+        """
+        b = np.asarray(b)
+        b = b.reshape(b.shape[0], -1)
+        dtype = np.result_type(b.dtype, self.dtype)
+        if not self.is_transpose:
+            out = np.empty((self.traj.shape[0], b.shape[1]), dtype=dtype)
+            for chunk in self.chunks:
+                out[chunk] = self._chunk_matrix(chunk).dot(b)
+        else:
+            numba.set_num_threads(self.proximity_obj.get_n_threads())
+            out = np.zeros((int(np.prod(self.full_size)), b.shape[1]), dtype=dtype)
+            for i in range(b.shape[1]):
+                column = np.ascontiguousarray(out[:, i])
+                for chunk, coords, (order, slab_starts) in zip(
+                    self.chunks, self.chunk_coords, self.chunk_slabs
+                ):
+                    # accumulate into the grid in place, without building the
+                    # coefficients of the chunk
+                    sparse_gridding_distance.grid_3d(
+                        coords,
+                        self.kernel_width,
+                        self.full_size,
+                        self.lut,
+                        self.lut_scale,
+                        order,
+                        slab_starts,
+                        np.ascontiguousarray(b[chunk, i], dtype=dtype),
+                        column,
+                    )
+                out[:, i] = column
+        return out
 
     def transpose(self):
         """Change the transpose of the system matrix."""
         self.is_transpose = not self.is_transpose
+
+
+def estimate_matrix_nbytes(
+    proximity_obj: proximity.Proximity,
+    overgrid_factor: float,
+    n_points: int,
+    dtype: np.dtype = np.float64,
+) -> int:
+    """Estimate the memory of the sparse system matrix of a 3D trajectory.
+
+    Each sample has about as many neighbors as there are voxels in the ball of the
+    kernel halfwidth.
+
+    Args:
+        proximity_obj (Proximity): proximity object defining the kernel.
+        overgrid_factor (float): overgridding factor
+        n_points (int): number of sample points.
+        dtype (np.dtype): precision of the interpolation coefficients.
+
+    Returns:
+        int: estimated size of the CSR arrays in bytes.
+    """
+    kernel_halfwidth = 0.5 * overgrid_factor * proximity_obj.kernel_obj.extent
+    n_neighbors = 4.0 / 3.0 * np.pi * kernel_halfwidth**3
+    nnz = n_points * n_neighbors
+    return int(nnz * (np.dtype(dtype).itemsize + 4) + 4 * (n_points + 1))
@@ -0,0 +1,96 @@
+"""Toeplitz embedding of the normal operator.
+
+The normal operator A^H W A of the non-uniform Fourier transform is a convolution of
+the image with the point spread function of the trajectory. The point spread
+function is sampled on a twice as large grid, so that the convolution is applied
+with two FFTs and no gridding.
+"""
+
+import itertools
+import sys
+from typing import List
+
+import numpy as np
+
+sys.path.append("..")
+from utils import fft_utils
+
+
+def psf_offsets(image_size: int) -> List[np.ndarray]:
+    """Get the shifts of the 8 blocks of the point spread function.
+
+    Args:
+        image_size (int): reconstructed image size N.
+
+    Returns:
+        List of the shifts, in voxels, of the image-sized blocks that tile the
+            (2N, 2N, 2N) point spread function.
+    """
+    half = image_size // 2
+    return [np.array(shift) for shift in itertools.product([-half, half], repeat=3)]
+
+
+def psf_modulation(traj: np.ndarray, image_size: int) -> np.ndarray:
+    """Get the data whose gridded images are the blocks of the point spread function.
+
+    Shifting the image by a block offset is a phase modulation of the data. The
+    image axes are in the reverse order of the trajectory columns.
+
+    Args:
+        traj (np.ndarray): trajectory of shape (K, 3)
+        image_size (int): reconstructed image size N.
+
+    Returns:
+        np.ndarray: modulations of shape (K, 8), in the order of psf_offsets.
+    """
+    offsets = np.stack(psf_offsets(image_size), axis=1)
+    return np.exp(2j * np.pi * traj[:, ::-1] @ offsets)
+
+
+class ToeplitzOperator(object):
+    """Normal operator applied by a convolution on a twice as large grid.
+
+    Attributes:
+        image_size (int): reconstructed image size N.
+        kernel (np.ndarray): real FFT of the point spread function of shape
+            (2N, 2N, 2N).
+    """
+
+    def __init__(self, psf_blocks: np.ndarray):
+        """Initialize the operator from the blocks of the point spread function.
+
+        Args:
+            psf_blocks (np.ndarray): gridded images of psf_modulation of shape
+                (N, N, N, 8).
+        """
+        self.image_size = psf_blocks.shape[0]
+        n = self.image_size
+        psf = np.zeros((2 * n,) * 3, dtype=psf_blocks.dtype)
+        for i, offset in enumerate(psf_offsets(n)):
+            psf[tuple(slice(0, n) if o < 0 else slice(n, 2 * n) for o in offset)] = (
+                psf_blocks[..., i]
+            )
+        # move the origin of the point spread function to index 0. The point spread
+        # function is hermitian, so its FFT is real up to the unused -N row.
+        self.kernel = fft_utils.fftn(np.fft.ifftshift(psf)).real
+
+    def lipschitz(self) -> float:
+        """Get the largest eigenvalue of the operator."""
+        return float(np.max(np.abs(self.kernel)))
+
+    def multiply(self, image: np.ndarray) -> np.ndarray:
+        """Apply the normal operator.
+
+        Args:
+            image (np.ndarray): image of shape (N, N, N)
+
+        Returns:
+            np.ndarray: image of shape (N, N, N)
+        """
+        n = self.image_size
+        window = (slice(n // 2, n // 2 + n),) * 3
+        padded = np.zeros((2 * n,) * 3, dtype=np.result_type(image, 1j))
+        padded[window] = image
+        padded = fft_utils.fftn(padded)
+        padded *= self.kernel
+        return fft_utils.ifftn(padded)[window]
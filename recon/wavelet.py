@@ -0,0 +1,102 @@
+"""Orthonormal 3D Haar wavelet transform and its soft thresholding."""
+
+import numpy as np
+
+
+def _max_levels(shape: tuple) -> int:
+    """Get the number of levels for which all axes stay even."""
+    levels = 0
+    while all(n % 2 ** (levels + 1) == 0 for n in shape):
+        levels += 1
+    return levels
+
+
+def haar_forward(image: np.ndarray, levels: int) -> np.ndarray:
+    """Compute the orthonormal Haar transform along all axes.
+
+    Each level transforms the low-pass block of the previous level in place, so the
+    coefficients have the shape of the image.
+
+    Args:
+        image (np.ndarray): 3D image.
+        levels (int): number of levels. Bounded by the number of times the image
+            size can be halved.
+
+    Returns:
+        np.ndarray: wavelet coefficients.
+    """
+    coeffs = np.array(image, copy=True)
+    size = np.array(coeffs.shape)
+    for _ in range(min(levels, _max_levels(coeffs.shape))):
+        block = tuple(slice(0, n) for n in size)
+        low = coeffs[block]
+        for axis in range(3):
+            even = np.take(low, range(0, low.shape[axis], 2), axis=axis)
+            odd = np.take(low, range(1, low.shape[axis], 2), axis=axis)
+            low = np.concatenate(
+                [(even + odd) / np.sqrt(2), (even - odd) / np.sqrt(2)], axis=axis
+            )
+        coeffs[block] = low
+        size //= 2
+    return coeffs
+
+
+def haar_inverse(coeffs: np.ndarray, levels: int) -> np.ndarray:
+    """Invert haar_forward.
+
+    Args:
+        coeffs (np.ndarray): wavelet coefficients.
+        levels (int): number of levels used by haar_forward.
+
+    Returns:
+        np.ndarray: 3D image.
+    """
+    image = np.array(coeffs, copy=True)
+    levels = min(levels, _max_levels(image.shape))
+    for level in reversed(range(levels)):
+        size = np.array(image.shape) // 2**level
+        block = tuple(slice(0, n) for n in size)
+        low = image[block]
+        for axis in reversed(range(3)):
+            half = low.shape[axis] // 2
+            sum_ = np.take(low, range(0, half), axis=axis)
+            diff = np.take(low, range(half, 2 * half), axis=axis)
+            low = np.empty_like(low)
+            index = [slice(None)] * 3
+            index[axis] = slice(0, None, 2)
+            low[tuple(index)] = (sum_ + diff) / np.sqrt(2)
+            index[axis] = slice(1, None, 2)
+            low[tuple(index)] = (sum_ - diff) / np.sqrt(2)
+        image[block] = low
+    return image
+
+
+def soft_threshold(
+    image: np.ndarray, threshold: float, levels: int, shift: np.ndarray
+) -> np.ndarray:
+    """Soft threshold the Haar detail coefficients of a circularly shifted image.
+
+    Randomly shifting the image every call (cycle spinning) avoids the blocky
+    artifacts of thresholding a fixed Haar grid.
+
+    Args:
+        image (np.ndarray): 3D complex image.
+        threshold (float): threshold on the magnitude of the coefficients.
+        levels (int): number of wavelet levels.
+        shift (np.ndarray): circular shift of the image along each axis.
+
+    Returns:
+        np.ndarray: thresholded image.
+    """
+    shift = tuple(int(s) for s in shift)
+    coeffs = haar_forward(np.roll(image, shift, axis=(0, 1, 2)), levels)
+    levels = min(levels, _max_levels(image.shape))
+    low = tuple(slice(0, n // 2**levels) for n in image.shape)
+    approximation = np.array(coeffs[low], copy=True)
+    magnitude = np.abs(coeffs)
+    coeffs *= np.maximum(1 - threshold / np.maximum(magnitude, 1e-30), 0)
+    # the low-pass coefficients hold the image contrast and are not sparse
+    coeffs[low] = approximation
+    return np.roll(
+        haar_inverse(coeffs, levels), tuple(-s for s in shift), axis=(0, 1, 2)
+    )
@@ -9,6 +9,7 @@ from ml_collections import config_flags
 
 from config import base_config
 from subject_classmap import Subject
+from utils import constants
 
 FLAGS = flags.FLAGS
 
@@ -95,7 +96,11 @@ def gx_mapping_reconstruction(config: base_config.Config):
         logging.info("Reconstructing images")
         subject.preprocess()
         subject.reconstruction_gas()
+        if config.bias_key == constants.BiasfieldKey.RF_DEPOLARIZATION.value:
+            subject.reconstruction_gas_subdivisions()
         subject.reconstruction_dissolved()
+        if config.recon.recon_rbc_oscillation:
+            subject.reconstruction_rbc_oscillation()
 
         if config.recon.recon_proton:
             subject.reconstruction_ute()
@@ -107,6 +112,8 @@ def gx_mapping_reconstruction(config: base_config.Config):
         subject.biasfield_correction()
         subject.gas_binning()
         subject.dixon_decomposition()
+        if config.recon.recon_rbc_oscillation:
+            subject.rbc_oscillation_analysis()
         subject.hb_correction()
         subject.dissolved_analysis()
         subject.dissolved_binning()
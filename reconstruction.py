@@ -1,12 +1,21 @@
 """Reconstruct 3D image from k-space data and trajectory."""
 
 import time
+from typing import Optional
 
 import numpy as np
 from absl import app, logging
 
-from recon import dcf, kernel, proximity, recon_model, system_model
-from utils import img_utils, io_utils
+from recon import (
+    dcf,
+    kernel,
+    neighborhood,
+    presort,
+    proximity,
+    recon_model,
+    system_model,
+)
+from utils import cache_utils, constants, fft_utils, img_utils, io_utils
 
 
 def reconstruct(
@@ -14,51 +23,235 @@ def reconstruct(
     traj: np.ndarray,
     kernel_sharpness: float = 0.32,
     kernel_extent: float = 0.32 * 9,
-    overgrid_factor: int = 3,
+    overgrid_factor: float = 3,
+    kernel_type: str = constants.KernelType.GAUSSIAN.value,
+    deapodize: bool = False,
+    recon_key: str = constants.ReconKey.ROBERTSON.value,
+    n_cs_iter: int = 20,
+    cs_lambda: float = 0.01,
     image_size: int = 128,
+    matrix_size: Optional[int] = None,
+    upsample_method: str = constants.UpsampleMethod.FOURIER.value,
     n_dcf_iter: int = 20,
+    dcf_init: Optional[np.ndarray] = None,
+    dcf_tolerance: float = 0.0,
+    dcf_dtype: np.dtype = np.float64,
+    n_threads: int = 0,
+    matrix_dtype: np.dtype = np.float64,
+    max_matrix_gb: Optional[float] = None,
+    chunk_size: int = 0,
+    neighborhood_cache: Optional[neighborhood.NeighborhoodCache] = None,
+    disk_cache: Optional[cache_utils.DiskCache] = None,
+    presort_samples: bool = False,
     verbosity: bool = True,
 ) -> np.ndarray:
     """Reconstruct k-space data and trajectory.
 
     Args:
-        data (np.ndarray): k space data of shape (K, 1)
+        data (np.ndarray): k space data of shape (K, 1), or of shape (K, n_images) to
+            reconstruct several images on the same trajectory with one system matrix.
         traj (np.Jlndarray): k space trajectory of shape (K, 3)
         kernel_sharpness (float): kernel sharpness. larger kernel sharpness is sharper
             image
         kernel_extent (float): kernel extent.
-        overgrid_factor (int): overgridding factor
+        overgrid_factor (float): overgridding factor
+        kernel_type (str): gridding kernel type, see constants.KernelType. The
+            kernel sharpness is not used by the Kaiser-Bessel kernel.
+        deapodize (bool): divide the image by the Fourier transform of the kernel
+        recon_key (str): reconstruction method, see constants.ReconKey. ROBERTSON
+            grids the data, PLUMMER runs an iterative compressed sensing
+            reconstruction that starts from the gridded image.
+        n_cs_iter (int): number of iterations of the PLUMMER reconstruction.
+        cs_lambda (float): wavelet regularization of the PLUMMER reconstruction,
+            relative to the maximum of the gridded image.
         image_size (int): target reconstructed image size
             (image_size, image_size, image_size)
+        matrix_size (int): size of the returned image. The reconstructed image is
+            upsampled from image_size, which keeps the kernel and system matrix of
+            image_size. None returns image_size.
+        upsample_method (str): upsampling to matrix_size, see
+            constants.UpsampleMethod. FOURIER zero-pads k-space and keeps voxel
+            image_size/2 at voxel matrix_size/2. ZOOM is the spline zoom of earlier
+            versions, whose voxel grid is shifted by about half an output voxel.
         n_pipe_iter (int): number of dcf iterations
+        dcf_init (np.ndarray): optional first guess of the dcf of shape (K, 1), e.g.
+            from dcf.radial_density_estimate.
+        dcf_tolerance (float): stop the dcf iterations once the relative update is
+            below tolerance. 0 runs all n_dcf_iter iterations.
+        dcf_dtype (np.dtype): precision of the dcf iterations.
+        n_threads (int): number of threads for the neighbor search. 0 uses all
+            available threads.
+        matrix_dtype (np.dtype): precision of the system matrix values.
+        max_matrix_gb (float): memory budget of the system matrix in GB. If the
+            estimated matrix is larger, the interpolation coefficients are computed
+            on the fly instead. None always stores the matrix.
+        chunk_size (int): number of samples per chunk when streaming the samples
+            through the gridding. 0 builds the system matrix of all samples at once.
+        neighborhood_cache (NeighborhoodCache): optional cache of sample-voxel
+            distances shared between reconstructions of the same trajectory.
+        disk_cache (DiskCache): optional on-disk cache of the system matrix and dcf
+            shared between subjects scanned with the same trajectory.
+        presort_samples (bool): sort the samples along a Morton curve of the
+            overgridded grid before building the system matrix, so that the
+            gridding touches nearby voxels. The image does not change.
         verbosity (bool): Log output messages
 
     Returns:
-        np.ndarray: reconstructed image volume
+        np.ndarray: reconstructed image volume, with the images along the last axis
+            if data has several columns.
     """
     start_time = time.time()
-    prox_obj = proximity.L2Proximity(
-        kernel_obj=kernel.Gaussian(
+    if kernel_type == constants.KernelType.GAUSSIAN.value:
+        kernel_obj = kernel.Gaussian(
             kernel_extent=kernel_extent,
             kernel_sigma=kernel_sharpness,
             verbosity=verbosity,
-        ),
+        )
+    elif kernel_type == constants.KernelType.KAISERBESSEL.value:
+        kernel_obj = kernel.KaiserBessel(
+            kernel_extent=kernel_extent,
+            overgrid_factor=overgrid_factor,
+            verbosity=verbosity,
+        )
+    else:
+        raise ValueError(f"Unknown kernel type: {kernel_type}")
+    prox_obj = proximity.L2Proximity(
+        kernel_obj=kernel_obj,
         verbosity=verbosity,
+        n_threads=n_threads,
     )
-    system_obj = system_model.MatrixSystemModel(
-        proximity_obj=prox_obj,
-        overgrid_factor=overgrid_factor,
-        image_size=np.array([image_size, image_size, image_size]),
-        traj=traj,
-        verbosity=verbosity,
+    image_size_3d = np.array([image_size, image_size, image_size])
+    if presort_samples:
+        presort_obj = presort.SamplePresort(
+            traj=traj, full_size=np.ceil(overgrid_factor * image_size_3d)
+        )
+        traj = presort_obj.sort(traj)
+        data = presort_obj.sort(data)
+        if dcf_init is not None:
+            dcf_init = presort_obj.sort(dcf_init)
+    on_the_fly = (
+        chunk_size <= 0
+        and max_matrix_gb is not None
+        and system_model.estimate_matrix_nbytes(
+            proximity_obj=prox_obj,
+            overgrid_factor=overgrid_factor,
+            n_points=traj.shape[0],
+            dtype=matrix_dtype,
+        )
+        > max_matrix_gb * 1e9
     )
+    matrix, dcf_array = None, None
+    stores_matrix = not on_the_fly and chunk_size <= 0
+    if disk_cache is not None:
+        matrix_key = cache_utils.hash_key(
+            "system_matrix",
+            traj,
+            prox_obj.unique_string,
+            overgrid_factor,
+            image_size,
+            np.dtype(matrix_dtype).str,
+        )
+        dcf_key = cache_utils.hash_key(
+            "dcf",
+            matrix_key,
+            n_dcf_iter,
+            dcf_init,
+            dcf_tolerance,
+            np.dtype(dcf_dtype).str,
+        )
+        if stores_matrix:
+            matrix = disk_cache.load_csr(matrix_key)
+        dcf_entry = (
+            disk_cache.load(dcf_key)
+            if matrix is not None or not stores_matrix
+            else None
+        )
+        dcf_array = dcf_entry["dcf"] if dcf_entry is not None else None
+        if verbosity and matrix is not None:
+            logging.info("Loaded system matrix from the disk cache.")
+        if verbosity and dcf_array is not None:
+            logging.info("Loaded dcf from the disk cache.")
+    if chunk_size > 0:
+        system_obj = system_model.ChunkedSystemModel(
+            proximity_obj=prox_obj,
+            overgrid_factor=overgrid_factor,
+            image_size=image_size_3d,
+            traj=traj,
+            verbosity=verbosity,
+            chunk_size=chunk_size,
+            dtype=matrix_dtype,
+        )
+    elif on_the_fly:
+        if verbosity:
+            logging.info("System matrix exceeds the memory budget, gridding on the fly.")
+        system_obj = system_model.OnTheFlySystemModel(
+            proximity_obj=prox_obj,
+            overgrid_factor=overgrid_factor,
+            image_size=image_size_3d,
+            traj=traj,
+            verbosity=verbosity,
+        )
+    else:
+        system_obj = system_model.MatrixSystemModel(
+            proximity_obj=prox_obj,
+            overgrid_factor=overgrid_factor,
+            image_size=image_size_3d,
+            traj=traj,
+            verbosity=verbosity,
+            dtype=matrix_dtype,
+            neighborhood_cache=neighborhood_cache,
+            matrix=matrix,
+        )
     dcf_obj = dcf.IterativeDCF(
-        system_obj=system_obj, dcf_iterations=n_dcf_iter, verbosity=verbosity
-    )
-    recon_obj = recon_model.LSQgridded(
-        system_obj=system_obj, dcf_obj=dcf_obj, verbosity=verbosity
+        system_obj=system_obj,
+        dcf_iterations=n_dcf_iter,
+        verbosity=verbosity,
+        dcf=dcf_array,
+        dcf_init=dcf_init,
+        tolerance=dcf_tolerance,
+        dtype=dcf_dtype,
     )
+    if disk_cache is not None and stores_matrix and matrix is None:
+        disk_cache.save_csr(matrix_key, system_obj.A)
+    if disk_cache is not None and dcf_array is None:
+        disk_cache.save(dcf_key, {"dcf": dcf_obj.dcf})
+    if recon_key == constants.ReconKey.ROBERTSON.value:
+        recon_obj = recon_model.LSQgridded(
+            system_obj=system_obj,
+            dcf_obj=dcf_obj,
+            verbosity=verbosity,
+            deapodize=deapodize,
+        )
+    elif recon_key == constants.ReconKey.PLUMMER.value:
+        recon_obj = recon_model.ToeplitzCSRecon(
+            system_obj=system_obj,
+            dcf_obj=dcf_obj,
+            verbosity=verbosity,
+            n_iterations=n_cs_iter,
+            reg_lambda=cs_lambda,
+        )
+    else:
+        raise ValueError(f"Unknown reconstruction key: {recon_key}")
     image = recon_obj.reconstruct(data=data, traj=traj)
+    if matrix_size is not None:
+        if upsample_method == constants.UpsampleMethod.FOURIER.value:
+            image = fft_utils.upsample(image, matrix_size)
+        elif upsample_method == constants.UpsampleMethod.ZOOM.value:
+            factor = matrix_size // image_size
+            images = image.reshape(image.shape[:3] + (-1,))
+            image = (
+                np.stack(
+                    [
+                        img_utils.interp(images[..., i], factor)
+                        for i in range(images.shape[-1])
+                    ],
+                    axis=-1,
+                )
+                .reshape((matrix_size,) * 3 + image.shape[3:])
+                .astype(image.dtype, copy=False)
+            )
+        else:
+            raise ValueError(f"Unknown upsample method: {upsample_method}")
     del recon_obj, dcf_obj, system_obj, prox_obj
     end_time = time.time()
     execution_time = end_time - start_time
@@ -12,6 +12,7 @@ import numpy as np
 from scipy.optimize import least_squares
 
 from spect.nmr_mix import NMR_Mix
+from utils import fft_utils
 
 
 class NMR_TimeFit(NMR_Mix):
@@ -82,12 +83,18 @@ class NMR_TimeFit(NMR_Mix):
         # calculate dwell time from delta tdata
         self.sample_time = self.tdata[1] - self.tdata[0]
         self.spectral_signal = self.sample_time * np.fft.fftshift(
-            np.fft.fft(self.ydata, self.zeropad_size)
+            fft_utils.fft(self.ydata, self.zeropad_size)
         )
         self.f = np.linspace(-0.5, 0.5, self.zeropad_size + 1) / self.sample_time
         # take out last sample to have the right number of samples
         self.f = self.f[:-1]
         self.sort_freq()
+        # time bases of the voigt model, the first component has no gaussian decay
+        self._t_column = self.tdata[:, np.newaxis]
+        self._t_gaussian = 4 * np.log(2) * self._t_column**2
+        self._gaussian_mask = np.array([0.0, 1.0, 1.0])
+        self._basis_x = None
+        self._basis = None
 
     def calc_time_fit_residual(self, bounds):
         """Fit the time domain signal using least square curve fitting.
@@ -107,6 +114,7 @@ class NMR_TimeFit(NMR_Mix):
         fit_result = least_squares(
             fun=fun,
             x0=x0,
+            jac=self.get_residual_time_jacobian,
             method="lm",
             ftol=1e-15,
             xtol=1e-09,
@@ -137,7 +145,7 @@ class NMR_TimeFit(NMR_Mix):
             fit_result = least_squares(
                 fun=fun,
                 x0=x0,
-                jac="3-point",
+                jac=self.get_residual_time_jacobian,
                 bounds=(-np.inf, np.inf),
                 method="trf",
             )
@@ -151,6 +159,28 @@ class NMR_TimeFit(NMR_Mix):
 
         return fit_param
 
+    def _get_voigt_basis(self, x: np.ndarray) -> np.ndarray:
+        """Get the decaying complex exponential of each component of the voigt model.
+
+        Matches NMR_Mix.get_time_function without the area. The basis of the last
+        parameters is kept, as least_squares evaluates the residual and the jacobian
+        at the same parameters.
+
+        Args:
+            x (np.ndarray): Fitting parameters of shape (5, 3) [area, freq, fwhmL,
+             fwhmG, phase]
+        Returns: basis of shape (number of time points, 3).
+        """
+        if self._basis_x is None or not np.array_equal(x, self._basis_x):
+            _, freq, fwhmL, fwhmG, phase = x
+            self._basis = np.exp(
+                self._t_column * (2j * np.pi * freq - np.pi * fwhmL)
+                - self._t_gaussian * (self._gaussian_mask * fwhmG**2)
+                + 1j * np.pi / 180.0 * phase
+            )
+            self._basis_x = x.copy()
+        return self._basis
+
     def get_residual_time_function(self, x: np.ndarray):
         """Calculate the residual of fitting.
 
@@ -158,24 +188,39 @@ class NMR_TimeFit(NMR_Mix):
             x (np.ndarray): Fitting parameters of shape [area, freq, fwhmL, fwhmG,
              phase]
         """
-        if self.method == "voigt":
-            x = np.reshape(x, (5, int(np.size(x) / 5)))
-            tmpNMRMix = NMR_Mix(
-                area=x[0, :],
-                freq=x[1, :],
-                fwhmL=x[2, :],
-                fwhmG=x[3, :],
-                phase=x[4, :],
-                method="voigt",
-            )
-        else:
+        if self.method != "voigt":
             raise ValueError("Only voigt method is supported for time domain fitting.")
+        x = np.reshape(x, (5, int(np.size(x) / 5)))
+        assert x.shape[1] == 3, "Number of components must be 3."
+        residual = self.ydata - self._get_voigt_basis(x) @ x[0]
+        return np.concatenate((np.real(residual), np.imag(residual)))
+
+    def get_residual_time_jacobian(self, x: np.ndarray):
+        """Calculate the jacobian of the residual of fitting.
 
-        complex_fit_time = tmpNMRMix.get_time_function(self.tdata)
-        fit_sig = np.array([np.real(complex_fit_time), np.imag(complex_fit_time)])
-        truth_sig = np.array([np.real(self.ydata), np.imag(self.ydata)])
-        residual = (truth_sig - fit_sig).flatten()
-        return residual
+        Args:
+            x (np.ndarray): Fitting parameters of shape [area, freq, fwhmL, fwhmG,
+             phase]
+        Returns: jacobian of shape (2 * number of time points, number of parameters).
+        """
+        if self.method != "voigt":
+            raise ValueError("Only voigt method is supported for time domain fitting.")
+        x = np.reshape(x, (5, int(np.size(x) / 5)))
+        basis = self._get_voigt_basis(x)
+        weighted_basis = x[0] * basis
+        # derivatives of the fit signal, in the order of the fitting parameters
+        derivative = np.stack(
+            (
+                basis,
+                weighted_basis * (2j * np.pi * self._t_column),
+                weighted_basis * (-np.pi * self._t_column),
+                weighted_basis
+                * (-2 * self._t_gaussian * self._gaussian_mask * x[3]),
+                weighted_basis * (1j * np.pi / 180.0),
+            ),
+            axis=1,
+        ).reshape((basis.shape[0], -1))
+        return -np.concatenate((np.real(derivative), np.imag(derivative)))
 
     def fit_time_signal_residual(
         self,
@@ -232,7 +277,7 @@ class NMR_TimeFit(NMR_Mix):
 
         # calculate fit spectral signal
         complex_fit_spect = self.sample_time * np.fft.fftshift(
-            np.fft.fft(complex_fit_time, self.zeropad_size)
+            fft_utils.fft(complex_fit_time, self.zeropad_size)
         )
 
         ax2 = plt.subplot(1, 3, 2)
@@ -3,7 +3,7 @@ import glob
 import logging
 import os
 import shutil
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 # Haad: Errors internal to nibabl may arise owing to deprecated numpy functions
 import nibabel as nib 
@@ -15,9 +15,12 @@ import reconstruction
 import registration
 import segmentation
 from config import base_config
+from recon import dcf, neighborhood
 from utils import (
     binning,
+    cache_utils,
     constants,
+    fft_utils,
     img_utils,
     io_utils,
     metrics,
@@ -35,9 +38,13 @@ class Subject(object):
 
     Attributes:
         config (config_dict.ConfigDict): config dict
+        complex_dtype (np.dtype): data type of the k-space data and complex images,
+            set by config.precision
         data_dissolved (np.array): dissolved-phase data of shape (n_projections, n_points)
         data_gas (np.array): gas-phase data of shape (n_projections, n_points)
         data_ute (np.array): UTE proton data of shape (n_projections, n_points)
+        disk_cache (DiskCache): on-disk cache of system matrices and dcfs shared
+            between subjects, or None if disabled
         dict_dis (dict): dictionary of dissolved-phase data and metadata
         dict_dyn (dict): dictionary of dynamic spectroscopy data and metadata
         dict_ute (dict): dictionary of UTE proton data and metadata
@@ -59,9 +66,13 @@ class Subject(object):
         image_rbc2gas_binned (np.array): binned image_rbc2gas
         mask (np.array): thoracic cavity mask
         mask_vent (np.ndarray): thoracic cavity mask without ventilation defects
+        neighborhood_cache (NeighborhoodCache): sample-voxel distances and kernel
+            matrices shared by the low resolution kernel reconstructions
         membrane_hb_correction_factor (float): membrane hb correction scaling factor
         rbc_hb_correction_factor (float): rbc hb correction scaling factor
         rbc_m_ratio (float): RBC to M ratio
+        real_dtype (np.dtype): data type of the trajectories and real images, set by
+            config.precision
         traj_dissolved (np.array): dissolved-phase trajectory of shape
             (n_projections, n_points, 3)
         traj_gas (np.array): gas-phase trajectory of shape (n_projections, n_points, 3)
@@ -73,16 +84,27 @@ class Subject(object):
         """Init object."""
         logging.info("Initializing gas exchange imaging subject.")
         self.config = config
+        single = self.config.precision == constants.Precision.SINGLE.value
+        self.complex_dtype = np.complex64 if single else np.complex128
+        self.real_dtype = np.float32 if single else np.float64
         self.data_dissolved = np.array([])
         self.data_gas = np.array([])
         self.dict_dis = {}
         self.dict_dyn = {}
         self.image_biasfield = np.array([0.0])
         self.image_dissolved = np.array([0.0])
+        self.image_dissolved_batched = np.array([])
+        self.image_dissolved_high = np.array([0.0])
+        self.image_dissolved_low = np.array([0.0])
+        self.image_dissolved_total = np.array([0.0])
+        self.image_rbc_osc = np.array([0.0])
         self.image_gas_binned = np.array([0.0])
         self.image_gas_cor = np.array([0.0])
         self.image_gas_highreso = np.array([0.0])
         self.image_gas_highsnr = np.array([0.0])
+        self.image_gas_first_half = np.array([0.0])
+        self.image_gas_second_half = np.array([0.0])
+        self.image_gas_subdivisions_batched = np.array([])
         self.image_membrane = np.array([0.0])
         self.image_membrane2gas = np.array([0.0])
         self.image_membrane2gas_binned = np.array([0.0])
@@ -102,6 +124,25 @@ class Subject(object):
         self.traj_dissolved = np.array([])
         self.traj_gas = np.array([])
         self.traj_ute = np.array([])
+        self.neighborhood_cache = neighborhood.NeighborhoodCache()
+        self.disk_cache = (
+            cache_utils.DiskCache(
+                cache_dir=str(self.config.recon.cache_dir),
+                max_size_gb=float(self.config.recon.cache_size_gb),
+            )
+            if self.config.recon.cache_dir
+            else None
+        )
+        fft_utils.configure(
+            backend=str(self.config.recon.fft_backend),
+            n_threads=int(self.config.recon.n_threads),
+            complex64=bool(self.config.recon.fft_complex64) or single,
+            wisdom_path=(
+                os.path.join(str(self.config.recon.cache_dir), "fftw_wisdom.pkl")
+                if self.config.recon.cache_dir
+                else ""
+            ),
+        )
 
     def read_twix_files(self):
         """Read in twix files to dictionary.
@@ -111,17 +152,22 @@ class Subject(object):
         """
         print(f"data_dir: {self.config.data_dir}")
         self.dict_dis = io_utils.read_dis_twix(
-            io_utils.get_dis_twix_files(str(self.config.data_dir))
+            io_utils.get_dis_twix_files(str(self.config.data_dir)),
+            dtype=self.complex_dtype,
+            use_cache=bool(self.config.cache_twix),
         )
         try:
             self.dict_dyn = io_utils.read_dyn_twix(
-                io_utils.get_dyn_twix_files(str(self.config.data_dir))
+                io_utils.get_dyn_twix_files(str(self.config.data_dir)),
+                use_cache=bool(self.config.cache_twix),
             )
         except ValueError:
             logging.info("No dynamic spectroscopy twix file found")
         if self.config.recon.recon_proton:
             self.dict_ute = io_utils.read_ute_twix(
-                io_utils.get_ute_twix_files(str(self.config.data_dir))
+                io_utils.get_ute_twix_files(str(self.config.data_dir)),
+                dtype=self.complex_dtype,
+                use_cache=bool(self.config.cache_twix),
             )
 
     def read_mrd_files(self):
@@ -131,7 +177,8 @@ class Subject(object):
         data.
         """
         self.dict_dis = io_utils.read_dis_mrd(
-            io_utils.get_dis_mrd_files(str(self.config.data_dir))
+            io_utils.get_dis_mrd_files(str(self.config.data_dir)),
+            dtype=self.complex_dtype,
         )
         try:
             self.dict_dyn = io_utils.read_dyn_mrd(
@@ -141,7 +188,8 @@ class Subject(object):
             logging.info("No dynamic spectroscopy MRD file found")
         if self.config.recon.recon_proton:
             self.dict_ute = io_utils.read_ute_mrd(
-                io_utils.get_ute_mrd_files(str(self.config.data_dir))
+                io_utils.get_ute_mrd_files(str(self.config.data_dir)),
+                dtype=self.complex_dtype,
             )
 
     def read_mat_file(self):
@@ -252,7 +300,11 @@ class Subject(object):
                 self.data_dissolved, self.traj_dissolved
             )
 
-        # rescale trajectories
+        # cast to the precision of the config and rescale trajectories
+        self.data_dissolved = self.data_dissolved.astype(self.complex_dtype, copy=False)
+        self.data_gas = self.data_gas.astype(self.complex_dtype, copy=False)
+        self.traj_dissolved = self.traj_dissolved.astype(self.real_dtype, copy=False)
+        self.traj_gas = self.traj_gas.astype(self.real_dtype, copy=False)
         self.traj_dissolved *= self.traj_scaling_factor
         self.traj_gas *= self.traj_scaling_factor
 
@@ -273,28 +325,94 @@ class Subject(object):
                     self.data_ute, self.traj_ute
                 )
 
-            # rescale trajectories
+            # cast to the precision of the config and rescale trajectories
+            self.data_ute = self.data_ute.astype(self.complex_dtype, copy=False)
+            self.traj_ute = self.traj_ute.astype(self.real_dtype, copy=False)
             self.traj_ute *= self.traj_scaling_factor
 
+    def _kernel_extent(self, kernel_sharpness: float) -> float:
+        """Get the kernel extent in pre-overgridded k-space voxels.
+
+        Args:
+            kernel_sharpness (float): gaussian kernel sharpness.
+        """
+        if self.config.recon.kernel_type == constants.KernelType.KAISERBESSEL.value:
+            return float(self.config.recon.kernel_width_kb) / float(
+                self.config.recon.overgrid_factor
+            )
+        return 9 * kernel_sharpness
+
+    def _reconstruct(
+        self,
+        data: np.ndarray,
+        traj: np.ndarray,
+        kernel_sharpness: float,
+        recon_key: Optional[str] = None,
+    ) -> np.ndarray:
+        """Reconstruct an image with the reconstruction settings of the config.
+
+        Args:
+            data (np.ndarray): data FIDs of shape (n_projections, n_points), or of
+                shape (n_projections, n_points, n_images) for several images on the
+                same trajectory.
+            traj (np.ndarray): trajectory of shape (n_projections, n_points, 3)
+            kernel_sharpness (float): gaussian kernel sharpness.
+            recon_key (str): reconstruction method, see constants.ReconKey. None
+                uses the reconstruction method of the config.
+
+        Returns:
+            np.ndarray: reconstructed image volume, with the images along the last
+                axis if data holds several images.
+        """
+        # only the low resolution kernel is reused, on the gas trajectory and on its
+        # subsets. the wider kernels would keep large neighborhoods in memory
+        share_neighborhood = kernel_sharpness == float(
+            self.config.recon.kernel_sharpness_lr
+        )
+        return reconstruction.reconstruct(
+            data=recon_utils.flatten_data(data),
+            traj=recon_utils.flatten_traj(traj),
+            kernel_sharpness=kernel_sharpness,
+            kernel_extent=self._kernel_extent(kernel_sharpness),
+            overgrid_factor=float(self.config.recon.overgrid_factor),
+            kernel_type=str(self.config.recon.kernel_type),
+            deapodize=bool(self.config.recon.deapodize),
+            recon_key=recon_key or str(self.config.recon.recon_key),
+            n_cs_iter=int(self.config.recon.n_cs_iter),
+            cs_lambda=float(self.config.recon.cs_lambda),
+            image_size=int(self.config.recon.recon_size),
+            matrix_size=int(self.config.recon.matrix_size),
+            upsample_method=str(self.config.recon.upsample_method),
+            n_threads=int(self.config.recon.n_threads),
+            max_matrix_gb=float(self.config.recon.max_matrix_gb),
+            chunk_size=int(self.config.recon.chunk_projections) * data.shape[1],
+            dcf_init=(
+                dcf.radial_density_estimate(traj)
+                if self.config.recon.dcf_warm_start
+                else None
+            ),
+            dcf_tolerance=float(self.config.recon.dcf_tolerance),
+            dcf_dtype=np.float32 if self.config.recon.dcf_float32 else self.real_dtype,
+            matrix_dtype=self.real_dtype,
+            neighborhood_cache=self.neighborhood_cache if share_neighborhood else None,
+            disk_cache=self.disk_cache,
+            presort_samples=bool(self.config.recon.presort_samples),
+        )
+
     def reconstruction_ute(self):
         """Reconstruct the UTE image."""
-        if self.config.recon.recon_key == constants.ReconKey.ROBERTSON.value:
-            self.image_proton = reconstruction.reconstruct(
-                data=(recon_utils.flatten_data(self.data_ute)),
-                traj=recon_utils.flatten_traj(self.traj_ute),
+        if self.config.recon.recon_key in [
+            constants.ReconKey.ROBERTSON.value,
+            constants.ReconKey.PLUMMER.value,
+        ]:
+            self.image_proton = self._reconstruct(
+                data=self.data_ute,
+                traj=self.traj_ute,
                 kernel_sharpness=float(self.config.recon.kernel_sharpness_hr),
-                kernel_extent=9 * float(self.config.recon.kernel_sharpness_hr),
-                image_size=int(self.config.recon.recon_size),
             )
             orientation = self.dict_ute[constants.IOFields.ORIENTATION]
-        elif self.config.recon.recon_key == constants.ReconKey.PLUMMER.value:
-            raise NotImplementedError("Plummer CS reconstruction not implemented.")
         else:
             raise ValueError("Unknown reconstruction key")
-        self.image_proton = img_utils.interp(
-            self.image_proton,
-            self.config.recon.matrix_size // self.config.recon.recon_size,
-        )
         self.image_proton = img_utils.flip_and_rotate_image(
             self.image_proton,
             orientation=orientation,
@@ -303,38 +421,52 @@ class Subject(object):
 
     def reconstruction_gas(self):
         """Reconstruct the gas phase image."""
-        if self.config.recon.recon_key == constants.ReconKey.ROBERTSON.value:
-            self.image_gas_highsnr = reconstruction.reconstruct(
-                data=(recon_utils.flatten_data(self.data_gas)),
-                traj=recon_utils.flatten_traj(self.traj_gas),
-                kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
-                kernel_extent=9 * float(self.config.recon.kernel_sharpness_lr),
-                image_size=int(self.config.recon.recon_size),
+        if self.config.recon.recon_key in [
+            constants.ReconKey.ROBERTSON.value,
+            constants.ReconKey.PLUMMER.value,
+        ]:
+            data = [self.data_gas]
+            batch_dissolved = np.array_equal(self.traj_gas, self.traj_dissolved)
+            if batch_dissolved:
+                # the dissolved image uses the same kernel, grid both at once
+                data.append(self.data_dissolved)
+            batch_subdivisions = (
+                self.config.bias_key == constants.BiasfieldKey.RF_DEPOLARIZATION.value
+                and self.config.recon.recon_key == constants.ReconKey.ROBERTSON.value
             )
-            self.image_gas_highreso = reconstruction.reconstruct(
-                data=(recon_utils.flatten_data(self.data_gas)),
-                traj=recon_utils.flatten_traj(self.traj_gas),
-                kernel_sharpness=float(self.config.recon.kernel_sharpness_hr),
-                kernel_extent=9 * float(self.config.recon.kernel_sharpness_hr),
-                image_size=int(self.config.recon.recon_size),
+            if batch_subdivisions:
+                # the temporal halves are gridded with the rows of the gas matrix
+                data += recon_utils.get_temporal_subdivisions(self.data_gas)
+            images = self._reconstruct(
+                data=np.stack(data, axis=-1),
+                traj=self.traj_gas,
+                kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
             )
+            images = images.reshape(images.shape[:3] + (-1,))
+            self.image_gas_highsnr = images[..., 0]
+            if batch_dissolved:
+                self.image_dissolved_batched = images[..., 1]
+            if batch_subdivisions:
+                self.image_gas_subdivisions_batched = images[..., -2:]
+            if (
+                self.config.recon.kernel_type
+                == constants.KernelType.KAISERBESSEL.value
+            ):
+                # the kernel sharpness is not used, both images are the same
+                self.image_gas_highreso = self.image_gas_highsnr.copy()
+            else:
+                self.image_gas_highreso = self._reconstruct(
+                    data=self.data_gas,
+                    traj=self.traj_gas,
+                    kernel_sharpness=float(self.config.recon.kernel_sharpness_hr),
+                )
             orientation = self.dict_dis[constants.IOFields.ORIENTATION]
-        elif self.config.recon.recon_key == constants.ReconKey.PLUMMER.value:
-            raise NotImplementedError("Plummer CS reconstruction not implemented.")
         else:
             raise ValueError(
                 f"Unknown reconstruction key: {self.config.recon.recon_key}"
             )
 
 
-        self.image_gas_highreso = img_utils.interp(
-            self.image_gas_highreso,
-            self.config.recon.matrix_size // self.config.recon.recon_size,
-        )
-        self.image_gas_highsnr = img_utils.interp(
-            self.image_gas_highsnr,
-            self.config.recon.matrix_size // self.config.recon.recon_size,
-        )
         self.image_gas_highsnr = img_utils.flip_and_rotate_image(
             self.image_gas_highsnr,
             orientation=orientation,
@@ -346,25 +478,53 @@ class Subject(object):
         io_utils.export_nii(np.abs(self.image_gas_highsnr), "tmp/image_gas_highsnr.nii")
         io_utils.export_nii(np.abs(self.image_gas_highreso), "tmp/image_gas_highreso.nii")
 
+    def reconstruction_gas_subdivisions(self):
+        """Reconstruct the gas images of the first and second halves of the scan.
+
+        Each half zeroes the projections acquired in the other half, so that it is
+        gridded with its rows of the system matrix and dcf of the gas trajectory.
+        With the ROBERTSON reconstruction, the halves are gridded in the same pass
+        as the gas image. With the PLUMMER reconstruction, the iterative solve
+        models all the projections, so the halves are gridded separately with the
+        ROBERTSON reconstruction. They only set the bias field ratio, and both
+        halves are gridded the same way.
+        """
+        if self.image_gas_subdivisions_batched.size > 0:
+            # reconstructed together with the gas image
+            images = self.image_gas_subdivisions_batched
+        else:
+            images = self._reconstruct(
+                data=np.stack(
+                    recon_utils.get_temporal_subdivisions(self.data_gas), axis=-1
+                ),
+                traj=self.traj_gas,
+                kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
+                recon_key=constants.ReconKey.ROBERTSON.value,
+            )
+        orientation = self.dict_dis[constants.IOFields.ORIENTATION]
+        self.image_gas_first_half, self.image_gas_second_half = [
+            img_utils.flip_and_rotate_image(images[..., i], orientation=orientation)
+            for i in range(2)
+        ]
+
     def reconstruction_dissolved(self):
         """Reconstruct the dissolved phase image."""
-        if self.config.recon.recon_key == constants.ReconKey.ROBERTSON.value:
-            self.image_dissolved = reconstruction.reconstruct(
-                data=(recon_utils.flatten_data(self.data_dissolved)),
-                traj=recon_utils.flatten_traj(self.traj_dissolved),
+        if self.image_dissolved_batched.size > 0:
+            # reconstructed together with the gas image
+            self.image_dissolved = self.image_dissolved_batched
+            orientation = self.dict_dis[constants.IOFields.ORIENTATION]
+        elif self.config.recon.recon_key in [
+            constants.ReconKey.ROBERTSON.value,
+            constants.ReconKey.PLUMMER.value,
+        ]:
+            self.image_dissolved = self._reconstruct(
+                data=self.data_dissolved,
+                traj=self.traj_dissolved,
                 kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
-                kernel_extent=9 * float(self.config.recon.kernel_sharpness_lr),
-                image_size=int(self.config.recon.recon_size),
             )
             orientation = self.dict_dis[constants.IOFields.ORIENTATION]
-        elif self.config.recon.recon_key == constants.ReconKey.PLUMMER.value:
-            raise NotImplementedError("Plummer CS reconstruction not implemented.")
         else:
             raise ValueError("Unknown reconstruction key")
-        self.image_dissolved = img_utils.interp(
-            self.image_dissolved,
-            self.config.recon.matrix_size // self.config.recon.recon_size,
-        )
         self.image_dissolved = img_utils.flip_and_rotate_image(
             self.image_dissolved,
             orientation=orientation,
@@ -373,6 +533,109 @@ class Subject(object):
         # This should give us image_dissolved.nii (Haad !!!)
         # io_utils.export_nii(np.abs(self.image_dissolved), "tmp/image_dissolved.nii")
 
+    def reconstruction_rbc_oscillation(self):
+        """Reconstruct the keyhole high and low RBC images and the total image.
+
+        The dissolved projections are binned by the cardiac phase of their k0 RBC
+        signal, assuming that the projections are evenly spaced by TR. The key of
+        each bin replaces the k-space center of the data, and the high, low and
+        total images are gridded in one pass with the system matrix and dcf of the
+        dissolved trajectory.
+        """
+        data_rbc, _ = signal_utils.dixon_decomposition(
+            data_dissolved=self.data_dissolved, rbc_m_ratio=self.rbc_m_ratio
+        )
+        phase = signal_utils.get_oscillation_phase(
+            data_rbc_k0=data_rbc[:, 0], tr=float(self.dict_dis[constants.IOFields.TR])
+        )
+        high_indices, low_indices = signal_utils.get_oscillation_bins(phase)
+        logging.info(
+            "Binned {} high and {} low RBC projections.".format(
+                len(high_indices), len(low_indices)
+            )
+        )
+        key_radius = int(self.config.recon.key_radius)
+        data = np.stack(
+            [
+                recon_utils.apply_keyhole(self.data_dissolved, key_radius, indices)
+                for indices in [high_indices, low_indices]
+            ]
+            + [self.data_dissolved],
+            axis=-1,
+        )
+        images = self._reconstruct(
+            data=data,
+            traj=self.traj_dissolved,
+            kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
+        )
+        orientation = self.dict_dis[constants.IOFields.ORIENTATION]
+        images = [
+            img_utils.flip_and_rotate_image(images[..., i], orientation=orientation)
+            for i in range(3)
+        ]
+        (
+            self.image_dissolved_high,
+            self.image_dissolved_low,
+            self.image_dissolved_total,
+        ) = images
+
+    def preview_reconstruction(self):
+        """Reconstruct low resolution gas and dissolved images and save a montage.
+
+        The images are reconstructed at config.recon.preview_size with the field of
+        view of the full reconstruction: the trajectory is rescaled to the preview
+        grid and the readout points beyond its k-space edge are dropped. A
+        Kaiser-Bessel kernel on a twice overgridded grid keeps the gridding cheap,
+        and the dcf starts from the radial density estimate and is shared through
+        the disk cache.
+        """
+        preview_size = int(self.config.recon.preview_size)
+        scale = float(self.config.recon.recon_size) / preview_size
+        if np.array_equal(self.traj_gas, self.traj_dissolved):
+            groups = [
+                (np.stack([self.data_gas, self.data_dissolved], axis=-1), self.traj_gas)
+            ]
+        else:
+            groups = [
+                (self.data_gas, self.traj_gas),
+                (self.data_dissolved, self.traj_dissolved),
+            ]
+        images = []
+        for data, traj in groups:
+            traj = traj * scale
+            # readout points inside the preview k-space
+            n_points = int(np.sum(np.max(np.abs(traj), axis=(0, 2)) <= 0.5))
+            image = reconstruction.reconstruct(
+                data=recon_utils.flatten_data(data[:, :n_points]),
+                traj=recon_utils.flatten_traj(traj[:, :n_points]),
+                kernel_extent=2.0,
+                overgrid_factor=2.0,
+                kernel_type=constants.KernelType.KAISERBESSEL.value,
+                matrix_dtype=self.real_dtype,
+                deapodize=bool(self.config.recon.deapodize),
+                image_size=preview_size,
+                dcf_init=dcf.radial_density_estimate(traj[:, :n_points]),
+                dcf_tolerance=5e-3,
+                dcf_dtype=self.real_dtype,
+                n_threads=int(self.config.recon.n_threads),
+                disk_cache=self.disk_cache,
+                presort_samples=bool(self.config.recon.presort_samples),
+                verbosity=False,
+            )
+            image = image.reshape(image.shape[:3] + (-1,))
+            images += [image[..., i] for i in range(image.shape[-1])]
+        orientation = self.dict_dis[constants.IOFields.ORIENTATION]
+        output_path = os.path.join(str(self.config.data_dir), "output")
+        os.makedirs(output_path, exist_ok=True)
+        plot.plot_montage_preview(
+            images=[
+                np.abs(img_utils.flip_and_rotate_image(image, orientation=orientation))
+                for image in images
+            ],
+            path=os.path.join(output_path, "montage_preview.png"),
+        )
+        logging.info("Saved the preview montage to {}".format(output_path))
+
     def segmentation(self):
         """Segment the thoracic cavity."""
         if self.config.segmentation_key == constants.SegmentationKey.CNN_VENT.value:
@@ -458,7 +721,9 @@ class Subject(object):
         if self.config.bias_key == constants.BiasfieldKey.SKIP.value:
             logging.info("Skipping bias field correction.")
             self.image_gas_cor = abs(self.image_gas_highreso)
-            self.image_biasfield = np.ones(self.image_gas_highreso.shape)
+            self.image_biasfield = np.ones(
+                self.image_gas_highreso.shape, dtype=self.real_dtype
+            )
         elif self.config.bias_key == constants.BiasfieldKey.N4ITK.value:
             print(f"image (gas_highreso) dims before correction: {np.shape(self.image_gas_highreso)}")
             logging.info("Performing N4ITK bias field correction.")
@@ -470,6 +735,23 @@ class Subject(object):
                 mask=self.mask.astype(bool),
             )
             print(f"image (gas_highreso) dims after correction: {np.shape(self.image_gas_cor)}")
+        elif (
+            self.config.bias_key == constants.BiasfieldKey.RF_DEPOLARIZATION.value
+        ):
+            logging.info("Performing RF-depolarization bias field correction.")
+            if self.image_gas_first_half.size == 1:
+                # the temporal halves were not reconstructed by the pipeline
+                self.reconstruction_gas_subdivisions()
+            (
+                self.image_gas_cor,
+                self.image_biasfield,
+            ) = biasfield.correct_biasfield_rf(
+                image=abs(self.image_gas_highreso),
+                image1=abs(self.image_gas_first_half),
+                image2=abs(self.image_gas_second_half),
+                mask=self.mask.astype(bool),
+                n_proj=self.data_gas.shape[0],
+            )
         else:
             raise ValueError("Invalid bias field correction key.")
 
@@ -494,6 +776,40 @@ class Subject(object):
             rbc_m_ratio=self.rbc_m_ratio,
         )
 
+    def rbc_oscillation_analysis(self):
+        """Calculate the RBC oscillation image from the keyhole images.
+
+        The dixon rotation of the total image is applied to the high and low images,
+        so that the RBC signal of each bin keeps its own RBC:M split.
+        """
+        rotation = img_utils.get_dixon_rotation(
+            image_gas=self.image_gas_highsnr,
+            image_dissolved=self.image_dissolved_total,
+            mask=self.mask_vent,
+            rbc_m_ratio=self.rbc_m_ratio,
+        )
+        image_rbc_high, image_rbc_low, image_rbc_total = [
+            img_utils.dixon_decomposition(
+                image_gas=self.image_gas_highsnr,
+                image_dissolved=image,
+                mask=self.mask_vent,
+                rbc_m_ratio=self.rbc_m_ratio,
+                rotation=rotation,
+            )[0]
+            for image in [
+                self.image_dissolved_high,
+                self.image_dissolved_low,
+                self.image_dissolved_total,
+            ]
+        ]
+        self.image_rbc_osc = img_utils.calculate_rbc_oscillation(
+            image_high=image_rbc_high,
+            image_low=image_rbc_low,
+            image_total=image_rbc_total,
+            mask=self.mask_vent,
+        )
+        io_utils.export_nii(self.image_rbc_osc * self.mask_vent, "tmp/rbc_osc.nii")
+
     def hb_correction(self):
         """Apply hemoglobin correction."""
         if self.config.hb_correction_key != constants.HbCorrectionKey.NONE.value:
@@ -555,15 +871,12 @@ class Subject(object):
             constants.T2STAR_MEMBRANE_3T,
             self.dict_dis[constants.IOFields.FIELD_STRENGTH],
         )
-        self.image_rbc2gas = (
-            flip_angle_scale_factor * t2star_scale_factor_rbc * self.image_rbc2gas
-        )
+        # scale in place to keep the precision of the images
+        self.image_rbc2gas *= flip_angle_scale_factor * t2star_scale_factor_rbc
         logging.info("Processed image_rbc2gas")
 
-        self.image_membrane2gas = (
-            flip_angle_scale_factor
-            * t2star_scale_factor_membrane
-            * self.image_membrane2gas
+        self.image_membrane2gas *= (
+            flip_angle_scale_factor * t2star_scale_factor_membrane
         )
         logging.info("Processed image_membrane2gas")
 
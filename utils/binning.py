@@ -25,7 +25,7 @@ def linear_bin(
         corresponds to the region outside the mask. A value of i > 0 correspond to
         the bin number i.
     """
-    image_binned = np.zeros(image.shape)
+    image_binned = np.zeros(image.shape, dtype=image.dtype)
     n = len(thresholds)
     left, right = -1, 0
     while right < n + 1:
@@ -0,0 +1,311 @@
+"""On-disk cache util functions.
+
+Trajectories, system matrices and density compensation filters only depend on the
+acquisition protocol and the reconstruction settings, so they are shared between
+subjects through a content-addressed cache directory. Each entry is a directory of
+.npy files that is memory-mapped when read. Entries are written to a temporary
+directory and renamed into place, so concurrent writers from parallel batch jobs
+never expose a partial entry.
+
+Parsed raw data files are kept in a sidecar directory next to each file, keyed by
+the size, modification time and content of the file, so that reruns of a subject
+skip parsing.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import scipy.sparse as sps
+
+# bump when the layout of the cached entries changes
+CACHE_VERSION = "1"
+# suffix of the sidecar directory of a raw data file
+SIDECAR_SUFFIX = ".cache"
+# name of the metadata file of a sidecar
+_SIDECAR_METADATA = "metadata.json"
+
+
+def hash_key(*parts: Any) -> str:
+    """Hash arrays and scalars into a cache key.
+
+    Args:
+        parts: arrays and scalars that fully determine the cached quantity.
+
+    Returns:
+        Hexadecimal sha1 digest of the parts.
+    """
+    hasher = hashlib.sha1(CACHE_VERSION.encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            hasher.update(str((part.dtype.str, part.shape)).encode())
+            hasher.update(np.ascontiguousarray(part).data)
+        else:
+            hasher.update(repr(part).encode())
+        hasher.update(b"|")
+    return hasher.hexdigest()
+
+
+class DiskCache(object):
+    """Content-addressed cache of numpy arrays on disk.
+
+    Attributes:
+        cache_dir (str): path to the cache directory.
+        max_size (int): maximum size of the cache in bytes. The least recently used
+            entries are removed once the cache is larger.
+    """
+
+    def __init__(self, cache_dir: str, max_size_gb: float = 20.0):
+        """Initialize the cache.
+
+        Args:
+            cache_dir (str): path to the cache directory.
+            max_size_gb (float): maximum size of the cache in GB.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1e9)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key: str) -> str:
+        """Return the directory of a cache entry."""
+        return os.path.join(self.cache_dir, key)
+
+    def _tmp_dir(self, key: str) -> str:
+        """Return a unique temporary directory in the cache directory."""
+        return os.path.join(
+            self.cache_dir, ".tmp-{}-{}-{}".format(key, os.getpid(), uuid.uuid4().hex)
+        )
+
+    def load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """Load a cache entry.
+
+        Args:
+            key (str): cache key.
+
+        Returns:
+            Dictionary of read-only memory-mapped arrays, or None on a cache miss.
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            names = os.listdir(entry_dir)
+            arrays = {
+                os.path.splitext(name)[0]: np.load(
+                    os.path.join(entry_dir, name), mmap_mode="r"
+                )
+                for name in names
+            }
+            # mark as recently used for the eviction
+            os.utime(entry_dir)
+        except (OSError, ValueError):
+            # missing or being evicted by another process
+            return None
+        return arrays
+
+    def save(self, key: str, arrays: Dict[str, np.ndarray]):
+        """Save a cache entry.
+
+        If another process saved the same entry first, its copy is kept.
+
+        Args:
+            key (str): cache key.
+            arrays (dict): arrays to save.
+        """
+        tmp_dir = self._tmp_dir(key)
+        os.makedirs(tmp_dir)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_dir, name + ".npy"), array)
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # the entry already exists or the disk is full
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits max_size."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            try:
+                if name.startswith(".tmp-"):
+                    # leftovers of writers that were killed
+                    if time.time() - os.path.getmtime(entry_dir) > 24 * 3600:
+                        shutil.rmtree(entry_dir, ignore_errors=True)
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(entry_dir, file))
+                    for file in os.listdir(entry_dir)
+                )
+                entries.append((os.path.getmtime(entry_dir), size, name))
+            except FileNotFoundError:
+                continue
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            # rename first so that readers never see a partially removed entry
+            tmp_dir = self._tmp_dir(name)
+            try:
+                os.rename(self._entry_dir(name), tmp_dir)
+            except OSError:
+                continue
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            total_size -= size
+            logging.info("Evicted cache entry {}".format(name))
+
+    def load_csr(self, key: str) -> Optional[sps.csr_matrix]:
+        """Load a sparse matrix saved with save_csr.
+
+        Args:
+            key (str): cache key.
+
+        Returns:
+            Sparse matrix backed by read-only memory-mapped arrays, or None on a
+            cache miss.
+        """
+        arrays = self.load(key)
+        if arrays is None:
+            return None
+        return sps.csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]),
+            shape=tuple(int(n) for n in arrays["shape"]),
+            copy=False,
+        )
+
+    def save_csr(self, key: str, matrix: sps.csr_matrix):
+        """Save a sparse matrix.
+
+        Args:
+            key (str): cache key.
+            matrix (sps.csr_matrix): sparse matrix.
+        """
+        self.save(
+            key,
+            {
+                "data": matrix.data,
+                "indices": matrix.indices,
+                "indptr": matrix.indptr,
+                "shape": np.array(matrix.shape),
+            },
+        )
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    """Hash the content of a file.
+
+    Args:
+        path (str): path to the file.
+        block_size (int): number of bytes read at a time.
+
+    Returns:
+        Hexadecimal sha1 digest of the file.
+    """
+    hasher = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def file_key(path: str) -> Dict[str, Any]:
+    """Get the key of a file from its size, modification time and content.
+
+    Args:
+        path (str): path to the file.
+
+    Returns:
+        Dictionary of the size in bytes, modification time in ns and content hash.
+    """
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha1": hash_file(path),
+    }
+
+
+def _json_default(value: Any) -> Any:
+    """Convert numpy scalars to python scalars for json."""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Cannot save {} to a sidecar.".format(type(value)))
+
+
+def load_sidecar(
+    path: str,
+) -> Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any]]]:
+    """Load the sidecar of a raw data file.
+
+    The content of the file is only hashed if its size and modification time match
+    the sidecar.
+
+    Args:
+        path (str): path to the raw data file.
+
+    Returns:
+        Tuple of the read-only memory-mapped arrays and of the metadata, or None if
+            there is no sidecar or the file changed since it was written.
+    """
+    sidecar_dir = path + SIDECAR_SUFFIX
+    try:
+        with open(os.path.join(sidecar_dir, _SIDECAR_METADATA), "r") as f:
+            sidecar = json.load(f)
+        stat = os.stat(path)
+        key = sidecar["key"]
+        if (
+            sidecar["version"] != CACHE_VERSION
+            or key["size"] != stat.st_size
+            or key["mtime_ns"] != stat.st_mtime_ns
+            or key["sha1"] != hash_file(path)
+        ):
+            return None
+        arrays = {
+            name: np.load(os.path.join(sidecar_dir, name + ".npy"), mmap_mode="r")
+            for name in sidecar["arrays"]
+        }
+    except (OSError, ValueError, KeyError):
+        # missing, stale or being replaced by another process
+        return None
+    return arrays, sidecar["metadata"]
+
+
+def save_sidecar(path: str, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]):
+    """Save the sidecar of a raw data file.
+
+    An existing sidecar is replaced. Failures, e.g. in a read-only data directory,
+    are logged and otherwise ignored.
+
+    Args:
+        path (str): path to the raw data file.
+        arrays (dict): arrays parsed from the file.
+        metadata (dict): json serializable metadata parsed from the file.
+    """
+    sidecar_dir = path + SIDECAR_SUFFIX
+    tmp_dir = "{}.tmp-{}-{}".format(sidecar_dir, os.getpid(), uuid.uuid4().hex)
+    try:
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), np.ascontiguousarray(array))
+        with open(os.path.join(tmp_dir, _SIDECAR_METADATA), "w") as f:
+            json.dump(
+                {
+                    "version": CACHE_VERSION,
+                    "key": file_key(path),
+                    "arrays": list(arrays.keys()),
+                    "metadata": metadata,
+                },
+                f,
+                default=_json_default,
+            )
+        shutil.rmtree(sidecar_dir, ignore_errors=True)
+        os.rename(tmp_dir, sidecar_dir)
+    except (OSError, TypeError) as e:
+        logging.warning("Could not save the sidecar of {}: {}".format(path, e))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -115,12 +115,27 @@ class RegistrationKey(enum.Enum):
     SKIP = "skip"
 
 
+class Precision(enum.Enum):
+    """Floating point precision of the pipeline.
+
+    Defines the precision of the raw data, trajectories, system matrix, dcf and
+    images from the raw data read to the binning. Options:
+    DOUBLE: complex128 and float64.
+    SINGLE: complex64 and float32. Sums over the lung volume accumulate in float64.
+    """
+
+    DOUBLE = "double"
+    SINGLE = "single"
+
+
 class BiasfieldKey(enum.Enum):
     """Biasfield correction flags.
 
     Defines how and if biasfield correction is performed. Options:
     N4ITK: Use N4ITK bias field correction.
     SKIP: Skip bias field ocrrection entirely.
+    RF_DEPOLARIZATION: Use the flip angle map from the RF depolarization between the
+        images of the first and second halves of the gas acquisition.
     """
 
     N4ITK = "n4itk"
@@ -133,13 +148,55 @@ class ReconKey(enum.Enum):
 
     Options:
     ROBERTSON: scott recon
-    PLUMMER: joey p. recon
+    PLUMMER: joey p. recon, iterative compressed sensing with a Toeplitz normal
+        operator
     """
 
     ROBERTSON = "robertson"
     PLUMMER = "plummer"
 
 
+class KernelType(enum.Enum):
+    """Gridding kernel type.
+
+    Options:
+    GAUSSIAN: gaussian kernel, needs an overgrid factor of about 3
+    KAISERBESSEL: Kaiser-Bessel kernel, for overgrid factors of about 1.25-2
+    """
+
+    GAUSSIAN = "gaussian"
+    KAISERBESSEL = "kaiser_bessel"
+
+
+class FFTBackend(enum.Enum):
+    """FFT backend.
+
+    Options:
+    NUMPY: numpy.fft, single-threaded
+    SCIPY: scipy.fft, multi-threaded
+    PYFFTW: pyFFTW with cached plans and wisdom, if installed
+    """
+
+    NUMPY = "numpy"
+    SCIPY = "scipy"
+    PYFFTW = "pyfftw"
+
+
+class UpsampleMethod(enum.Enum):
+    """Upsampling of the reconstructed images to the matrix size.
+
+    Options:
+    FOURIER: zero-pad k-space. Voxel n/2 of the reconstructed image stays at voxel
+        N/2 of the output
+    ZOOM: cubic spline zoom, which aligns the corner voxels instead. The output is
+        shifted by about half an output voxel from FOURIER. Reproduces the voxel
+        grid of earlier versions, e.g. for manual masks drawn on their images
+    """
+
+    FOURIER = "fourier"
+    ZOOM = "zoom"
+
+
 class HbCorrectionKey(enum.Enum):
     """Hb correction flags.
 
@@ -0,0 +1,321 @@
+"""FFT util functions.
+
+All FFTs of the reconstruction and spectroscopy go through this module, so that the
+backend is selected in one place. The scipy backend is multi-threaded, and pyFFTW is
+used if it is installed and selected, with its plans cached in memory and its wisdom
+cached on disk. Centered transforms of even-sized axes replace the fftshifts by a
+checkerboard modulation applied in place.
+"""
+
+import functools
+import logging
+import os
+import pickle
+import sys
+from typing import Optional, Sequence
+
+import numpy as np
+import scipy.fft
+
+sys.path.append("..")
+from utils import constants
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+
+# settings of the FFTs, set with configure
+_settings = {
+    "backend": constants.FFTBackend.SCIPY.value,
+    "workers": -1,
+    "complex64": False,
+    "wisdom_path": "",
+}
+# wisdom last read from or written to the wisdom file
+_saved_wisdom = {"wisdom": None}
+
+
+def configure(
+    backend: str = constants.FFTBackend.SCIPY.value,
+    n_threads: int = 0,
+    complex64: bool = False,
+    wisdom_path: str = "",
+):
+    """Set the FFT backend.
+
+    Args:
+        backend (str): FFT backend, see constants.FFTBackend. Falls back to scipy if
+            pyFFTW is selected but not installed.
+        n_threads (int): number of threads of the FFTs. 0 uses all available threads.
+        complex64 (bool): compute the centered image transforms in single precision.
+        wisdom_path (str): path to the pyFFTW wisdom file. Empty string does not
+            cache the wisdom.
+    """
+    if backend not in [b.value for b in constants.FFTBackend]:
+        raise ValueError(f"Unknown FFT backend: {backend}")
+    if backend == constants.FFTBackend.PYFFTW.value and pyfftw is None:
+        logging.warning("pyFFTW is not installed, using the scipy FFT backend.")
+        backend = constants.FFTBackend.SCIPY.value
+    _settings["backend"] = backend
+    _settings["workers"] = n_threads if n_threads > 0 else -1
+    _settings["complex64"] = complex64
+    _settings["wisdom_path"] = wisdom_path
+    if backend == constants.FFTBackend.PYFFTW.value:
+        pyfftw.interfaces.cache.enable()
+        _load_wisdom()
+
+
+def _load_wisdom():
+    """Import the pyFFTW wisdom from the wisdom file."""
+    if not _settings["wisdom_path"] or not os.path.exists(_settings["wisdom_path"]):
+        return
+    try:
+        with open(_settings["wisdom_path"], "rb") as f:
+            wisdom = pickle.load(f)
+        pyfftw.import_wisdom(wisdom)
+        _saved_wisdom["wisdom"] = wisdom
+    except (OSError, pickle.UnpicklingError, ValueError):
+        logging.warning("Could not read the FFTW wisdom file, replanning.")
+
+
+def _save_wisdom():
+    """Export the pyFFTW wisdom to the wisdom file if new plans were made."""
+    if not _settings["wisdom_path"]:
+        return
+    wisdom = pyfftw.export_wisdom()
+    if wisdom == _saved_wisdom["wisdom"]:
+        return
+    # write and rename so that parallel jobs never read a partial file
+    tmp_path = "{}.{}".format(_settings["wisdom_path"], os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(wisdom, f)
+        os.replace(tmp_path, _settings["wisdom_path"])
+        _saved_wisdom["wisdom"] = wisdom
+    except OSError:
+        logging.warning("Could not write the FFTW wisdom file.")
+
+
+def _transform(name: str, x: np.ndarray, overwrite_x: bool = False, **kwargs):
+    """Run a transform of scipy.fft with the selected backend.
+
+    Args:
+        name (str): name of the transform in scipy.fft, e.g. "ifftn".
+        x (np.ndarray): input array.
+        overwrite_x (bool): allow the input to be destroyed.
+        kwargs: arguments of the transform.
+
+    Returns:
+        np.ndarray: transformed array.
+    """
+    backend = _settings["backend"]
+    if backend == constants.FFTBackend.NUMPY.value:
+        return getattr(np.fft, name)(x, **kwargs)
+    if backend == constants.FFTBackend.PYFFTW.value:
+        out = getattr(pyfftw.interfaces.scipy_fft, name)(
+            x, overwrite_x=overwrite_x, workers=_settings["workers"], **kwargs
+        )
+        _save_wisdom()
+        return out
+    return getattr(scipy.fft, name)(
+        x, overwrite_x=overwrite_x, workers=_settings["workers"], **kwargs
+    )
+
+
+def fft(x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+    """Compute the 1D FFT.
+
+    Args:
+        x (np.ndarray): input array.
+        n (int): length of the transformed axis, zero-padded or truncated.
+        axis (int): axis of the transform.
+
+    Returns:
+        np.ndarray: transformed array.
+    """
+    return _transform("fft", x, n=n, axis=axis)
+
+
+def fftn(x: np.ndarray, axes: Optional[Sequence[int]] = None) -> np.ndarray:
+    """Compute the N-D FFT.
+
+    Args:
+        x (np.ndarray): input array.
+        axes (tuple): axes of the transform. None transforms all axes.
+
+    Returns:
+        np.ndarray: transformed array.
+    """
+    return _transform("fftn", x, axes=axes)
+
+
+def ifftn(x: np.ndarray, axes: Optional[Sequence[int]] = None) -> np.ndarray:
+    """Compute the N-D inverse FFT.
+
+    Args:
+        x (np.ndarray): input array.
+        axes (tuple): axes of the transform. None transforms all axes.
+
+    Returns:
+        np.ndarray: transformed array.
+    """
+    return _transform("ifftn", x, axes=axes)
+
+
+@functools.lru_cache(maxsize=8)
+def _checkerboard(shape: tuple, dtype: np.dtype) -> np.ndarray:
+    """Get the (-1)^(i + j + ...) pattern of an array shape.
+
+    Args:
+        shape (tuple): shape of the pattern, 1 along axes that are not modulated.
+        dtype (np.dtype): data type of the pattern.
+
+    Returns:
+        np.ndarray: read-only pattern of +1 and -1.
+    """
+    parity = sum(np.ogrid[tuple(slice(n) for n in shape)]) % 2
+    board = (1 - 2 * parity).astype(dtype)
+    board.setflags(write=False)
+    return board
+
+
+def _transform_centered(
+    name: str, x: np.ndarray, axes: tuple, overwrite_x: bool
+) -> np.ndarray:
+    """Run a transform between centered arrays of even-sized axes.
+
+    Shifting an even axis by half its length is a (-1)^k modulation in the other
+    domain, so the shifts are replaced by multiplying the input and the output by a
+    checkerboard in place.
+
+    Args:
+        name (str): name of the transform in scipy.fft, "fftn" or "ifftn".
+        x (np.ndarray): centered input array.
+        axes (tuple): axes of the transform, all of even length.
+        overwrite_x (bool): allow the input to be destroyed.
+
+    Returns:
+        np.ndarray: centered output array, in complex64 if configured.
+    """
+    dtype = np.complex64 if _settings["complex64"] else np.result_type(x, 1j)
+    shape = tuple(n if axis in axes else 1 for axis, n in enumerate(x.shape))
+    board = _checkerboard(shape, np.finfo(dtype).dtype)
+    if overwrite_x and x.dtype == dtype:
+        np.multiply(x, board, out=x)
+    else:
+        x = np.multiply(x, board, dtype=dtype)
+    out = _transform(name, x, overwrite_x=True, axes=axes)
+    # the output shift leaves a global sign of (-1)^(n / 2) per axis
+    if sum(x.shape[axis] // 2 for axis in axes) % 2:
+        np.negative(out, out=out)
+    np.multiply(out, board, out=out)
+    return out
+
+
+def fftn_centered(
+    x: np.ndarray, axes: Sequence[int] = (0, 1, 2), overwrite_x: bool = False
+) -> np.ndarray:
+    """Compute fftshift(fftn(ifftshift(x))) over the given axes.
+
+    Even axes replace the shifts by a checkerboard modulation, odd axes fall back to
+    the fftshift copies.
+
+    Args:
+        x (np.ndarray): centered image array.
+        axes (tuple): axes of the transform.
+        overwrite_x (bool): allow the input to be destroyed.
+
+    Returns:
+        np.ndarray: centered k-space array, in complex64 if configured.
+    """
+    dtype = np.complex64 if _settings["complex64"] else np.result_type(x, 1j)
+    axes = tuple(axes)
+    if any(x.shape[axis] % 2 for axis in axes):
+        return np.fft.fftshift(
+            fftn(np.fft.ifftshift(x.astype(dtype, copy=False), axes=axes), axes=axes),
+            axes=axes,
+        )
+    return _transform_centered("fftn", x, axes, overwrite_x)
+
+
+def ifftn_centered(
+    x: np.ndarray, axes: Sequence[int] = (0, 1, 2), overwrite_x: bool = False
+) -> np.ndarray:
+    """Compute ifftshift(ifftn(ifftshift(x))) over the given axes.
+
+    Even axes replace the shifts by a checkerboard modulation, odd axes fall back to
+    the fftshift copies.
+
+    Args:
+        x (np.ndarray): centered k-space array.
+        axes (tuple): axes of the transform.
+        overwrite_x (bool): allow the input to be destroyed.
+
+    Returns:
+        np.ndarray: centered image array, in complex64 if configured.
+    """
+    dtype = np.complex64 if _settings["complex64"] else np.result_type(x, 1j)
+    axes = tuple(axes)
+    if any(x.shape[axis] % 2 for axis in axes):
+        return np.fft.ifftshift(
+            ifftn(np.fft.ifftshift(x.astype(dtype, copy=False), axes=axes), axes=axes),
+            axes=axes,
+        )
+    return _transform_centered("ifftn", x, axes, overwrite_x)
+
+
+def upsample(
+    x: np.ndarray, size: int, axes: Sequence[int] = (0, 1, 2)
+) -> np.ndarray:
+    """Upsample a centered image by zero-padding its k-space.
+
+    The k-space of the image is computed with one FFT at the image size, padded to
+    the output size and transformed back, which interpolates the image with a sinc
+    kernel. The Nyquist plane of even axes is split evenly between the +-n/2
+    frequencies, so that real images stay real. Axes that already have the output
+    size are left as they are.
+
+    Voxel n/2 of the input stays at voxel size/2 of the output, the grid of the
+    centered FFT. A spline zoom such as scipy.ndimage.zoom aligns the corner voxels
+    instead, so its output is shifted by about half an output voxel from this one.
+
+    Args:
+        x (np.ndarray): centered image array.
+        size (int): output size of the upsampled axes. Must not be smaller than the
+            image size.
+        axes (tuple): axes to upsample.
+
+    Returns:
+        np.ndarray: upsampled image with the amplitude of the input image.
+    """
+    axes = tuple(axes)
+    if any(size < x.shape[axis] for axis in axes):
+        raise ValueError(f"Cannot upsample an image of shape {x.shape} to {size}.")
+    if all(size == x.shape[axis] for axis in axes):
+        return x
+    kspace = fftn_centered(x, axes=axes)
+    shape = tuple(size if axis in axes else n for axis, n in enumerate(x.shape))
+    padded = np.zeros(shape, dtype=kspace.dtype)
+    start = {axis: size // 2 - x.shape[axis] // 2 for axis in axes}
+    padded[
+        tuple(
+            slice(start[axis], start[axis] + n) if axis in axes else slice(None)
+            for axis, n in enumerate(x.shape)
+        )
+    ] = kspace
+    del kspace
+    for axis in axes:
+        if x.shape[axis] % 2 or x.shape[axis] == size:
+            # no Nyquist plane, or no room to mirror it on an axis that keeps its size
+            continue
+        nyquist = [slice(None)] * x.ndim
+        nyquist[axis] = start[axis]
+        padded[tuple(nyquist)] *= 0.5
+        mirror = list(nyquist)
+        mirror[axis] = start[axis] + x.shape[axis]
+        padded[tuple(mirror)] = padded[tuple(nyquist)]
+    out = ifftn_centered(padded, axes=axes, overwrite_x=True)
+    out *= np.prod([size / x.shape[axis] for axis in axes])
+    return out
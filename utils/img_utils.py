@@ -164,8 +164,34 @@ def smooth_image(image: np.ndarray, kernel: int = 11) -> np.ndarray:
     return ndimage.convolve(image, kernel, mode="constant")
 
 
+def smooth_image_in_mask(
+    image: np.ndarray, mask: np.ndarray, sigma: float = 8.0
+) -> np.ndarray:
+    """Smooth the image inside the mask and extrapolate it outside the mask.
+
+    The image is smoothed by normalized convolution: the gaussian blur of the masked
+    image is divided by the gaussian blur of the mask, so that the voxels outside
+    the mask and the non-finite voxels do not bias the result.
+
+    Args:
+        image (np.ndarray): 3D image to smooth.
+        mask (np.ndarray): mask of the image. Must be the same shape as the image.
+        sigma (float, optional): standard deviation of the gaussian in voxels.
+            Defaults to 8.
+    Returns:
+        Smoothed image, set to 1 where no voxel of the mask is within reach.
+    """
+    valid = np.logical_and(mask.astype(bool), np.isfinite(image))
+    weights = ndimage.gaussian_filter(valid.astype(float), sigma, mode="constant")
+    smoothed = ndimage.gaussian_filter(
+        np.where(valid, image, 0.0), sigma, mode="constant"
+    )
+    return np.divide(
+        smoothed, weights, out=np.ones_like(smoothed), where=weights > 1e-6
+    )
+
+
 def interp(img: np.ndarray, factor: int = 1):
-    print("HAAD: interpolating image / changing size !!!")
     """Interpolate the image to be of size factor times the original size.
 
     Args:
@@ -214,7 +240,7 @@ def normalize(
         # image_n[image_n > 1] = 1
         image_n = da.clip(image_n, 0, 1)
 
-        return image_n.compute()
+        return image_n.compute().astype(image.dtype, copy=False)
 
     elif method == constants.NormalizationMethods.MEAN:
         image[np.isnan(image)] = 0
@@ -242,18 +268,50 @@ def correct_b0(
     while abs(meanphase) > 1e-7:
         index = index + 1
         diffphase = np.angle(image)
-        meanphase = np.mean(diffphase[mask])  # type: ignore
-        image = np.multiply(image, np.exp(-1j * meanphase))
+        # accumulate in double precision, single precision sums do not reach 1e-7
+        meanphase = np.mean(diffphase[mask], dtype=np.float64)  # type: ignore
+        image = np.multiply(image, np.exp(-1j * meanphase).astype(image.dtype))
         if index > max_iterations:
             break
     return np.angle(image)  # type: ignore
 
 
+def get_dixon_rotation(
+    image_gas: np.ndarray,
+    image_dissolved: np.ndarray,
+    mask: np.ndarray,
+    rbc_m_ratio: float,
+) -> np.ndarray:
+    """Get the phase rotation of the 1-point dixon decomposition.
+
+    The rotation shifts the phase of the dissolved image such that its RBC:M angle
+    matches rbc_m_ratio, and removes the B0 inhomogeneity phase of the gas image.
+
+    Args:
+        image_gas (np.ndarray): gas image
+        image_dissolved (np.ndarray): dissolved image
+        mask (np.ndarray): boolean mask of the lung. must be the same size as the images.
+        rbc_m_ratio (float): RBC:m ratio
+    Returns:
+        Complex rotation of unit magnitude of the same shape as the images.
+    """
+    # correct for B0 inhomogeneity
+    diffphase = correct_b0(image_gas, mask)
+    # calculate phase shift to separate RBC and membrane
+    desired_angle = np.arctan2(rbc_m_ratio, 1.0)
+    current_angle = np.angle(np.sum(image_dissolved[mask > 0], dtype=np.complex128))
+    delta_angle = desired_angle - current_angle
+    return np.exp(1j * delta_angle).astype(image_dissolved.dtype) * np.exp(
+        1j * (-diffphase)
+    )
+
+
 def dixon_decomposition(
     image_gas: np.ndarray,
     image_dissolved: np.ndarray,
     mask: np.ndarray,
     rbc_m_ratio: float,
+    rotation: Optional[np.ndarray] = None,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """Apply 1-point dixon decomposition on images.
 
@@ -267,17 +325,20 @@ def dixon_decomposition(
         image_dissolved (np.ndarray): dissolved image
         mask (np.ndarray): boolean mask of the lung. must be the same size as the images.
         rbc_m_ratio (float): RBC:m ratio
+        rotation (np.ndarray): optional rotation from get_dixon_rotation, e.g. of the
+            total image when decomposing the keyhole images of the same acquisition.
+            None computes the rotation from image_dissolved.
     Returns:
         Tuple of decomposed RBC and membrane images respectively.
     """
-    # correct for B0 inhomogeneity
-    diffphase = correct_b0(image_gas, mask)
-    # calculate phase shift to separate RBC and membrane
-    desired_angle = np.arctan2(rbc_m_ratio, 1.0)
-    current_angle = np.angle(np.sum(image_dissolved[mask > 0]))
-    delta_angle = desired_angle - current_angle
-    image_dixon = np.multiply(image_dissolved, np.exp(1j * (delta_angle)))
-    image_dixon = np.multiply(image_dixon, np.exp(1j * (-diffphase)))
+    if rotation is None:
+        rotation = get_dixon_rotation(
+            image_gas=image_gas,
+            image_dissolved=image_dissolved,
+            mask=mask,
+            rbc_m_ratio=rbc_m_ratio,
+        )
+    image_dixon = np.multiply(image_dissolved, rotation)
     # separate RBC and membrane components
     image_rbc = (
         np.imag(image_dixon)
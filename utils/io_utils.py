@@ -1,7 +1,7 @@
 """Import and export util functions."""
 
 import logging
-from utils import constants, mrd_utils, twix_utils
+from utils import cache_utils, constants, mrd_utils, twix_reader, twix_utils
 from ml_collections import config_dict
 import scipy.io as sio
 import pandas as pd
@@ -189,11 +189,83 @@ def get_mat_file(path: str) -> str:
         raise ValueError("Can't find mat file in path.")
 
 
-def read_dyn_twix(path: str) -> Dict[str, Any]:
+def _map_twix(path: str) -> Any:
+    """Map a twix file with the native reader, or with mapVBVD if the reader fails.
+
+    The native reader raises a ValueError for twix files it does not support, e.g.
+    VB files or ramp sampling, but any other error also falls back to mapVBVD.
+
+    Args:
+        path: str file path of twix file
+    Returns: twix object, or list of twix objects if the file has several
+        measurements.
+    """
+    try:
+        return twix_reader.read_twix(path)
+    except Exception as e:
+        logging.info(
+            "Reading {} with mapVBVD, the native reader raised {}: {}".format(
+                path, type(e).__name__, e
+            )
+        )
+        return mapvbvd.mapVBVD(path)
+
+
+def _load_twix_sidecar(path: str, dtype: np.dtype) -> Optional[Dict[str, Any]]:
+    """Load the data dictionary of a twix file from its sidecar.
+
+    Args:
+        path: str file path of twix file
+        dtype: complex data type of the FIDs. The FIDs are stored as complex64, the
+            precision of the twix file, and are only copied for other types.
+    Returns: dictionary of the metadata and memory-mapped FIDs, or None if the twix
+        file has no up to date sidecar.
+    """
+    sidecar = cache_utils.load_sidecar(path)
+    if sidecar is None:
+        return None
+    arrays, metadata = sidecar
+    logging.info(
+        "Loaded parsed twix file from {}".format(path + cache_utils.SIDECAR_SUFFIX)
+    )
+    data_dict = dict(metadata)
+    for name, array in arrays.items():
+        data_dict[name] = array.astype(dtype, copy=False)
+    return data_dict
+
+
+def _save_twix_sidecar(path: str, data_dict: Dict[str, Any], fields: List[str]):
+    """Save the data dictionary of a twix file to its sidecar.
+
+    Args:
+        path: str file path of twix file
+        data_dict: dictionary containing data and metadata extracted from the twix
+            file.
+        fields: keys of the FIDs to store. Other arrays are not stored.
+    """
+    cache_utils.save_sidecar(
+        path,
+        arrays={
+            field: data_dict[field].astype(np.complex64, copy=False) for field in fields
+        },
+        metadata={
+            key: value
+            for key, value in data_dict.items()
+            if not isinstance(value, np.ndarray)
+        },
+    )
+
+
+def read_dyn_twix(
+    path: str, dtype: np.dtype = np.cdouble, use_cache: bool = False
+) -> Dict[str, Any]:
     """Read dynamic spectroscopy twix file.
 
     Args:
         path: str file path of twix file
+        dtype: complex data type of the FIDs.
+        use_cache: load the parsed file from its sidecar if it is up to date, and
+            write the sidecar otherwise.
     Returns: dictionary containing data and metadata extracted from the twix file.
     This includes:
         1. scan date in MM-DD-YYY format.
@@ -203,8 +275,12 @@ def read_dyn_twix(path: str) -> Dict[str, Any]:
         5. excitation frequency in ppm.
         6. dissolved phase FIDs in format (n_points, n_projections).
     """
+    if use_cache:
+        data_dict = _load_twix_sidecar(path, dtype)
+        if data_dict is not None:
+            return data_dict
     try:
-        twix_obj = mapvbvd.mapVBVD(path)
+        twix_obj = _map_twix(path)
     except:
         raise ValueError("Invalid twix file.")
     twix_obj.image.squeeze = True
@@ -213,13 +289,13 @@ def read_dyn_twix(path: str) -> Dict[str, Any]:
 
     # Get scan information
     sample_time = twix_utils.get_sample_time(twix_obj=twix_obj)
-    fids_dis = twix_utils.get_dyn_fids(twix_obj)
+    fids_dis = twix_utils.get_dyn_fids(twix_obj, dtype=dtype)
     xe_center_frequency = twix_utils.get_center_freq(twix_obj=twix_obj)
     xe_dissolved_offset_frequency = twix_utils.get_excitation_freq(twix_obj=twix_obj)
     scan_date = twix_utils.get_scan_date(twix_obj=twix_obj)
     tr = twix_utils.get_TR(twix_obj=twix_obj)
 
-    return {
+    data_dict = {
         constants.IOFields.SAMPLE_TIME: sample_time,
         constants.IOFields.FIDS_DIS: fids_dis,
         constants.IOFields.XE_CENTER_FREQUENCY: xe_center_frequency,
@@ -227,13 +303,22 @@ def read_dyn_twix(path: str) -> Dict[str, Any]:
         constants.IOFields.SCAN_DATE: scan_date,
         constants.IOFields.TR: tr,
     }
+    if use_cache:
+        _save_twix_sidecar(path, data_dict, [constants.IOFields.FIDS_DIS])
+    return data_dict
 
 
-def read_dis_twix(path: str) -> Dict[str, Any]:
+def read_dis_twix(
+    path: str, dtype: np.dtype = np.cdouble, use_cache: bool = False
+) -> Dict[str, Any]:
     """Read 1-point dixon disssolved phase imaging twix file.
 
     Args:
         path: str file path of twix file
+        dtype: complex data type of the FIDs.
+        use_cache: load the parsed file from its sidecar if it is up to date, and
+            write the sidecar otherwise. Only the raw FIDs are stored, the gas and
+            dissolved phase FIDs are split from them when loaded.
     Returns: dictionary containing data and metadata extracted from the twix file.
     This includes:
         - dwell time in seconds.
@@ -256,18 +341,29 @@ def read_dis_twix(path: str) -> Dict[str, Any]:
         - TE90 in seconds.
         - TR in seconds.
     """
+    if use_cache:
+        data_dict = _load_twix_sidecar(path, dtype)
+        if data_dict is not None:
+            data_dict.update(
+                twix_utils.split_gx_fids(
+                    raw_fids=data_dict[constants.IOFields.FIDS],
+                    flip_angle_dissolved=data_dict[constants.IOFields.FA_DIS],
+                    scan_date=data_dict[constants.IOFields.SCAN_DATE],
+                )
+            )
+            return data_dict
     try:
-        twix_obj = mapvbvd.mapVBVD(path)
+        twix_obj = _map_twix(path)
     except:
         raise ValueError("Invalid twix file.")
     twix_obj.image.squeeze = True
     twix_obj.image.flagIgnoreSeg = True
     twix_obj.image.flagRemoveOS = False
 
-    data_dict = twix_utils.get_gx_data(twix_obj=twix_obj)
+    data_dict = twix_utils.get_gx_data(twix_obj=twix_obj, dtype=dtype)
     filename = os.path.basename(path)
 
-    return {
+    dis_dict = {
         constants.IOFields.SAMPLE_TIME: twix_utils.get_sample_time(twix_obj),
         constants.IOFields.FA_DIS: twix_utils.get_flipangle_dissolved(twix_obj),
         constants.IOFields.FA_GAS: twix_utils.get_flipangle_gas(twix_obj),
@@ -299,19 +395,31 @@ def read_dis_twix(path: str) -> Dict[str, Any]:
             twix_obj, data_dict, filename
         ),
     }
+    if use_cache:
+        _save_twix_sidecar(path, dis_dict, [constants.IOFields.FIDS])
+    return dis_dict
 
 
-def read_ute_twix(path: str) -> Dict[str, Any]:
+def read_ute_twix(
+    path: str, dtype: np.dtype = np.cdouble, use_cache: bool = False
+) -> Dict[str, Any]:
     """Read proton ute imaging twix file.
 
     Args:
         path: str file path of twix file
+        dtype: complex data type of the FIDs.
+        use_cache: load the parsed file from its sidecar if it is up to date, and
+            write the sidecar otherwise.
     Returns: dictionary containing data and metadata extracted from the twix file.
     This includes:
         TODO
     """
+    if use_cache:
+        data_dict = _load_twix_sidecar(path, dtype)
+        if data_dict is not None:
+            return data_dict
     try:
-        twix_obj = mapvbvd.mapVBVD(path)
+        twix_obj = _map_twix(path)
     except:
         raise ValueError("Invalid twix file.")
     try:
@@ -325,9 +433,9 @@ def read_ute_twix(path: str) -> Dict[str, Any]:
         twix_obj.image.flagRemoveOS = False
     except:
         raise ValueError("Cannot get data from twix object.")
-    data_dict = twix_utils.get_ute_data(twix_obj=twix_obj)
+    data_dict = twix_utils.get_ute_data(twix_obj=twix_obj, dtype=dtype)
 
-    return {
+    ute_dict = {
         constants.IOFields.SAMPLE_TIME: twix_utils.get_sample_time(twix_obj),
         constants.IOFields.FIDS: data_dict[constants.IOFields.FIDS],
         constants.IOFields.INSTITUTION: twix_utils.get_institution_name(twix_obj),
@@ -340,13 +448,17 @@ def read_ute_twix(path: str) -> Dict[str, Any]:
         constants.IOFields.N_FRAMES: data_dict[constants.IOFields.N_FRAMES],
         constants.IOFields.ORIENTATION: twix_utils.get_orientation(twix_obj),
     }
+    if use_cache:
+        _save_twix_sidecar(path, ute_dict, [constants.IOFields.FIDS])
+    return ute_dict
 
 
-def read_dyn_mrd(path: str) -> Dict[str, Any]:
+def read_dyn_mrd(path: str, dtype: np.dtype = np.cdouble) -> Dict[str, Any]:
     """Read dynamic spectroscopy MRD file.
 
     Args:
         path: str file path of MRD file
+        dtype: complex data type of the FIDs.
     Returns: dictionary containing data and metadata extracted from the MRD file.
     This includes:
         1. scan date in MM-DD-YYY format.
@@ -363,7 +475,7 @@ def read_dyn_mrd(path: str) -> Dict[str, Any]:
         raise ValueError("Invalid mrd file.")
     # Get scan information
     sample_time = mrd_utils.get_sample_time(dataset=dataset)
-    fids_dis = mrd_utils.get_dyn_fids(dataset=dataset)
+    fids_dis = mrd_utils.get_dyn_fids(dataset=dataset, dtype=dtype)
     xe_center_frequency = mrd_utils.get_center_freq(header=header)
     xe_dissolved_offset_frequency = mrd_utils.get_excitation_freq(header=header)
     scan_date = mrd_utils.get_scan_date(header=header)
@@ -379,11 +491,12 @@ def read_dyn_mrd(path: str) -> Dict[str, Any]:
     }
 
 
-def read_dis_mrd(path: str) -> Dict[str, Any]:
+def read_dis_mrd(path: str, dtype: np.dtype = np.cdouble) -> Dict[str, Any]:
     """Read 1-point dixon disssolved phase imaging mrd file.
 
     Args:
         path: str file path of mrd file
+        dtype: complex data type of the FIDs.
     Returns: dictionary containing data and metadata extracted from the mrd file.
     This includes:
         - dwell time in seconds.
@@ -412,7 +525,7 @@ def read_dis_mrd(path: str) -> Dict[str, Any]:
     except:
         raise ValueError("Invalid mrd file.")
 
-    data_dict = mrd_utils.get_gx_data(dataset)
+    data_dict = mrd_utils.get_gx_data(dataset, dtype=dtype)
     return {
         constants.IOFields.BANDWIDTH: np.nan,
         constants.IOFields.SAMPLE_TIME: mrd_utils.get_sample_time(dataset),
@@ -443,11 +556,12 @@ def read_dis_mrd(path: str) -> Dict[str, Any]:
     }
 
 
-def read_ute_mrd(path: str) -> Dict[str, Any]:
+def read_ute_mrd(path: str, dtype: np.dtype = np.cdouble) -> Dict[str, Any]:
     """Read proton MRD file.
 
     Args:
         path (str): file path of mrd file
+        dtype: complex data type of the FIDs.
     Returns: dictionary containing data and metadata extracted from the mrd file.
     This includes:
         TODO
@@ -458,7 +572,7 @@ def read_ute_mrd(path: str) -> Dict[str, Any]:
     except:
         raise ValueError("Invalid mrd file.")
 
-    data_dict = mrd_utils.get_ute_data(dataset)
+    data_dict = mrd_utils.get_ute_data(dataset, dtype=dtype)
     return {
         constants.IOFields.SAMPLE_TIME: mrd_utils.get_sample_time(dataset),
         constants.IOFields.FIDS: data_dict[constants.IOFields.FIDS],
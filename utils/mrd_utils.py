@@ -1,7 +1,7 @@
 """MRD util functions."""
 import logging
 import sys
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 
 import ismrmrd
 import numpy as np
@@ -77,21 +77,22 @@ def get_sample_time(dataset: ismrmrd.hdf5.Dataset) -> float:
     return acq_header.sample_time_us * 1e-6
 
 
-def get_dyn_fids(dataset: ismrmrd.hdf5.Dataset, n_skip_end: int = 20) -> np.ndarray:
+def get_dyn_fids(
+    dataset: ismrmrd.hdf5.Dataset, n_skip_end: int = 20, dtype: np.dtype = np.cdouble
+) -> np.ndarray:
     """Get the dissolved phase FIDS used for dyn. spectroscopy from mrd object.
 
     Args:
         header (ismrmrd.hdf5.Dataset): MRD dataset
         n_skip_end: number of fids to skip from the end. Usually they are calibration
             frames.
+        dtype: complex data type of the FIDs.
     Returns:
         dissolved phase FIDs in shape (number of points in ray, number of projections).
     """
-    raw_fids = []
     n_projections = dataset.number_of_acquisitions() - n_skip_end
-    for i in range(0, int(n_projections)):  # type: ignore
-        raw_fids.append(dataset.read_acquisition(i).data[0].flatten())
-    return np.transpose(np.asarray(raw_fids))
+    raw_fids = read_acquisitions(dataset, dtype=dtype, stop=n_projections)[0]
+    return np.transpose(raw_fids)
 
 
 def get_excitation_freq(
@@ -305,11 +306,80 @@ def get_TR_dissolved(header: ismrmrd.xsd.ismrmrdschema.ismrmrd.ismrmrdHeader) ->
     return (tr_gas_to_dissolved + tr_dissolved_to_gas) * 1e-3
 
 
-def get_gx_data(dataset: ismrmrd.hdf5.Dataset) -> Dict[str, Any]:
+def read_acquisitions(
+    dataset: ismrmrd.hdf5.Dataset,
+    dtype: np.dtype = np.cdouble,
+    stop: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Read the acquisitions of the MRD data set in one pass.
+
+    Reads the acquisition table from the HDF5 compound dataset at once instead of
+    calling dataset.read_acquisition for each acquisition, which reads the table
+    entry of the acquisition again for its header, data and trajectory. Assumes the
+    acquisitions read have the same number of channels, samples and trajectory
+    dimensions.
+
+    Args:
+        dataset: ismrmrd dataset object
+        dtype: complex data type of the FIDs. The trajectory has the matching real
+            data type.
+        stop: number of leading acquisitions to read. If None, all acquisitions are
+            read. Acquisitions after it are neither read nor checked for their
+            shape, e.g. trailing calibration frames.
+    Returns:
+        a tuple containing
+            - fids of the first channel of shape (number of acquisitions, number of
+                points in ray)
+            - k space trajectory of shape (number of acquisitions, number of points
+                in ray, trajectory dimensions)
+            - contrast labels of shape (number of acquisitions,)
+            - bonus spectra labels (measurement uid) of shape (number of
+                acquisitions,)
+    """
+    # the acquisition table of the dataset group, see ismrmrd.hdf5.acquisition_dtype
+    acquisitions = dataset._dataset["data"][:stop]
+    header = acquisitions["head"]
+    n_acquisitions = acquisitions.shape[0]
+    n_channels = header["active_channels"][0]
+    n_samples = header["number_of_samples"][0]
+    n_dims = header["trajectory_dimensions"][0]
+    if (
+        np.any(header["active_channels"] != n_channels)
+        or np.any(header["number_of_samples"] != n_samples)
+        or np.any(header["trajectory_dimensions"] != n_dims)
+    ):
+        raise ValueError("Acquisitions of the mrd file differ in shape.")
+
+    # data and trajectory are variable length float32 arrays, data holding
+    # interleaved real and imaginary parts
+    fids = (
+        np.stack(acquisitions["data"])
+        .view(np.complex64)
+        .reshape((n_acquisitions, n_channels, n_samples))[:, 0, :]
+        .astype(dtype)
+    )
+    traj = (
+        np.stack(acquisitions["traj"])
+        .reshape((n_acquisitions, n_samples, n_dims))
+        .astype(np.finfo(dtype).dtype)
+    )
+    return (
+        fids,
+        traj,
+        np.ascontiguousarray(header["idx"]["contrast"]),
+        np.ascontiguousarray(header["measurement_uid"]),
+    )
+
+
+def get_gx_data(
+    dataset: ismrmrd.hdf5.Dataset, dtype: np.dtype = np.cdouble
+) -> Dict[str, Any]:
     """Get the FID acquisition data from dixon MRD file.
 
     Args:
         dataset: ismrmrd dataset object
+        dtype: complex data type of the FIDs. The trajectory has the matching real
+            data type.
     Returns:
         a dictionary containing
             - all raw fids of shape (number of projections for gas and dissolved phase combined,
@@ -319,32 +389,16 @@ def get_gx_data(dataset: ismrmrd.hdf5.Dataset) -> Dict[str, Any]:
             - k space trajectory of gas and dissolved acquisitions (for standard 1 pt Dixon
                 these are the same)
     """
-    # get the raw FIDs, contrast labels, and bonus spectra labels
-    raw_fids = []
-    contrast_labels = []
-    bonus_spectra_labels = []
-    n_projections = dataset.number_of_acquisitions()
-    for i in range(0, int(n_projections)):
-        acquisition_header = dataset.read_acquisition(i).getHead()
-        raw_fids.append(dataset.read_acquisition(i).data[0].flatten())
-        contrast_labels.append(acquisition_header.idx.contrast)
-        bonus_spectra_labels.append(acquisition_header.measurement_uid)
-    raw_fids = np.asarray(raw_fids)
-    contrast_labels = np.asarray(contrast_labels)
-    bonus_spectra_labels = np.asarray(bonus_spectra_labels)
+    # get the raw FIDs, trajectories, contrast labels, and bonus spectra labels
+    raw_fids, raw_traj, contrast_labels, bonus_spectra_labels = read_acquisitions(
+        dataset, dtype=dtype
+    )
 
     # remove bonus spectra
-    raw_fids_truncated = raw_fids[
-        bonus_spectra_labels == constants.BonusSpectraLabels.NOT_BONUS, :
-    ]
-    contrast_labels_truncated = contrast_labels[
-        bonus_spectra_labels == constants.BonusSpectraLabels.NOT_BONUS
-    ]
-
-    # get the trajectories
-    raw_traj = np.empty((raw_fids_truncated.shape[0], raw_fids_truncated.shape[1], 3))
-    for i in range(0, raw_fids_truncated.shape[0]):
-        raw_traj[i, :, :] = dataset.read_acquisition(i).traj
+    not_bonus = bonus_spectra_labels == constants.BonusSpectraLabels.NOT_BONUS
+    raw_fids_truncated = raw_fids[not_bonus, :]
+    contrast_labels_truncated = contrast_labels[not_bonus]
+    raw_traj = raw_traj[not_bonus, :, :]
 
     return {
         constants.IOFields.FIDS: raw_fids_truncated,
@@ -360,42 +414,30 @@ def get_gx_data(dataset: ismrmrd.hdf5.Dataset) -> Dict[str, Any]:
     }
 
 
-def get_ute_data(dataset: ismrmrd.hdf5.Dataset) -> Dict[str, Any]:
+def get_ute_data(
+    dataset: ismrmrd.hdf5.Dataset, dtype: np.dtype = np.cdouble
+) -> Dict[str, Any]:
     """Get the FID acquisition data from proton MRD file.
 
     Args:
         dataset: ismrmrd dataset object
+        dtype: complex data type of the FIDs. The trajectory has the matching real
+            data type.
     Returns:
         a dictionary containing
             - all proton fids of shape (number of projections, number of points in ray)
             - k space trajectory of proton acquisitions
     """
-    # get the raw FIDs, contrast labels, and bonus spectra labels
-    raw_fids = []
-    contrast_labels = []
-    bonus_spectra_labels = []
-    n_projections = dataset.number_of_acquisitions()
-    for i in range(0, int(n_projections)):
-        acquisition_header = dataset.read_acquisition(i).getHead()
-        raw_fids.append(dataset.read_acquisition(i).data[0].flatten())
-        contrast_labels.append(acquisition_header.idx.contrast)
-        bonus_spectra_labels.append(acquisition_header.measurement_uid)
-    raw_fids = np.asarray(raw_fids)
-    contrast_labels = np.asarray(contrast_labels)
-    bonus_spectra_labels = np.asarray(bonus_spectra_labels)
+    # get the raw FIDs, trajectories, contrast labels, and bonus spectra labels
+    raw_fids, raw_traj, contrast_labels, bonus_spectra_labels = read_acquisitions(
+        dataset, dtype=dtype
+    )
 
     # remove bonus spectra
-    raw_fids_truncated = raw_fids[
-        bonus_spectra_labels == constants.BonusSpectraLabels.NOT_BONUS, :
-    ]
-    contrast_labels_truncated = contrast_labels[
-        bonus_spectra_labels == constants.BonusSpectraLabels.NOT_BONUS
-    ]
-
-    # get the trajectories
-    raw_traj = np.empty((raw_fids_truncated.shape[0], raw_fids_truncated.shape[1], 3))
-    for i in range(0, raw_fids_truncated.shape[0]):
-        raw_traj[i, :, :] = dataset.read_acquisition(i).traj
+    not_bonus = bonus_spectra_labels == constants.BonusSpectraLabels.NOT_BONUS
+    raw_fids_truncated = raw_fids[not_bonus, :]
+    contrast_labels_truncated = contrast_labels[not_bonus]
+    raw_traj = raw_traj[not_bonus, :, :]
 
     return {
         constants.IOFields.FIDS: raw_fids_truncated[
@@ -212,6 +212,31 @@ def make_montage(image: np.ndarray, n_slices: int = 16) -> np.ndarray:
     return montage
 
 
+def plot_montage_preview(images: List[np.ndarray], path: str, n_slices: int = 16):
+    """Plot the grey scale montages of several images, one above the other.
+
+    Each image is normalized to its maximum and n_slices evenly spaced slices are
+    plotted, so that no mask is needed to select the slices. The montage is saved at
+    the image resolution without a matplotlib figure.
+
+    Args:
+        images (list): gray scale images to plot of shape (x, y, z)
+        path (str): path to save the image.
+        n_slices (int, optional): number of slices to plot. Defaults to 16.
+    """
+    montages = []
+    for image in images:
+        image = image / np.max(image)
+        indices = np.linspace(0, image.shape[2] - 1, n_slices).round().astype(int)
+        montages.append(
+            make_montage(
+                np.stack((image, image, image), axis=-1)[:, :, indices, :],
+                n_slices=n_slices,
+            )
+        )
+    plt.imsave(path, np.clip(np.concatenate(montages, axis=0), 0, 1))
+
+
 def plot_montage_grey(
     image: np.ndarray, path: str, index_start: int, index_skip: int = 1
 ):
@@ -2,7 +2,7 @@
 import sys
 
 sys.path.append("..")
-from typing import Tuple
+from typing import List, Tuple
 
 import numpy as np
 
@@ -48,16 +48,69 @@ def apply_indices_mask(
     return (data[indices], traj[indices])
 
 
+def apply_keyhole(
+    data: np.ndarray, key_radius: int, indices: np.ndarray
+) -> np.ndarray:
+    """Replace the k-space center of the data by that of a bin of projections.
+
+    The key, i.e. the first key_radius points of each projection, is kept only for
+    the projections of the bin and scaled up by the fraction of projections in the
+    bin, so that the data can be gridded with the dcf of all projections. The
+    k-space periphery is kept for all projections.
+
+    Args:
+        data (np.ndarray): k space data of shape (n_projections, n_points)
+        key_radius (int): number of points of each projection in the key.
+        indices (np.ndarray): indices of the projections in the bin.
+
+    Returns:
+        np.ndarray: keyhole data of shape (n_projections, n_points)
+    """
+    data_keyhole = np.array(data, copy=True)
+    data_keyhole[:, :key_radius] = 0
+    data_keyhole[indices, :key_radius] = (
+        data[indices, :key_radius] * data.shape[0] / max(len(indices), 1)
+    )
+    return data_keyhole
+
+
+def get_temporal_subdivisions(
+    data: np.ndarray, n_subdivisions: int = 2
+) -> List[np.ndarray]:
+    """Split the data into subdivisions of consecutive projections.
+
+    Each subdivision zeroes the projections acquired outside of it and is scaled up
+    by the fraction of projections it holds. Zeroed projections do not contribute to
+    the gridding, so the subdivision is gridded with the rows of the system matrix
+    and dcf of all projections that belong to it.
+
+    Args:
+        data (np.ndarray): k space data of shape (n_projections, n_points)
+        n_subdivisions (int): number of subdivisions.
+
+    Returns:
+        List of the data of each subdivision of shape (n_projections, n_points), in
+            the order of acquisition.
+    """
+    subdivisions = []
+    for indices in np.array_split(np.arange(data.shape[0]), n_subdivisions):
+        data_subdivision = np.zeros_like(data)
+        data_subdivision[indices] = data[indices] * data.shape[0] / len(indices)
+        subdivisions.append(data_subdivision)
+    return subdivisions
+
+
 def flatten_data(data: np.ndarray) -> np.ndarray:
     """Flatten data for reconstruction.
 
     Args:
-        data (np.ndarray): data of shape (n_projections, n_points)
+        data (np.ndarray): data of shape (n_projections, n_points), or of shape
+            (n_projections, n_points, n_images) for several images.
 
     Returns:
-        np.ndarray: flattened data of shape (n_projections * n_points, 1)
+        np.ndarray: flattened data of shape (n_projections * n_points, n_images)
     """
-    return data.reshape((data.shape[0] * data.shape[1], 1))
+    return data.reshape((data.shape[0] * data.shape[1], -1))
 
 
 def flatten_traj(traj: np.ndarray) -> np.ndarray:
@@ -69,3 +122,20 @@ def flatten_traj(traj: np.ndarray) -> np.ndarray:
         np.ndarray: flattened trajectory of shape (n_projections * n_points, 3)
     """
     return traj.reshape((traj.shape[0] * traj.shape[1], 3))
+
+
+def get_chunk_slices(n_samples: int, chunk_size: int) -> List[slice]:
+    """Split flattened samples into consecutive chunks.
+
+    Args:
+        n_samples (int): number of flattened samples.
+        chunk_size (int): number of samples per chunk. A multiple of the number of
+            points per projection keeps whole projections in each chunk.
+
+    Returns:
+        List of slices of the flattened samples.
+    """
+    return [
+        slice(start, min(start + chunk_size, n_samples))
+        for start in range(0, n_samples, chunk_size)
+    ]
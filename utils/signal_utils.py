@@ -254,6 +254,49 @@ def dixon_decomposition(
     return np.imag(rotated_data), np.real(rotated_data)
 
 
+def get_oscillation_phase(
+    data_rbc_k0: np.ndarray,
+    tr: float,
+    lowcut: float = 0.5,
+    highcut: float = 2.5,
+) -> np.ndarray:
+    """Get the cardiac phase of each projection from the k0 RBC signal.
+
+    The k0 RBC signal is detrended, bandpass filtered around the heart rate, and the
+    phase of its analytic signal is used, so that 0 is the peak of the oscillation
+    and +-pi its trough.
+
+    Args:
+        data_rbc_k0 (np.ndarray): k0 RBC signal of each projection of shape
+            (n_projections,)
+        tr (float): time between two projections in seconds.
+        lowcut (float): lowest heart rate in Hz.
+        highcut (float): highest heart rate in Hz.
+    Returns:
+        Phase of each projection in radians of shape (n_projections,)
+    """
+    data = detrend(data_rbc_k0 / np.max(np.abs(data_rbc_k0)))
+    data = bandpass(data=data, lowcut=lowcut, highcut=highcut, fs=1.0 / tr)
+    return np.angle(signal.hilbert(data))
+
+
+def get_oscillation_bins(
+    phase: np.ndarray, bin_width: float = np.pi / 2
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Bin projections into high and low RBC signal by their cardiac phase.
+
+    Args:
+        phase (np.ndarray): cardiac phase of each projection from
+            get_oscillation_phase.
+        bin_width (float): width of each bin in radians.
+    Returns:
+        Tuple of the indices of the high and low projections respectively.
+    """
+    high_indices = np.where(np.abs(phase) <= bin_width / 2)[0]
+    low_indices = np.where(np.abs(phase) >= np.pi - bin_width / 2)[0]
+    return high_indices, low_indices
+
+
 def smooth(data: np.ndarray, window_size: int = 5) -> np.ndarray:
     """Smooth response data.
 
@@ -1,5 +1,6 @@
 """Trajectory calculation util functions."""
 
+import functools
 import math
 import sys
 from typing import Callable, Tuple
@@ -7,71 +8,18 @@ from typing import Callable, Tuple
 sys.path.append("..")
 import numpy as np
 from absl import app, flags
+from numba import njit
 
 from utils import constants
 
 FLAGS = flags.FLAGS
-flags.DEFINE_integer("n_proj", 100, "number of projections per frame.")
-flags.DEFINE_string("traj_type", "halton", "trajectory type.")
 
 
 _GOLDMEAN1 = 0.465571231876768
 _GOLDMEAN2 = 0.682327803828019
 
 
-def _swap(arr: np.ndarray, i: int, j: int):
-    """Swap two elements in an array.
-
-    Args:
-        arr (np.ndarray): array
-        i (int): index of first element
-        j (int): index of second element
-    """
-    arr[i], arr[j] = arr[j], arr[i]
-
-
-def _partition(
-    ht_polar: np.ndarray, sp_polar: np.ndarray, sp_azi: np.ndarray, low: int, high: int
-) -> int:
-    """Places the pivot element at its correct position in sorted array.
-
-    Also places all smaller (smaller than pivot) to left of pivot and all greater elements
-    to right of pivot
-
-    For more details, see: https://www.geeksforgeeks.org/quick-sort/
-
-    Returns:
-        int: index of pivot element
-    """
-    pivot = ht_polar[high]
-    i = low - 1
-    for j in range(low, high):
-        if ht_polar[j] <= pivot:
-            i += 1
-            _swap(ht_polar, i, j)
-            _swap(sp_polar, i, j)
-            _swap(sp_azi, i, j)
-    _swap(ht_polar, i + 1, high)
-    _swap(sp_polar, i + 1, high)
-    _swap(sp_azi, i + 1, high)
-
-    return i + 1
-
-
-def quicksort(
-    ht_polar: np.ndarray, sp_polar: np.ndarray, sp_azi: np.ndarray, low: int, high: int
-):
-    """Sort ht_polar in ascending order. Use sorted indices to sort sp_polar and sp_azi.
-
-    Algorithm explanation: https://www.geeksforgeeks.org/quick-sort/
-
-    """
-    if low < high:
-        pi = _partition(ht_polar, sp_polar, sp_azi, low, high)
-        quicksort(ht_polar, sp_polar, sp_azi, low, pi - 1)
-        quicksort(ht_polar, sp_polar, sp_azi, pi + 1, high)
-
-
+@njit(cache=True)
 def _halton_number(index: int, base: int) -> float:
     """Calculate halton number.
 
@@ -89,11 +37,12 @@ def _halton_number(index: int, base: int) -> float:
     i = index
     while i > 0:
         f = f / base
-        result += f * math.fmod(i, base)
+        result += f * np.fmod(i, base)
         i = int(i / base)
     return result
 
 
+@njit(cache=True)
 def _halton_seq(
     arr_azimuthal_angle: np.ndarray,
     arr_polar_angle: np.ndarray,
@@ -120,6 +69,7 @@ def _halton_seq(
             arr_azimuthal_angle[linter] = phi
 
 
+@njit(cache=True)
 def _spiral_seq(
     arr_azimuthal_angle: np.ndarray,
     arr_polar_angle: np.ndarray,
@@ -146,7 +96,7 @@ def _spiral_seq(
             if llin == 0:
                 arr_azimuthal_angle[linter] = 0
             else:
-                arr_azimuthal_angle[linter] = math.fmod(
+                arr_azimuthal_angle[linter] = np.fmod(
                     dPreviousAngle
                     + 3.6 / (math.sqrt(num_totalProjections * (1.0 - dH * dH))),
                     2.0 * math.pi,
@@ -154,6 +104,7 @@ def _spiral_seq(
             dPreviousAngle = arr_azimuthal_angle[linter]
 
 
+@njit(cache=True)
 def _archimedian_seq(
     arr_azimuthal_angle: np.ndarray,
     arr_polar_angle: np.ndarray,
@@ -179,6 +130,7 @@ def _archimedian_seq(
             arr_azimuthal_angle[linter] = lk * dAngle
 
 
+@njit(cache=True)
 def _golden_mean_seq(
     arr_azimuthal_angle: np.ndarray,
     arr_polar_angle: np.ndarray,
@@ -197,10 +149,11 @@ def _golden_mean_seq(
     for lFrame in range(num_frames):
         for lk in range(num_projPerFrame):
             linter = lk + lFrame * num_projPerFrame
-            arr_polar_angle[linter] = math.acos(2.0 * math.fmod(lk * _GOLDMEAN1, 1) - 1)
-            arr_azimuthal_angle[linter] = 2 * math.pi * math.fmod(lk * _GOLDMEAN2, 1)
+            arr_polar_angle[linter] = math.acos(2.0 * np.fmod(lk * _GOLDMEAN1, 1) - 1)
+            arr_azimuthal_angle[linter] = 2 * math.pi * np.fmod(lk * _GOLDMEAN2, 1)
 
 
+@njit(cache=True)
 def _random_spiral_seq(
     arr_azimuthal_angle: np.ndarray,
     arr_polar_angle: np.ndarray,
@@ -218,9 +171,15 @@ def _random_spiral_seq(
     ht_adAzimu = np.zeros(num_projPerFrame)
     ht_adPolar = np.zeros(num_projPerFrame)
     _halton_seq(ht_adAzimu, ht_adPolar, 1, num_projPerFrame)
-    quicksort(ht_adPolar, arr_polar_angle, arr_azimuthal_angle, 0, num_projPerFrame - 1)
+    # the halton polar angles are distinct, so any sort gives the same order
+    order = np.argsort(ht_adPolar, kind="mergesort")
+    arr_polar_angle[:num_projPerFrame] = arr_polar_angle[:num_projPerFrame][order]
+    arr_azimuthal_angle[:num_projPerFrame] = arr_azimuthal_angle[:num_projPerFrame][
+        order
+    ]
 
 
+@njit(cache=True)
 def _halton_spiral_seq(
     arr_azimuthal_angle: np.ndarray,
     arr_polar_angle: np.ndarray,
@@ -262,9 +221,40 @@ def _traj_factory(traj_type: str) -> Callable:
         raise ValueError("Invalid trajectory type {}.".format(traj_type))
 
 
+@njit(cache=True)
+def _unit_vectors(
+    arr_azimuthal_angle: np.ndarray, arr_polar_angle: np.ndarray
+) -> np.ndarray:
+    """Get the unit vectors of the projection angles.
+
+    Args:
+        arr_azimuthal_angle (np.ndarray): azimuthal angle array.
+        arr_polar_angle (np.ndarray): polar angle array.
+
+    Returns:
+        np.ndarray: coordinates of shape
+        [coordinates_x + coordinates_y + coordinates z, 1]
+    """
+    num_proj = arr_polar_angle.shape[0]
+    coordinates = np.zeros(num_proj * 3)
+    for k in range(num_proj):
+        coordinates[k] = math.sin(arr_polar_angle[k]) * math.cos(
+            arr_azimuthal_angle[k]
+        )
+        coordinates[k + num_proj] = math.sin(arr_polar_angle[k]) * math.sin(
+            arr_azimuthal_angle[k]
+        )
+        coordinates[k + 2 * num_proj] = math.cos(arr_polar_angle[k])
+    return coordinates
+
+
+@functools.lru_cache(maxsize=16)
 def _gen_traj(num_projPerFrame: int, traj_type: str) -> np.ndarray:
     """Generate trajectory by trajectory type.
 
+    The coordinates are memoized per number of projections and trajectory type and
+    returned read-only, so repeated calls cost nothing.
+
     Args:
         n_ProjectionsPerFrame (int): number of projections per frame.
         traj_type (str): trajectory type.
@@ -275,19 +265,13 @@ def _gen_traj(num_projPerFrame: int, traj_type: str) -> np.ndarray:
     """
     m_adAzimuthalAngle = np.zeros(num_projPerFrame)
     m_adPolarAngle = np.zeros(num_projPerFrame)
-    coordinates = np.zeros(num_projPerFrame * 3)
     num_frames = 1
 
     _traj_factory(traj_type)(
         m_adAzimuthalAngle, m_adPolarAngle, num_frames, num_projPerFrame
     )
-
-    for k in range(num_projPerFrame):
-        coordinates[k] = math.sin(m_adPolarAngle[k]) * math.cos(m_adAzimuthalAngle[k])
-        coordinates[k + num_projPerFrame] = math.sin(m_adPolarAngle[k]) * math.sin(
-            m_adAzimuthalAngle[k]
-        )
-        coordinates[k + 2 * num_projPerFrame] = math.cos(m_adPolarAngle[k])
+    coordinates = _unit_vectors(m_adAzimuthalAngle, m_adPolarAngle)
+    coordinates.flags.writeable = False
     return coordinates
 
 
@@ -450,4 +434,8 @@ def main(argv):
 
 
 if __name__ == "__main__":
+    # defined here, as the cached numba functions import this module again as
+    # utils.traj_utils
+    flags.DEFINE_integer("n_proj", 100, "number of projections per frame.")
+    flags.DEFINE_string("traj_type", "halton", "trajectory type.")
     app.run(main)
@@ -0,0 +1,574 @@
+"""Memory-mapped reader of Siemens twix files.
+
+A native replacement of mapvbvd.mapVBVD for the VD/VE twix layout. The file is
+memory-mapped and the measurement data headers (MDH) are indexed with a vectorized
+scan, so that opening a file does not parse it in Python line by line. The ADC lines
+of the image scans are only read when the data is requested, and the protocol header
+values are only parsed when they are looked up.
+
+The returned objects mirror the parts of the mapVBVD twix object that twix_utils
+queries: the protocol buffers in hdr, and the unsorted() and [""] data of image.
+VB files, and measurements that mapVBVD would regrid for ramp sampling, are not
+supported and raise a ValueError.
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+# the multi-raid file header holds up to 64 measurement entries of 152 bytes each
+_MAX_MEASUREMENTS = 64
+_MEASUREMENT_ENTRY_DTYPE = np.dtype(
+    [
+        ("meas_id", "<u4"),
+        ("file_id", "<u4"),
+        ("offset", "<u8"),
+        ("length", "<u8"),
+        ("patient_name", "S64"),
+        ("protocol_name", "S64"),
+    ]
+)
+_SCAN_HEADER_SIZE = 192
+_CHANNEL_HEADER_SIZE = 32
+# the lowest 25 bits of the first MDH field hold the DMA length
+_DMA_LENGTH_MASK = (1 << 25) - 1
+# number of scan positions checked at once when scanning a run of equal scans
+_RUN_SIZE = 4096
+
+# bits of the first word of the MDH evaluation info mask
+_MDH_ACQEND = 1 << 0
+_MDH_RTFEEDBACK = 1 << 1
+_MDH_HPFEEDBACK = 1 << 2
+_MDH_SYNCDATA = 1 << 5
+_MDH_REFPHASESTABSCAN = 1 << 14
+_MDH_PHASESTABSCAN = 1 << 15
+_MDH_PHASCOR = 1 << 21
+_MDH_PATREFSCAN = 1 << 22
+_MDH_PATREFANDIMASCAN = 1 << 23
+_MDH_REFLECT = 1 << 24
+_MDH_NOISEADJSCAN = 1 << 25
+_MDH_NOT_IMAGE = (
+    _MDH_ACQEND
+    | _MDH_RTFEEDBACK
+    | _MDH_HPFEEDBACK
+    | _MDH_SYNCDATA
+    | _MDH_REFPHASESTABSCAN
+    | _MDH_PHASESTABSCAN
+    | _MDH_PHASCOR
+    | _MDH_NOISEADJSCAN
+)
+
+# the MDH fields that locate and sort the scans
+_MDH_DTYPE = np.dtype(
+    {
+        "names": [
+            "flags_and_dma_length",
+            "eval_info_mask",
+            "samples_in_scan",
+            "used_channels",
+            "loop_counters",
+        ],
+        "formats": ["<u4", "<u4", "<u2", "<u2", ("<u2", (14,))],
+        "offsets": [0, 40, 48, 50, 52],
+        "itemsize": _SCAN_HEADER_SIZE,
+    }
+)
+# the MDH fields read when scanning for the scan positions
+_MDH_PREFIX_DTYPE = np.dtype(
+    {
+        "names": _MDH_DTYPE.names[:4],
+        "formats": ["<u4", "<u4", "<u2", "<u2"],
+        "offsets": [0, 40, 48, 50],
+        "itemsize": 52,
+    }
+)
+# order of the MDH loop counters (Lin, Ave, Sli, Par, Eco, Phs, Rep, Set, Seg, Ida,
+# Idb, Idc, Idd, Ide) in the sorted data dimensions (Lin, Par, Sli, Ave, Phs, Eco,
+# Rep, Set, Seg, Ida, Idb, Idc, Idd, Ide)
+_SORTED_LOOP_COUNTERS = [0, 3, 2, 1, 5, 4, 6, 7, 8, 9, 10, 11, 12, 13]
+_SORTED_AVE = 3
+_SORTED_REP = 6
+_SORTED_SET = 7
+_SORTED_SEG = 8
+
+_ASCCONV = re.compile(r"### ASCCONV BEGIN[^\n]*\n(.*)\s### ASCCONV END ###", re.DOTALL)
+_REPEATED_WHITESPACE = re.compile(r"\s+")
+_QUOTES_AND_NESTED_TAGS = re.compile(r'("+)|( *<\w*> *[^\n]*)')
+
+
+def _read_records(
+    buffer: np.ndarray, positions: np.ndarray, dtype: np.dtype
+) -> np.ndarray:
+    """Read records of a structured data type at the given positions of a buffer.
+
+    Args:
+        buffer: bytes of the file of type uint8.
+        positions: byte positions of the records.
+        dtype: structured data type of the records.
+    Returns:
+        records of shape (number of positions,).
+    """
+    index = positions[:, np.newaxis] + np.arange(dtype.itemsize)
+    return buffer[index].view(dtype)[:, 0]
+
+
+def _scan_lengths(prefixes: np.ndarray) -> np.ndarray:
+    """Get the length of each scan in bytes from its MDH.
+
+    Args:
+        prefixes: MDH prefixes of type _MDH_PREFIX_DTYPE.
+    Returns:
+        length in bytes of the scan header and channel data of each scan.
+    """
+    samples = prefixes["samples_in_scan"].astype(np.int64)
+    channels = prefixes["used_channels"].astype(np.int64)
+    return _SCAN_HEADER_SIZE + (8 * samples + _CHANNEL_HEADER_SIZE) * channels
+
+
+def _scan_positions(buffer: np.ndarray, start: int) -> np.ndarray:
+    """Find the byte positions of the scans of a measurement.
+
+    The scans follow each other, so the position of a scan depends on the lengths of
+    all scans before it. Consecutive scans mostly have the same length, so from each
+    scan the positions of the following scans are predicted assuming they have its
+    length, and the MDHs at up to _RUN_SIZE predicted positions are checked at once.
+    The run ends at the first MDH that does not match, such as sync data, a scan of
+    another length or the end of the acquisition, which is then stepped over alone.
+    Sync data and everything from the end of the acquisition on are skipped as in
+    mapVBVD.
+
+    Args:
+        buffer: bytes of the file of type uint8.
+        start: byte position of the first scan.
+    Returns:
+        positions of the scans that are not sync data.
+    """
+    end = buffer.shape[0]
+    runs = []
+    position = start
+    while position + _SCAN_HEADER_SIZE <= end:
+        prefix = _read_records(buffer, np.array([position]), _MDH_PREFIX_DTYPE)
+        dma_length = int(prefix["flags_and_dma_length"][0]) & _DMA_LENGTH_MASK
+        eval_info_mask = int(prefix["eval_info_mask"][0])
+        if eval_info_mask & _MDH_ACQEND or dma_length == 0:
+            break
+        if eval_info_mask & _MDH_SYNCDATA:
+            position += dma_length
+            continue
+        length = int(_scan_lengths(prefix)[0])
+        n_run = min((end - position - _SCAN_HEADER_SIZE) // length + 1, _RUN_SIZE)
+        run = position + length * np.arange(n_run, dtype=np.int64)
+        prefixes = _read_records(buffer, run, _MDH_PREFIX_DTYPE)
+        is_same = (
+            (prefixes["eval_info_mask"] & (_MDH_ACQEND | _MDH_SYNCDATA) == 0)
+            & (prefixes["flags_and_dma_length"] & _DMA_LENGTH_MASK != 0)
+            & (_scan_lengths(prefixes) == length)
+        )
+        n_same = n_run if is_same.all() else int(np.argmin(is_same))
+        runs.append(run[:n_same])
+        position += length * n_same
+    positions = np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+    # drop a last scan that was cut off
+    if positions.size:
+        prefix = _read_records(buffer, positions[-1:], _MDH_PREFIX_DTYPE)
+        if positions[-1] + _scan_lengths(prefix)[0] > end:
+            positions = positions[:-1]
+    return positions
+
+
+def _read_buffers(buffer: np.ndarray, offset: int) -> Dict[str, bytes]:
+    """Read the protocol buffers of the header of a measurement.
+
+    Args:
+        buffer: bytes of the file of type uint8.
+        offset: byte position of the measurement.
+    Returns:
+        raw text of each protocol buffer, by buffer name.
+    """
+    n_buffers = int(buffer[offset + 4 : offset + 8].view("<u4")[0])
+    position = offset + 8
+    buffers = {}
+    for _ in range(n_buffers):
+        name = re.match(rb"\w*", bytes(buffer[position : position + 10])).group(0)
+        position += len(name) + 1
+        length = int(buffer[position : position + 4].view("<u4")[0])
+        position += 4
+        if not name or position + length > buffer.shape[0]:
+            raise ValueError("Corrupt twix header at byte {}.".format(position))
+        buffers[name.decode()] = bytes(buffer[position : position + length])
+        position += length
+    return buffers
+
+
+class ProtocolBuffer(object):
+    """Values of one protocol buffer of a twix header, parsed on lookup.
+
+    Keys are looked up as in mapVBVD: tuple keys are ASCCONV parameters, for example
+    ("sRXSPEC", "alDwellTime", "0") for sRXSPEC.alDwellTime[0], and string keys are
+    XProtocol parameters, for example "TR". Numeric values are returned as floats
+    and other values as strings. Values are also available as attributes.
+    """
+
+    def __init__(self, raw: bytes):
+        """Initialize the buffer.
+
+        Args:
+            raw: raw text of the buffer.
+        """
+        self._raw = raw
+        self._text = None
+        self._ascconv = None
+        self._values = {}
+
+    def _get_text(self) -> str:
+        """Get the buffer text, trimmed of whitespace and blank lines as in mapVBVD."""
+        if self._text is None:
+            lines = self._raw.decode("latin-1", errors="ignore").split("\n")
+            self._text = "\n".join([line.strip() for line in lines if line.strip()])
+            ascconv = _ASCCONV.search(self._text)
+            self._ascconv = ascconv.group(0) if ascconv is not None else ""
+        return self._text
+
+    def _lookup_ascconv(self, key: Tuple[str, ...]) -> Any:
+        """Look up an ASCCONV parameter."""
+        name = ""
+        for part in key:
+            if part.isdigit():
+                name += "[{}]".format(part)
+            else:
+                name += ("." if name else "") + part
+        self._get_text()
+        matches = re.findall(
+            r"^{}\s*=\s*(\S*)$".format(re.escape(name)), self._ascconv, re.MULTILINE
+        )
+        if not matches:
+            raise KeyError(key)
+        try:
+            return float(matches[-1])
+        except ValueError:
+            return matches[-1]
+
+    def _lookup_xprotocol(self, key: str) -> Any:
+        """Look up an XProtocol parameter."""
+        matches = re.findall(
+            r'<Param(?:Bool|Long|String|Double)\."{}">\s*{{\s*'
+            r"(?:<Precision>\s*[0-9]*)?\s*([^}}]*)".format(re.escape(key)),
+            self._get_text(),
+        )
+        if not matches:
+            raise KeyError(key)
+        value = matches[-1].strip()
+        # long values are most likely nested ASCCONV blocks, kept as they are
+        if len(value) < 5000:
+            value = _QUOTES_AND_NESTED_TAGS.sub("", value).strip()
+            value = _REPEATED_WHITESPACE.sub(" ", value)
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        return value
+
+    def __getitem__(self, key: Union[str, Tuple[str, ...]]) -> Any:
+        """Get the value of a parameter."""
+        if key not in self._values:
+            if isinstance(key, tuple):
+                self._values[key] = self._lookup_ascconv(key)
+            else:
+                self._values[key] = self._lookup_xprotocol(key)
+        return self._values[key]
+
+    def __getattr__(self, name: str) -> Any:
+        """Get the value of an XProtocol parameter."""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, key: Union[str, Tuple[str, ...]]) -> bool:
+        """Check whether the buffer has a parameter."""
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+
+class TwixHeader(object):
+    """Protocol buffers of a twix measurement, such as Config, Dicom and MeasYaps."""
+
+    def __init__(self, buffers: Dict[str, bytes]):
+        """Initialize the header.
+
+        Args:
+            buffers: raw text of each protocol buffer, by buffer name.
+        """
+        self._buffers = {name: ProtocolBuffer(raw) for name, raw in buffers.items()}
+
+    def keys(self) -> List[str]:
+        """Get the names of the protocol buffers."""
+        return list(self._buffers.keys())
+
+    def __getitem__(self, name: str) -> ProtocolBuffer:
+        """Get a protocol buffer."""
+        return self._buffers[name]
+
+    def __getattr__(self, name: str) -> ProtocolBuffer:
+        """Get a protocol buffer."""
+        if name.startswith("_") or name not in self._buffers:
+            raise AttributeError(name)
+        return self._buffers[name]
+
+    def __contains__(self, name: str) -> bool:
+        """Check whether the header has a protocol buffer."""
+        return name in self._buffers
+
+
+class AdcLines(object):
+    """Lazy array of the ADC lines of a memory-mapped twix file.
+
+    Indexing reads the selected lines into an array of shape (lines, channels,
+    columns) of type complex64. Lines at evenly spaced positions, which is the usual
+    case, are returned as a read-only strided view of the file without copying.
+    """
+
+    def __init__(
+        self, buffer: np.ndarray, positions: np.ndarray, n_channels: int, n_columns: int
+    ):
+        """Initialize the lines.
+
+        Args:
+            buffer: bytes of the file of type uint8.
+            positions: byte positions of the scans of the lines.
+            n_channels: number of channels of each line.
+            n_columns: number of samples of each line and channel.
+        """
+        self._buffer = buffer
+        self._positions = positions
+        self.n_channels = n_channels
+        self.n_columns = n_columns
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """Shape of the lines."""
+        return (self._positions.shape[0], self.n_channels, self.n_columns)
+
+    @property
+    def dtype(self) -> np.dtype:
+        """Data type of the lines."""
+        return np.dtype(np.complex64)
+
+    def __len__(self) -> int:
+        """Number of lines."""
+        return self._positions.shape[0]
+
+    def __getitem__(self, key: Any) -> np.ndarray:
+        """Read the selected lines."""
+        positions = self._positions[key]
+        if np.ndim(positions) == 0:
+            return self[np.atleast_1d(key)][0]
+        channel_stride = _CHANNEL_HEADER_SIZE + 8 * self.n_columns
+        steps = np.diff(positions)
+        if positions.shape[0] > 1 and steps[0] > 0 and np.all(steps == steps[0]):
+            return np.ndarray(
+                shape=(positions.shape[0], self.n_channels, self.n_columns),
+                dtype=np.complex64,
+                buffer=self._buffer,
+                offset=int(positions[0]) + _SCAN_HEADER_SIZE + _CHANNEL_HEADER_SIZE,
+                strides=(int(steps[0]), channel_stride, 8),
+            )
+        lines = np.empty(
+            (positions.shape[0], self.n_channels, self.n_columns), dtype=np.complex64
+        )
+        for i, position in enumerate(positions):
+            scan = self._buffer[
+                position
+                + _SCAN_HEADER_SIZE : position
+                + _SCAN_HEADER_SIZE
+                + self.n_channels * channel_stride
+            ]
+            channels = scan.reshape((self.n_channels, channel_stride))
+            lines[i] = channels[:, _CHANNEL_HEADER_SIZE:].view(np.complex64)
+        return lines
+
+
+class TwixImage(object):
+    """Image scans of a twix measurement.
+
+    Mirrors the mapVBVD image object: unsorted() returns the lines in acquisition
+    order in shape (columns, channels, lines), and [""] the lines sorted by their loop
+    counters in shape (columns, channels, lines, partitions, slices, averages,
+    phases, echoes, repetitions, sets, segments, ida, idb, idc, idd, ide). Reflected
+    lines are reversed and repeated lines averaged as in mapVBVD.
+
+    Attributes:
+        lines: AdcLines, the lazy ADC lines in acquisition order.
+        squeeze: bool, whether to drop the singleton dimensions of the data.
+        flagRemoveOS: bool, whether to remove the 2x readout oversampling.
+        flagDoAverage: bool, whether to average over the averages dimension.
+        flagAverageReps: bool, whether to average over the repetitions dimension.
+        flagAverageSets: bool, whether to average over the sets dimension.
+        flagIgnoreSeg: bool, whether to average over the segments dimension.
+        flagDisableReflect: bool, whether to keep reflected lines as acquired.
+    """
+
+    def __init__(self, lines: AdcLines, headers: np.ndarray):
+        """Initialize the image scans.
+
+        Args:
+            lines: lazy ADC lines of the image scans.
+            headers: MDHs of the image scans of type _MDH_DTYPE.
+        """
+        self.lines = lines
+        self._loop_counters = headers["loop_counters"][:, _SORTED_LOOP_COUNTERS]
+        self._is_reflected = headers["eval_info_mask"] & _MDH_REFLECT != 0
+        self.squeeze = False
+        self.flagRemoveOS = True
+        self.flagDoAverage = False
+        self.flagAverageReps = False
+        self.flagAverageSets = False
+        self.flagIgnoreSeg = False
+        self.flagDisableReflect = False
+
+    def _read(self, key: Any = slice(None)) -> np.ndarray:
+        """Read lines in shape (lines, channels, columns) with corrections applied."""
+        lines = self.lines[key]
+        is_reflected = self._is_reflected[key]
+        if not self.flagDisableReflect and np.any(is_reflected):
+            lines = np.array(lines)
+            lines[is_reflected] = lines[is_reflected, :, ::-1]
+        if self.flagRemoveOS:
+            n_columns = lines.shape[-1]
+            keep = np.concatenate(
+                [np.arange(n_columns // 4), np.arange(n_columns * 3 // 4, n_columns)]
+            )
+            lines = np.fft.fft(np.fft.ifft(lines, axis=-1)[..., keep], axis=-1)
+            lines = lines.astype(np.complex64, copy=False)
+        return lines
+
+    def _output(self, data: np.ndarray) -> np.ndarray:
+        """Squeeze the data if requested."""
+        return np.squeeze(data) if self.squeeze else data
+
+    def unsorted(self, ival: Optional[int] = None) -> np.ndarray:
+        """Get the lines in acquisition order.
+
+        Args:
+            ival: number of a single line to get, counting from 1. Gets all lines if
+                not given.
+        Returns:
+            lines in shape (columns, channels, lines).
+        """
+        key = slice(ival - 1, ival) if ival else slice(None)
+        return self._output(np.transpose(self._read(key)))
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        """Get all lines sorted by their loop counters.
+
+        Args:
+            key: the empty string, only the full selection is supported.
+        Returns:
+            lines sorted by their loop counters.
+        """
+        if key not in ("", None):
+            raise ValueError("Only the full selection [''] is supported.")
+        counters = self._loop_counters.astype(np.int64)
+        sizes = counters.max(axis=0) + 1
+        averaged = np.zeros(sizes.shape[0], dtype=bool)
+        averaged[_SORTED_AVE] = self.flagDoAverage
+        averaged[_SORTED_REP] = self.flagAverageReps
+        averaged[_SORTED_SET] = self.flagAverageSets
+        averaged[_SORTED_SEG] = self.flagIgnoreSeg
+        counters[:, averaged] = 0
+        sizes[averaged] = 1
+        target = np.ravel_multi_index(tuple(counters.T), tuple(sizes))
+
+        lines = self._read()
+        data = np.zeros((np.prod(sizes),) + lines.shape[1:], dtype=np.complex64)
+        np.add.at(data, target, lines)
+        counts = np.bincount(target, minlength=data.shape[0])
+        if np.any(counts > 1):
+            data /= np.maximum(counts, 1).astype(np.float32)[:, np.newaxis, np.newaxis]
+        data = np.transpose(data).reshape(data.shape[:0:-1] + tuple(sizes))
+        return self._output(data)
+
+
+class TwixObject(object):
+    """Header and image scans of one measurement of a twix file.
+
+    Attributes:
+        hdr: TwixHeader, the protocol buffers of the measurement.
+        image: TwixImage, the image scans. Not set if the measurement has none.
+    """
+
+    def __init__(self, hdr: TwixHeader, image: Optional[TwixImage]):
+        """Initialize the measurement."""
+        self.hdr = hdr
+        if image is not None:
+            self.image = image
+
+    def __getitem__(self, key: str) -> Any:
+        """Get the header or image scans."""
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+
+def _read_measurement(buffer: np.ndarray, offset: int) -> TwixObject:
+    """Read the header and index the scans of a measurement.
+
+    Args:
+        buffer: bytes of the file of type uint8.
+        offset: byte position of the measurement.
+    Returns:
+        the measurement.
+    """
+    header_length = int(buffer[offset : offset + 4].view("<u4")[0])
+    hdr = TwixHeader(_read_buffers(buffer, offset))
+    if "Meas" in hdr and "alRegridMode" in hdr.Meas:
+        if float(str(hdr.Meas.alRegridMode).split(" ")[0]) > 1:
+            raise ValueError("Ramp sampling regridding is not supported.")
+
+    positions = _scan_positions(buffer, offset + header_length)
+    headers = _read_records(buffer, positions, _MDH_DTYPE)
+    eval_info_mask = headers["eval_info_mask"]
+    is_image = (eval_info_mask & _MDH_NOT_IMAGE == 0) & ~(
+        (eval_info_mask & _MDH_PATREFSCAN != 0)
+        & (eval_info_mask & _MDH_PATREFANDIMASCAN == 0)
+    )
+    if not np.any(is_image):
+        return TwixObject(hdr, None)
+    headers = headers[is_image]
+    n_columns = headers["samples_in_scan"]
+    n_channels = headers["used_channels"]
+    if np.any(n_columns != n_columns[0]) or np.any(n_channels != n_channels[0]):
+        raise ValueError("Image scans of different shapes are not supported.")
+    lines = AdcLines(
+        buffer, positions[is_image], int(n_channels[0]), int(n_columns[0])
+    )
+    return TwixObject(hdr, TwixImage(lines, headers))
+
+
+def read_twix(path: str) -> Union[TwixObject, List[TwixObject]]:
+    """Read a VD/VE twix file.
+
+    Args:
+        path: str file path of twix file
+    Returns:
+        the measurement, or a list of the measurements if the file has several, as
+        returned by mapVBVD.
+    """
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    if buffer.shape[0] < 8:
+        raise ValueError("Invalid twix file.")
+    first, n_measurements = (int(x) for x in buffer[:8].view("<u4"))
+    if not (first < 10000 and n_measurements <= _MAX_MEASUREMENTS):
+        raise ValueError("Only VD/VE twix files are supported.")
+    entries = np.frombuffer(
+        buffer, dtype=_MEASUREMENT_ENTRY_DTYPE, count=n_measurements, offset=8
+    )
+    measurements = [_read_measurement(buffer, int(e["offset"])) for e in entries]
+    return measurements[0] if len(measurements) == 1 else measurements
@@ -363,7 +363,9 @@ def get_institution_name(twix_obj: mapvbvd._attrdict.AttrDict) -> str:
 
 
 def get_dyn_fids(
-    twix_obj: mapvbvd._attrdict.AttrDict, n_skip_end: int = 20
+    twix_obj: mapvbvd._attrdict.AttrDict,
+    n_skip_end: int = 20,
+    dtype: np.dtype = np.cdouble,
 ) -> np.ndarray:
     """Get the dissolved phase FIDS used for dyn. spectroscopy from twix object.
 
@@ -371,10 +373,11 @@ def get_dyn_fids(
         twix_obj: twix object returned from mapVBVD function
         n_skip_end: number of fids to skip from the end. Usually they are calibration
             frames.
+        dtype: complex data type of the FIDs.
     Returns:
         dissolved phase FIDs in shape (number of points in ray, number of projections).
     """
-    raw_fids = twix_obj.image[""].astype(np.cdouble)
+    raw_fids = twix_obj.image[""].astype(dtype)
     return raw_fids[:, 0 : -(1 + n_skip_end)]
 
 
@@ -402,15 +405,40 @@ def get_bandwidth(
     )
 
 
-def get_gx_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
+def get_gx_data(
+    twix_obj: mapvbvd._attrdict.AttrDict, dtype: np.dtype = np.cdouble
+) -> Dict[str, Any]:
     """Get the dissolved phase and gas phase FIDs from twix object.
 
+    Args:
+        twix_obj: twix object returned from mapVBVD function
+        dtype: complex data type of the FIDs.
+    Returns:
+        a dictionary containing the FIDs and acquisition information, see
+            split_gx_fids.
+    """
+    return split_gx_fids(
+        raw_fids=np.transpose(twix_obj.image.unsorted().astype(dtype)),
+        flip_angle_dissolved=get_flipangle_dissolved(twix_obj),
+        scan_date=get_scan_date(twix_obj=twix_obj),
+    )
+
+
+def split_gx_fids(
+    raw_fids: np.ndarray, flip_angle_dissolved: float, scan_date: str
+) -> Dict[str, Any]:
+    """Split the raw FIDs into the interleaved dissolved phase and gas phase FIDs.
+
     For reconstruction, we also need important information like the gradient delay,
     number of fids in each phase, etc. Note, this cannot be trivially read from the
     twix object, and need to hard code some values. For example, the gradient delay
-    is slightly different depending on the scanner.
+    is slightly different depending on the scanner. The dissolved phase and gas
+    phase FIDs are strided views of the raw FIDs, except for the 2007-2008 Trio
+    data that is phase shifted.
     Args:
-        twix_obj: twix object returned from mapVBVD function
+        raw_fids: raw fids in shape (number of projections, number of points in ray).
+        flip_angle_dissolved: flip angle applied to dissolved phase in degrees.
+        scan_date: scan date in YYYY-MM-DD format.
     Returns:
         a dictionary containing
         1. dissolved phase FIDs in shape (number of projections,
@@ -425,10 +453,6 @@ def get_gx_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
         8. gradient delay z in microseconds.
         9. raw fids in shape (number of projections, number of points in ray).
     """
-    raw_fids = np.transpose(twix_obj.image.unsorted().astype(np.cdouble))
-    flip_angle_dissolved = get_flipangle_dissolved(twix_obj)
-    # get the scan date
-    scan_date = get_scan_date(twix_obj=twix_obj)
     YYYY, MM, DD = scan_date.split("-")
     scan_datetime = datetime.datetime(int(YYYY), int(MM), int(DD))
     # check the flip angle and scan date to get the data
@@ -522,7 +546,9 @@ def get_gx_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
     }
 
 
-def get_ute_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
+def get_ute_data(
+    twix_obj: mapvbvd._attrdict.AttrDict, dtype: np.dtype = np.cdouble
+) -> Dict[str, Any]:
     """Get the UTE FIDs from twix object.
 
     For reconstruction, we also need important information like the gradient delay,
@@ -531,6 +557,7 @@ def get_ute_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
     is slightly different depending on the scanner.
     Args:
         twix_obj: twix object returned from mapVBVD function
+        dtype: complex data type of the FIDs.
     Returns:
         a dictionary containing
         1. UTE FIDs in shape (number of projections,
@@ -542,7 +569,7 @@ def get_ute_data(twix_obj: mapvbvd._attrdict.AttrDict) -> Dict[str, Any]:
         6. gradient delay y in microseconds.
         7. gradient delay z in microseconds.
     """
-    raw_fids = np.array(twix_obj.image.unsorted().astype(np.cdouble))
+    raw_fids = np.array(twix_obj.image.unsorted().astype(dtype))
 
     if raw_fids.ndim == 3:
         raw_fids = np.squeeze(raw_fids[:, 0, :])